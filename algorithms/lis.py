@@ -77,48 +77,128 @@ def longest_decreasing_subsequence(xs):
     return list(reversed(longest_increasing_subsequence(reversed(xs))))
 
 
-def backtracking(a, L, bestsofar):
+def fenwick_query(tree, x):
     """
-    Start with the heaviest weight and emit index
+    Maximum of the values stored at positions 1..x of a Fenwick tree.
     """
-    w, j = max(L.items())
+    best = tree[0]
+    while x > 0:
+        if tree[x] > best:
+            best = tree[x]
+        x -= x & -x
+    return best
+
+
+def fenwick_update(tree, x, value):
+    """
+    Raise the values covering position x of a Fenwick tree to value.
+    """
+    m = len(tree)
+    while x < m:
+        if value > tree[x]:
+            tree[x] = value
+        x += x & -x
+
+
+def heaviest_chain(ranks, weights, nranks, debug=False):
+    """
+    Dynamic programming core for heaviest_increasing_subsequence(). The ranks
+    are the 1-based dense ranks of the keys. Each Fenwick node stores (weight,
+    -rank, -idx - 1), so that among equally heavy subsequences the one ending
+    in the smallest key, then the earliest element, is preferred.
+    """
+    tree = [(0, 0, 0)] * (nranks + 1)
+    prev = [-1] * len(ranks)
+    best = (0, 0, 0)
+    for i, (r, weight) in enumerate(zip(ranks, weights)):
+        w, _, j = fenwick_query(tree, r - 1)
+        prev[i] = -j - 1
+        newbest = (w + weight, -r, -i - 1)
+        if newbest > best:
+            best = newbest
+        fenwick_update(tree, r, newbest)
+
+        if debug:
+            print (r, weight), newbest
+
+    chain = []
+    j = -best[2] - 1  # start backtracking
     while j != -1:
-        yield j
-        w, j = bestsofar[j]
+        chain.append(j)
+        j = prev[j]
+
+    chain.reverse()
+    return chain
 
 
 def heaviest_increasing_subsequence(a, debug=False):
     """
     Returns the heaviest increasing subsequence for array a. Elements are (key,
-    weight) pairs.
+    weight) pairs. Keys are compressed to ranks and the best chain ending below
+    each key is found in O(log n) with a Fenwick tree.
 
     >>> heaviest_increasing_subsequence([(3, 3), (2, 2), (1, 1), (0, 5)])
     [(0, 5)]
+    >>> heaviest_increasing_subsequence([(1, 2), (3, 1), (2, 2), (4, 1)])
+    [(1, 2), (2, 2), (4, 1)]
     """
-    # Stores the smallest idx of last element of a subsequence of weight w
-    L = {0: -1}
-    bestsofar = [(0, -1)] * len(a)  # (best weight, from_idx)
-    for i, (key, weight) in enumerate(a):
+    if not a:
+        return []
 
-        for w, j in L.items():
-            if j != -1 and a[j][0] >= key:
-                continue
+    keys, weights = zip(*a)
+    rank = dict((k, i + 1) for i, k in enumerate(sorted(set(keys))))
+    ranks = [rank[k] for k in keys]
+    chain = heaviest_chain(ranks, weights, len(rank), debug=debug)
 
-            new_weight = w + weight
-            if new_weight in L and a[L[new_weight]][0] <= key:
-                continue
+    return [a[x] for x in chain]
 
-            L[new_weight] = i
-            newbest = (new_weight, j)
-            if newbest > bestsofar[i]:
-                bestsofar[i] = newbest
 
-        if debug:
-            #print (key, weight), L
-            print (key, weight), bestsofar
+def heaviest_increasing_subsequences(blocks):
+    """
+    Batch version of heaviest_increasing_subsequence() over many independent
+    blocks, each a list of (key, weight) pairs with numeric keys. The keys of
+    all blocks are ranked together in one sort.
+
+    >>> heaviest_increasing_subsequences([[(3, 3), (0, 5)], [(1, 1), (2, 1)]])
+    [[(0, 5)], [(1, 1), (2, 1)]]
+    """
+    import numpy as np
 
-    tb = reversed(list(backtracking(a, L, bestsofar)))
-    return [a[x] for x in tb]
+    sizes = np.array([len(x) for x in blocks], dtype=int)
+    n = sizes.sum()
+    if n == 0:
+        return [[] for x in blocks]
+
+    keys = np.array([k for x in blocks for k, w in x])
+    bids = np.repeat(np.arange(len(blocks)), sizes)
+    order = np.lexsort((keys, bids))
+
+    # Dense ranks of the keys, restarting at 1 within each block
+    skeys, sbids = keys[order], bids[order]
+    isnew = np.ones(n, dtype=bool)
+    isnew[1:] = (skeys[1:] != skeys[:-1]) | (sbids[1:] != sbids[:-1])
+    dense = np.cumsum(isnew)
+    blockstarts = np.cumsum(sizes) - sizes
+    nonempty = sizes > 0
+    base = np.zeros(len(blocks), dtype=int)
+    base[nonempty] = dense[np.searchsorted(sbids, np.flatnonzero(nonempty))] - 1
+    ranks = np.empty(n, dtype=int)
+    ranks[order] = dense - base[sbids]
+    nranks = np.zeros(len(blocks), dtype=int)
+    np.maximum.at(nranks, bids, ranks)
+
+    ranks = ranks.tolist()
+    results = []
+    for i, block in enumerate(blocks):
+        start, size = blockstarts[i], sizes[i]
+        if not size:
+            results.append([])
+            continue
+        weights = [w for k, w in block]
+        chain = heaviest_chain(ranks[start:start + size], weights, nranks[i])
+        results.append([block[x] for x in chain])
+
+    return results
 
 
 if __name__ == '__main__':
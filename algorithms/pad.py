@@ -23,7 +23,6 @@ from optparse import OptionParser
 
 from jcvi.algorithms.synteny import AnchorFile, add_beds, check_beds
 from jcvi.formats.bed import Bed
-from jcvi.formats.blast import BlastLine
 from jcvi.apps.base import ActionDispatcher, debug, need_update, sh
 debug()
 
@@ -38,62 +37,121 @@ def main():
     p.dispatch(globals())
 
 
-def make_arrays(blastfile, qpadbed, spadbed, qpadnames, spadnames):
+def get_padindex(padbed, padnames):
+    """
+    Map each gene accn to the index of the PAD (seqid) it belongs to, and return
+    the number of genes within each PAD.
+    """
+    padid = dict((a, i) for i, a in enumerate(padnames))
+    padlen = np.zeros(len(padnames), dtype=int)
+    for a, b in padbed.sub_beds():
+        padlen[padid[a]] = len(b)
+
+    padof = dict((x.accn, padid[x.seqid]) for x in padbed)
+    return padof, padlen
+
+
+def empty_cells(qpadlen, spadlen, density, cutoff, cells):
+    """
+    Find the cells whose expected count is at least cutoff, except the ones
+    in `cells` (flat indices of the non-empty cells). For each row, the columns
+    are the tail of the PAD lengths sorted in ascending order.
+    """
+    n = len(spadlen)
+    order = np.argsort(spadlen, kind="mergesort")
+    slen = spadlen[order]
+    erows, ecols = [], []
+    for r in np.flatnonzero(qpadlen):
+        rowdensity = density * qpadlen[r]
+        # start a bit early and filter, against rounding in the division
+        start = np.searchsorted(slen, cutoff / rowdensity * (1 - 1e-9))
+        c = order[start:]
+        c = c[rowdensity * spadlen[c] >= cutoff]
+        erows.append(np.repeat(r, len(c)))
+        ecols.append(c)
+
+    if not erows:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    erows, ecols = np.concatenate(erows), np.concatenate(ecols)
+    empty = ~np.in1d(erows * n + ecols, cells)
+    erows, ecols = erows[empty], ecols[empty]
+
+    return erows, ecols, density * qpadlen[erows] * spadlen[ecols]
+
+
+def make_arrays(blastfile, qpadbed, spadbed, qpadnames, spadnames, sparse=False,
+                cutoff=None):
     """
     This function makes three matrices: observed, expected and logmp. The logmp
-    contains the statistical significance for each comparison.
+    contains the statistical significance for each comparison, as -log(P) under
+    Poisson where the expected count is proportional to the area of the cell.
+
+    With sparse=True, the result is a scipy.sparse.coo_matrix of the cells with
+    at least one observed dot. An empty cell has -log(P) equal to its expected
+    count, so with a `cutoff` the empty cells whose expected count reaches it
+    are also included; they are found from the sorted PAD lengths, without
+    building the dense matrix.
     """
+    from scipy.stats.distributions import poisson
+
     m, n = len(qpadnames), len(spadnames)
-    qpadorder, spadorder = qpadbed.order, spadbed.order
-    qpadid = dict((a, i) for i, a in enumerate(qpadnames))
-    spadid = dict((a, i) for i, a in enumerate(spadnames))
-    qpadlen = dict((a, len(b)) for a, b in qpadbed.sub_beds())
-    spadlen = dict((a, len(b)) for a, b in spadbed.sub_beds())
+    qpadof, qpadlen = get_padindex(qpadbed, qpadnames)
+    spadof, spadlen = get_padindex(spadbed, spadnames)
 
     qsize, ssize = len(qpadbed), len(spadbed)
 
-    assert sum(qpadlen.values()) == qsize
-    assert sum(spadlen.values()) == ssize
+    assert qpadlen.sum() == qsize
+    assert spadlen.sum() == ssize
 
-    # Populate arrays of observed counts and expected counts
-    logging.debug("Initialize array of size ({0} x {1})".format(m, n))
-    observed = np.zeros((m, n))
+    # Only the first two columns are needed to place the dots
+    qi, si = [], []
     fp = open(blastfile)
-    all_dots = 0
     for row in fp:
-        b = BlastLine(row)
-        qi, q = qpadorder[b.query]
-        si, s = spadorder[b.subject]
-        qseqid, sseqid = q.seqid, s.seqid
-        qsi, ssi = qpadid[qseqid], spadid[sseqid]
-        observed[qsi, ssi] += 1
-        all_dots += 1
+        query, subject = row.split("\t", 2)[:2]
+        qi.append(qpadof[query])
+        si.append(spadof[subject])
+    fp.close()
 
-    assert int(round(observed.sum())) == all_dots
+    qi = np.array(qi, dtype=int)
+    si = np.array(si, dtype=int)
+    all_dots = len(qi)
 
     logging.debug("Total area: {0} x {1}".format(qsize, ssize))
-    S = qsize * ssize
-    expected = np.zeros((m, n))
-    qsum = 0
-    ssum = 0
-    for i, a in enumerate(qpadnames):
-        alen = qpadlen[a]
-        qsum += alen
-        for j, b in enumerate(spadnames):
-            blen = spadlen[b]
-            expected[i, j] = all_dots * alen * blen * 1. / S
+    density = all_dots * 1. / (qsize * ssize)
+
+    if sparse:
+        from scipy.sparse import coo_matrix
 
+        cells, observed = np.unique(qi * n + si, return_counts=True)
+        rows, cols = cells // n, cells % n
+        expected = density * qpadlen[rows] * spadlen[cols]
+        logmp = np.maximum(-poisson.logpmf(observed, expected), 0)
+        logging.debug("Scored {0} non-empty cells of ({1} x {2})".\
+                        format(len(cells), m, n))
+
+        if cutoff is not None and density > 0:
+            erows, ecols, eexpected = empty_cells(qpadlen, spadlen, density,
+                                                  cutoff, cells)
+            logging.debug("Added {0} empty cells with expected >= {1}".\
+                            format(len(erows), cutoff))
+            rows = np.r_[rows, erows]
+            cols = np.r_[cols, ecols]
+            logmp = np.r_[logmp, eexpected]
+
+        return coo_matrix((logmp, (rows, cols)), shape=(m, n))
+
+    # Populate arrays of observed counts and expected counts
+    logging.debug("Initialize array of size ({0} x {1})".format(m, n))
+    observed = np.zeros((m, n))
+    np.add.at(observed, (qi, si), 1)
+    expected = density * np.outer(qpadlen, spadlen)
+
+    assert int(round(observed.sum())) == all_dots
     assert int(round(expected.sum())) == all_dots
 
-    # Calculate the statistical significance for each cell
-    from scipy.stats.distributions import poisson
-    M = m * n  # multiple testing
-    logmp = np.zeros((m, n))
-    for i in xrange(m):
-        for j in xrange(n):
-            obs, exp = observed[i, j], expected[i, j]
-            pois = max(poisson.pmf(obs, exp), 1e-250)  # Underflow
-            logmp[i, j] = max(- log(pois), 0)
+    # Stay in log-space so that extreme cells do not underflow to zero
+    logmp = np.maximum(-poisson.logpmf(observed, expected), 0)
 
     return logmp
 
@@ -110,6 +168,8 @@ def pad(args):
     add_beds(p)
     p.add_option("--cutoff", default=.3, type="float",
                  help="The clustering cutoff to call similar [default: %default]")
+    p.add_option("--sparse", default=False, action="store_true",
+                 help="Only score cells with dots, for large PAD sets [default: %default]")
 
     opts, args = p.parse_args(args)
     qbed, sbed, qorder, sorder, is_self = check_beds(p, opts)
@@ -138,18 +198,21 @@ def pad(args):
     qnames = range(len(qparts))
     snames = range(len(sparts))
 
-    logmp = make_arrays(blastfile, qbed, sbed, qnames, snames)
-    m, n = logmp.shape
     pvalue_cutoff = 1e-30
     cutoff = - log(pvalue_cutoff)
-
-    significant = []
-    for i in xrange(m):
-        for j in xrange(n):
-            score = logmp[i, j]
-            if score < cutoff:
-                continue
-            significant.append((qparts[i], sparts[j], score))
+    logmp = make_arrays(blastfile, qbed, sbed, qnames, snames,
+                        sparse=opts.sparse, cutoff=cutoff)
+
+    if opts.sparse:
+        rows, cols, scores = logmp.row, logmp.col, logmp.data
+        ok = scores >= cutoff
+        rows, cols, scores = rows[ok], cols[ok], scores[ok]
+    else:
+        rows, cols = np.nonzero(logmp >= cutoff)
+        scores = logmp[rows, cols]
+
+    significant = [(qparts[i], sparts[j], score) \
+                    for i, j, score in zip(rows, cols, scores)]
 
     for a, b, score in significant:
         print "|".join(a), "|".join(b), score
@@ -18,108 +18,116 @@ import sys
 import collections
 import logging
 
+import numpy as np
 from optparse import OptionParser
 
 from jcvi.formats.blast import BlastLine
 from jcvi.formats.coords import CoordsLine
-from jcvi.utils.range import Range, range_chain
+from jcvi.utils.range import range_chain_arrays
 from jcvi.apps.base import debug
 debug()
 
 
-def BlastOrCoordsLine(filename, filter="ref", dialect="blast", clip=0):
-    allowed_filters = ("ref", "query")
-    REF, QUERY = range(len(allowed_filters))
-
+def BlastOrCoordsRanges(filename, dialect="blast", clip=0):
+    """
+    Parse the alignments once, and return the line numbers, the scores and the
+    (seqids, starts, ends) arrays on both the ref and the query.
+    """
     allowed_dialects = ("blast", "coords")
     BLAST, COORDS = range(len(allowed_dialects))
 
-    assert filter in allowed_filters
-    filter = allowed_filters.index(filter)
-
     assert dialect in allowed_dialects
     dialect = allowed_dialects.index(dialect)
 
+    ids, scores = [], []
+    ranges = {"ref": ([], [], []), "query": ([], [], [])}
+    qseqids, qstarts, qends = ranges["query"]
+    rseqids, rstarts, rends = ranges["ref"]
+
     fp = open(filename)
     for i, row in enumerate(fp):
         if row[0] == '#':
             continue
         if dialect == BLAST:
             b = BlastLine(row)
-            if filter == QUERY:
-                query, start, end = b.query, b.qstart, b.qstop
-            else:
-                query, start, end = b.subject, b.sstart, b.sstop
+            qseqids.append(b.query)
+            qstarts.append(b.qstart)
+            qends.append(b.qstop)
+            rseqids.append(b.subject)
+            rstarts.append(b.sstart)
+            rends.append(b.sstop)
         else:
             try:
                 b = CoordsLine(row)
             except AssertionError:
                 continue
 
-            if filter == QUERY:
-                query, start, end = b.query, b.start2, b.end2
-            else:
-                query, start, end = b.ref, b.start1, b.end1
+            qseqids.append(b.query)
+            qstarts.append(b.start2)
+            qends.append(b.end2)
+            rseqids.append(b.ref)
+            rstarts.append(b.start1)
+            rends.append(b.end1)
+
+        ids.append(i)
+        scores.append(b.score)
+    fp.close()
 
-        if start > end:
-            start, end = end, start
+    for filter, (seqids, starts, ends) in ranges.items():
+        starts, ends = np.array(starts), np.array(ends)
+        starts, ends = np.minimum(starts, ends), np.maximum(starts, ends)
 
         if clip:
             # clip cannot be more than 5% of the range
-            r = end - start + 1
-            cc = min(.05 * r, clip)
-            start = start + cc
-            end = end - cc
-
-        yield Range(query, start, end, b.score, i)
-
-
-def supermap(blast_file, filter="intersection", dialect="blast", clip=0):
-    # filter by query
-    if filter != "ref":
-        logging.debug("filter by query")
-        ranges = list(BlastOrCoordsLine(blast_file, filter="query",
-            dialect=dialect, clip=clip))
+            r = ends - starts + 1
+            cc = np.minimum(.05 * r, clip)
+            starts = starts + cc
+            ends = ends - cc
 
-        query_selected, query_score = range_chain(ranges)
-        query_idx = set(x.id for x in query_selected)
+        ranges[filter] = (seqids, starts, ends)
 
-    # filter by ref
-    if filter != "query":
-        logging.debug("filter by ref")
-        ranges = list(BlastOrCoordsLine(blast_file, filter="ref",
-            dialect=dialect, clip=clip))
+    return np.array(ids, dtype=int), scores, ranges
 
-        ref_selected, ref_score = range_chain(ranges)
-        ref_idx = set(x.id for x in ref_selected)
 
-    if filter == "ref":
-        selected_idx = ref_idx
-
-    elif filter == "query":
-        selected_idx = query_idx
+def supermap(blast_file, filter="intersection", dialect="blast", clip=0):
+    ids, scores, ranges = BlastOrCoordsRanges(blast_file, dialect=dialect,
+                                              clip=clip)
+    filters = [filter] if filter in ("ref", "query") else ["query", "ref"]
+
+    selected = {}
+    for f in filters:
+        logging.debug("filter by {0}".format(f))
+        seqids, starts, ends = ranges[f]
+        chains, score = range_chain_arrays(seqids, starts, ends, scores)
+        mask = np.zeros(len(ids), dtype=bool)
+        mask[chains] = True
+        selected[f] = mask
+
+    if filter in ("ref", "query"):
+        mask = selected[filter]
 
     elif filter == "intersection":
         logging.debug("perform intersection")
-        selected_idx = ref_idx & query_idx
+        mask = selected["ref"] & selected["query"]
 
     elif filter == "union":
         logging.debug("perform union")
-        selected_idx = ref_idx | query_idx
-
-    assert len(selected_idx) != 0
+        mask = selected["ref"] | selected["query"]
 
     # selected_idx is in fact the lineno in the BLAST file
-    fp = open(blast_file)
+    selected_idx = ids[mask].tolist()
+    assert len(selected_idx) != 0
 
     if filter == "intersection":
         tag = ""
     else:
         tag = "." + filter
     supermapfile = blast_file + tag + ".supermap"
+
+    fp = open(blast_file)
     fw = open(supermapfile, "w")
 
-    selected_idx = iter(sorted(selected_idx))
+    selected_idx = iter(selected_idx)
     selected = selected_idx.next()
     for i, row in enumerate(fp):
         if i < selected:
@@ -2,6 +2,7 @@
 # -*- coding: UTF-8 -*-
 
 import sys
+import time
 import logging
 import collections
 
@@ -9,9 +10,10 @@ import numpy as np
 from optparse import OptionParser
 
 from jcvi.formats.bed import Bed, BedLine
-from jcvi.formats.blast import BlastLine
+from jcvi.formats.blast import BlastLine, BlastTable, set_table, \
+        group_bounds
 from jcvi.formats.base import BaseFile, read_block
-from jcvi.utils.grouper import Grouper
+from jcvi.utils.grouper import CompactGrouper, DisjointSet
 from jcvi.apps.base import ActionDispatcher, debug
 debug()
 
@@ -53,10 +55,13 @@ def group_hits(blasts):
     return all_hits
 
 
-def read_blast(blast_file, qorder, sorder, is_self=False):
+def read_blast(blast_file, qorder, sorder, is_self=False, table=False):
     """
     read the blast and convert name into coordinates
     """
+    if table:
+        return read_blasttable(blast_file, qorder, sorder, is_self=is_self)
+
     fp = open(blast_file)
     filtered_blast = []
     seen = set()
@@ -88,6 +93,46 @@ def read_blast(blast_file, qorder, sorder, is_self=False):
     return filtered_blast
 
 
+def read_blasttable(blast_file, qorder, sorder, is_self=False):
+    """
+    Same as read_blast(), but through the cached columnar BlastTable, so that
+    repeated runs on the same blast_file just map the binary sidecar
+    """
+    blast = BlastTable(blast_file, cache=True)
+    names = blast.names
+    qranks = np.array([qorder[x][0] if x in qorder else -1 for x in names],
+                      dtype="i8")
+    sranks = np.array([sorder[x][0] if x in sorder else -1 for x in names],
+                      dtype="i8")
+
+    data = blast.data
+    qi, si = qranks[data["query"]], sranks[data["subject"]]
+    rows = np.flatnonzero((qi >= 0) & (si >= 0))
+    qi, si = qi[rows], si[rows]
+
+    # keep the first hit of each (query, subject) pair, in file order
+    n = int(si.max()) + 1 if len(si) else 1
+    first = np.sort(np.unique(qi * n + si, return_index=True)[1])
+
+    qlines = dict(qorder.values())
+    slines = dict(sorder.values())
+    filtered_blast = []
+    for i, qi, si in zip(rows[first], qi[first], si[first]):
+        qi, si = int(qi), int(si)
+        q, s = qlines[qi], slines[si]
+        if is_self and qi > si:
+            # remove redundant a<->b to one side when doing self-self BLAST
+            qi, si = si, qi
+            q, s = s, q
+
+        b = blast.blastline(i)
+        b.qseqid, b.sseqid = q.seqid, s.seqid
+        b.qi, b.si = qi, si
+        filtered_blast.append(b)
+
+    return filtered_blast
+
+
 def read_anchors(anchor_file, qorder, sorder):
     """
     anchors file are just (geneA, geneB) pairs (with possible deflines)
@@ -107,15 +152,18 @@ def read_anchors(anchor_file, qorder, sorder):
     return all_anchors
 
 
-def synteny_scan(points, xdist, ydist, N):
+def synteny_scan(points, xdist, ydist, N, engine="python"):
     """
     This is the core single linkage algorithm which behaves in O(n):
     iterate through the pairs, foreach pair we look back on the
     adjacent pairs to find links
     """
-    clusters = Grouper()
+    if engine == "numpy":
+        return synteny_scan_numpy(points, xdist, ydist, N)
+
     n = len(points)
     points.sort()
+    clusters = DisjointSet(n)
     for i in xrange(n):
         for j in xrange(i - 1, -1, -1):
             # x-axis distance
@@ -127,26 +175,123 @@ def synteny_scan(points, xdist, ydist, N):
             if abs(del_y) > ydist:
                 continue
             # otherwise join
-            clusters.join(points[i], points[j])
+            clusters.join(i, j)
 
+    # duplicated points are collapsed, as they are the same member
+    clusters = [sorted(set(points[k] for k in cluster)) for cluster in clusters]
     # select clusters that are at least >=N
-    clusters = [sorted(cluster) for cluster in list(clusters) \
-            if _score(cluster) >= N]
+    clusters = [cluster for cluster in clusters if _score(cluster) >= N]
+
+    return clusters
+
+
+def synteny_scan_numpy(points, xdist, ydist, N):
+    """
+    Vectorized synteny_scan(), gives the same clusters. Distinct points are
+    sorted by x, the look-back window of each point is found by searchsorted
+    and scanned one offset at a time over all points at once. Links are then
+    merged with an array-based union-find. Clusters are sorted by their first
+    point.
+    """
+    from jcvi.utils.grouper import array_union
+
+    if not len(points):
+        return []
+
+    # distinct points sorted by (x, y), duplicates collapse as in synteny_scan()
+    pts, counts = np.unique(np.array(points, dtype="i8").view([("x", "i8"),
+                            ("y", "i8")]).ravel(), return_counts=True)
+    x, y = pts["x"], pts["y"]
+    n = len(pts)
+
+    lo = np.searchsorted(x, x - xdist, side="left")
+    window = np.arange(n) - lo
+    a, b = [], []
+    i = np.arange(n)
+    for k in xrange(1, window.max() + 1):
+        i = i[window[i] >= k]
+        j = i - k
+        linked = np.abs(y[i] - y[j]) <= ydist
+        a.append(i[linked])
+        b.append(j[linked])
+
+    a = np.concatenate(a) if a else np.zeros(0, dtype=int)
+    b = np.concatenate(b) if b else np.zeros(0, dtype=int)
+    labels = array_union(n, a, b)
+
+    # points joined to anything, duplicated points are joined to themselves
+    member = counts > 1
+    member[a] = member[b] = True
+    idx = np.flatnonzero(member)
+    idx = idx[np.argsort(labels[idx], kind="mergesort")]
+    starts, stops = group_bounds(labels[idx])
+
+    # score is the number of distinct x or y, whichever is smaller
+    gid = np.repeat(np.arange(len(starts)), stops - starts)
+    xs = np.ones(len(idx), dtype=bool)
+    xs[1:] = (x[idx][1:] != x[idx][:-1]) | (gid[1:] != gid[:-1])
+    yorder = np.lexsort((y[idx], gid))
+    ys = np.ones(len(idx), dtype=bool)
+    ys[1:] = (y[idx][yorder][1:] != y[idx][yorder][:-1]) | \
+             (gid[yorder][1:] != gid[yorder][:-1])
+    score = np.minimum(np.bincount(gid, weights=xs, minlength=len(starts)),
+                       np.bincount(gid[yorder], weights=ys,
+                                   minlength=len(starts)))
+
+    coords = zip(x.tolist(), y.tolist())
+    clusters = [[coords[k] for k in idx[start:stop]] \
+                for start, stop, s in zip(starts, stops, score) if s >= N]
 
     return clusters
 
 
-def batch_scan(points, xdist=20, ydist=20, N=6):
+def scan_pair(args):
     """
-    runs synteny_scan() per chromosome pair
+    Runs synteny_scan() on one chromosome pair, used as the worker of the
+    process pool in batch_scan()
     """
+    chr_pair, points, xdist, ydist, N, engine = args
+    start = time.time()
+    clusters = synteny_scan(points, xdist, ydist, N, engine=engine)
+    return chr_pair, len(points), clusters, time.time() - start
+
+
+def batch_scan(points, xdist=20, ydist=20, N=6, engine="python", cpus=1):
+    """
+    runs synteny_scan() per chromosome pair, on a pool of `cpus` processes if
+    more than one. Largest pairs are dispatched first, the clusters are always
+    merged in the sorted order of chromosome pairs.
+    """
+    from multiprocessing import Pool, cpu_count
+
     chr_pair_points = group_hits(points)
+    chr_pairs = sorted(chr_pair_points.keys())
+    jobs = sorted(chr_pairs, key=lambda x: -len(chr_pair_points[x]))
+    jobs = [(x, chr_pair_points[x], xdist, ydist, N, engine) for x in jobs]
+
+    cpus = min(cpus, cpu_count(), len(jobs))
+    if cpus > 1:
+        logging.debug("Create a pool of {0} workers.".format(cpus))
+        pool = Pool(cpus)
+        results = pool.imap_unordered(scan_pair, jobs)
+    else:
+        pool = None
+        results = (scan_pair(x) for x in jobs)
+
+    pair_clusters = {}
+    for i, (chr_pair, npoints, clusters, elapsed) in enumerate(results):
+        pair_clusters[chr_pair] = clusters
+        logging.debug("[{0}/{1}] {2}: {3} points, {4} clusters ({5:.2f}s)".\
+                format(i + 1, len(jobs), "-".join(chr_pair), npoints,
+                       len(clusters), elapsed))
+
+    if pool:
+        pool.close()
+        pool.join()
 
     clusters = []
-    for chr_pair in sorted(chr_pair_points.keys()):
-        points = chr_pair_points[chr_pair]
-        #logging.debug("%s: %d" % (chr_pair, len(points)))
-        clusters.extend(synteny_scan(points, xdist, ydist, N))
+    for chr_pair in chr_pairs:
+        clusters.extend(pair_clusters[chr_pair])
 
     return clusters
 
@@ -198,6 +343,13 @@ def check_beds(p, opts):
     return qbed, sbed, qorder, sorder, is_self
 
 
+def add_engine(p):
+
+    p.add_option("--engine", default="python", choices=("python", "numpy"),
+            help="Single-linkage engine, `numpy` is vectorized for large "
+                 "inputs [default: %default]")
+
+
 def add_options(p, args):
     """
     scan and liftover has similar interfaces, so share common options
@@ -206,6 +358,7 @@ def add_options(p, args):
     add_beds(p)
     p.add_option("--dist", default=10, type="int",
             help="Extent of flanking regions to search [default: %default]")
+    set_table(p)
 
     opts, args = p.parse_args(args)
 
@@ -322,7 +475,7 @@ def group(args):
         sys.exit(not p.print_help())
 
     anchorfiles = args
-    groups = Grouper()
+    groups = CompactGrouper()
     for anchorfile in anchorfiles:
         ac = AnchorFile(anchorfile)
         for a, b in ac.iter_pairs():
@@ -376,7 +529,8 @@ def depth(args):
     range_depth(sranges, len(sbed))
 
 
-def get_blocks(scaffold, bs, order, xdist=20, ydist=20, N=6):
+def get_blocks(scaffold, bs, order, xdist=20, ydist=20, N=6,
+               engine="python"):
     points = []
     for b in bs:
         accn = b.accn.rsplit(".", 1)[0]
@@ -387,7 +541,7 @@ def get_blocks(scaffold, bs, order, xdist=20, ydist=20, N=6):
         points.append((x, y))
 
     #print scaffold, points
-    blocks = synteny_scan(points, xdist, ydist, N)
+    blocks = synteny_scan(points, xdist, ydist, N, engine=engine)
     return blocks
 
 
@@ -409,6 +563,7 @@ def breakpoint(args):
                  help="ydist (in current genome) cutoff [default: %default]")
     p.add_option("-n", type="int", default=5,
                  help="number of markers in a block [default: %default]")
+    add_engine(p)
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
@@ -421,7 +576,8 @@ def breakpoint(args):
     key = lambda x: x[1]
     for scaffold, bs in bbed.sub_beds():
         blocks = get_blocks(scaffold, bs, order,
-                            xdist=opts.xdist, ydist=opts.ydist, N=opts.n)
+                            xdist=opts.xdist, ydist=opts.ydist, N=opts.n,
+                            engine=opts.engine)
         sblocks = []
         for block in blocks:
             xx, yy = zip(*block)
@@ -443,14 +599,19 @@ def scan(args):
     p = OptionParser(scan.__doc__)
     p.add_option("-n", type="int", default=5,
             help="minimum number of anchors in a cluster [default: %default]")
+    p.add_option("--cpus", default=1, type="int",
+            help="Scan chromosome pairs in parallel [default: %default]")
+    add_engine(p)
 
     blast_file, anchor_file, dist, opts = add_options(p, args)
     qbed, sbed, qorder, sorder, is_self = check_beds(p, opts)
 
-    filtered_blast = read_blast(blast_file, qorder, sorder, is_self=is_self)
+    filtered_blast = read_blast(blast_file, qorder, sorder, is_self=is_self,
+                                table=opts.table)
 
     fw = open(anchor_file, "w")
-    clusters = batch_scan(filtered_blast, xdist=dist, ydist=dist, N=opts.n)
+    clusters = batch_scan(filtered_blast, xdist=dist, ydist=dist, N=opts.n,
+                          engine=opts.engine, cpus=opts.cpus)
     for cluster in clusters:
         print >>fw, "###"
         for qi, si in cluster:
@@ -481,7 +642,8 @@ def liftover(args):
     blast_file, anchor_file, dist, opts = add_options(p, args)
     qbed, sbed, qorder, sorder, is_self = check_beds(p, opts)
 
-    filtered_blast = read_blast(blast_file, qorder, sorder, is_self=is_self)
+    filtered_blast = read_blast(blast_file, qorder, sorder, is_self=is_self,
+                                table=opts.table)
     all_hits = group_hits(filtered_blast)
     all_anchors = read_anchors(anchor_file, qorder, sorder)
 
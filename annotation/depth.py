@@ -7,20 +7,25 @@ and optimize against the truth, to determine the cutoff for incorporating
 RNA-seq into annotation pipelines.
 """
 
+import os
 import sys
 import os.path as op
 import numpy as np
 import logging
 
-from itertools import groupby
+from itertools import islice
 from optparse import OptionParser
 
 from jcvi.formats.sizes import Sizes
 from jcvi.formats.base import BaseFile, must_open
-from jcvi.apps.base import ActionDispatcher, debug
+from jcvi.utils.cbook import memoized
+from jcvi.apps.base import ActionDispatcher, debug, set_outfile
 debug()
 
 
+Dtypes = {1: np.uint8, 2: np.uint16}
+
+
 class BinFile (BaseFile):
     """
     The binfile contains per base count, fastafile provides the coordinate
@@ -30,6 +35,15 @@ class BinFile (BaseFile):
         super(BinFile, self).__init__(binfile)
         assert op.exists(binfile), \
             "Binary file `{0}` not found. Rerun depth.count().".format(binfile)
+
+        # The width of the counts follows from the size of the coordinate system
+        if fastafile:
+            fastasize, sizes, offsets = get_offsets(fastafile)
+            itemsize, remainder = divmod(op.getsize(binfile), fastasize)
+            assert remainder == 0 and itemsize in Dtypes, \
+                "Size of `{0}` does not match `{1}`".format(binfile, fastafile)
+            dtype = Dtypes[itemsize]
+
         self.dtype = dtype
 
     @property
@@ -43,6 +57,12 @@ class BinFile (BaseFile):
         return np.memmap(binfile, dtype=self.dtype, mode="r")
 
 
+def set_dtype(instance):
+    instance.add_option("--dtype", default="uint8", choices=("uint8", "uint16"),
+            help="Data type of the counts, uint16 avoids clipping deep " \
+                 "coverage at 255 [default: %default]")
+
+
 def main():
 
     actions = (
@@ -55,52 +75,99 @@ def main():
     p.dispatch(globals())
 
 
+def depth_runs(ar, cutoffs, blocksize=1 << 24):
+    """
+    Find the runs of bases in ar (the counts of one contig) with depth at least
+    each of the cutoffs, in one pass over the array. The array is read one
+    block at a time, so that a memory-mapped array is never loaded whole.
+
+    Yields (cutoff, starts, ends, means) arrays for each block, starts and ends
+    are 0-based half-open, means are the floor of the mean depth of the runs.
+    """
+    n = len(ar)
+    carry = dict((c, None) for c in cutoffs)
+    for lo in xrange(0, n, blocksize):
+        block = np.asarray(ar[lo:lo + blocksize])
+        hi = lo + len(block)
+        cumdepth = np.r_[0, np.cumsum(block, dtype=np.int64)]
+        for c in cutoffs:
+            # Threshold crossings are where the padded mask changes value
+            mask = np.r_[False, block >= c, False].view(np.int8)
+            crossings = np.diff(mask)
+            starts = np.flatnonzero(crossings == 1)
+            ends = np.flatnonzero(crossings == -1)
+            sums = cumdepth[ends] - cumdepth[starts]
+            starts += lo
+            ends += lo
+
+            # Stitch the runs that span the block boundaries
+            if carry[c] is not None:
+                cstart, csum = carry[c]
+                if len(starts) and starts[0] == lo:
+                    starts[0] = cstart
+                    sums[0] += csum
+                else:
+                    starts = np.r_[cstart, starts]
+                    ends = np.r_[lo, ends]
+                    sums = np.r_[csum, sums]
+                carry[c] = None
+
+            if len(ends) and ends[-1] == hi and hi < n:
+                carry[c] = (starts[-1], sums[-1])
+                starts, ends, sums = starts[:-1], ends[:-1], sums[:-1]
+
+            yield c, starts, ends, sums // (ends - starts)
+
+
 def bed(args):
     """
     %prog bed binfile fastafile
 
-    Write bed files where the bases have at least certain depth.
+    Write bed files where the bases have at least certain depth. Several
+    cutoffs can be given at once, separated by comma, which writes one bed file
+    per cutoff named `binfile.cutoff.bed`.
     """
     p = OptionParser(bed.__doc__)
     p.add_option("-o", dest="output", default="stdout",
             help="Output file name [default: %default]")
-    p.add_option("--cutoff", dest="cutoff", default=10, type="int",
-            help="Minimum read depth to report intervals [default: %default]")
+    p.add_option("--cutoff", dest="cutoff", default="10",
+            help="Minimum read depth to report intervals, comma-separated " \
+                 "for several [default: %default]")
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
         sys.exit(not p.print_help())
 
     binfile, fastafile = args
-    fw = must_open(opts.output, "w")
-    cutoff = opts.cutoff
-    assert cutoff >= 0, "Need non-negative cutoff"
+    cutoffs = [int(x) for x in opts.cutoff.split(",")]
+    assert min(cutoffs) >= 0, "Need non-negative cutoff"
 
-    b = BinFile(binfile)
-    ar = b.array
+    if len(cutoffs) == 1:
+        fws = {cutoffs[0]: must_open(opts.output, "w")}
+    else:
+        pf = binfile.rsplit(".", 1)[0]
+        fws = dict((c, open("{0}.{1}.bed".format(pf, c), "w")) \
+                    for c in cutoffs)
+
+    b = BinFile(binfile, fastafile)
+    ar = b.mmarray
 
     fastasize, sizes, offsets = get_offsets(fastafile)
     s = Sizes(fastafile)
     for ctg, ctglen in s.iter_sizes():
         offset = offsets[ctg]
         subarray = ar[offset:offset + ctglen]
-        key = lambda x: x[1] >= cutoff
-        for tf, array_elements in groupby(enumerate(subarray), key=key):
-            array_elements = list(array_elements)
-            if not tf:
-                continue
-
-            # 0-based system => 1-based system
-            start = array_elements[0][0] + 1
-            end = array_elements[-1][0] + 1
-
-            mean_depth = sum([x[1] for x in array_elements]) / \
-                len(array_elements)
-            mean_depth = int(mean_depth)
-
+        for c, starts, ends, means in depth_runs(subarray, cutoffs):
+            fw = fws[c]
             name = "na"
-            print >> fw, "\t".join(str(x) for x in (ctg, \
-                    start - 1, end, name, mean_depth))
+            for start, end, mean_depth in zip(starts, ends, means):
+                print >> fw, "\t".join(str(x) for x in (ctg, \
+                        start, end, name, mean_depth))
+
+    for c, fw in sorted(fws.items()):
+        fw.close()
+        if len(fws) > 1:
+            logging.debug("Cutoff {0} written to `{1}`.".format(c, fw.name))
 
 
 def merge(args):
@@ -108,9 +175,10 @@ def merge(args):
     %prog merge *.bin merged.bin
 
     Merge several count arrays into one. Overflows will be capped at uint8_max
-    (255).
+    (255), or uint16_max (65535) with --dtype=uint16.
     """
     p = OptionParser(merge.__doc__)
+    set_dtype(p)
     opts, args = p.parse_args(args)
 
     if len(args) < 2:
@@ -123,70 +191,263 @@ def merge(args):
                 .format(mergedbin))
         return
 
-    b = BinFile(binfiles[0])
+    dtype = np.dtype(opts.dtype)
+    b = BinFile(binfiles[0], dtype=dtype)
     ar = b.mmarray
     fastasize, = ar.shape
-    logging.debug("Initialize array of uint16 with size {0}".format(fastasize))
+    logging.debug("Initialize array of uint32 with size {0}".format(fastasize))
 
-    merged_ar = np.zeros(fastasize, dtype=np.uint16)
+    merged_ar = np.zeros(fastasize, dtype=np.uint32)
     for binfile in binfiles:
-        b = BinFile(binfile)
-        merged_ar += b.array
+        b = BinFile(binfile, dtype=dtype)
+        merged_ar += b.mmarray
 
-    logging.debug("Resetting the count max to 255.")
-    merged_ar[merged_ar > 255] = 255
+    maxcount = np.iinfo(dtype).max
+    logging.debug("Resetting the count max to {0}.".format(maxcount))
+    np.minimum(merged_ar, maxcount, out=merged_ar)
 
-    logging.debug("Compact array back to uint8 with size {0}".format(fastasize))
-    merged_ar = np.array(merged_ar, dtype=np.uint8)
+    logging.debug("Compact array back to {0} with size {1}".\
+                    format(dtype, fastasize))
+    merged_ar = np.array(merged_ar, dtype=dtype)
     merged_ar.tofile(mergedbin)
     logging.debug("Merged array written to `{0}`".format(mergedbin))
 
 
+def contig_lookup(table, ctgs):
+    """
+    Look up the offsets or sizes in table of the contigs in ctgs (array of
+    names).
+    """
+    uniq, inverse = np.unique(ctgs, return_inverse=True)
+    return np.array([table[x] for x in uniq], dtype=np.int64)[inverse]
+
+
+def check_bounds(ctgs, starts, ends, ctgsizes):
+    """
+    Raise if any of the 0-based half-open intervals is outside its contig.
+    """
+    starts, ends, ctgsizes = \
+            np.asarray(starts), np.asarray(ends), np.asarray(ctgsizes)
+    bad = np.flatnonzero((starts < 0) | (ends > ctgsizes) | (starts >= ends))
+    if len(bad):
+        i = bad[0]
+        raise ValueError("{0} queries out of bounds, e.g. `{1}:{2}-{3}` " \
+                "on contig of size {4}".format(len(bad), ctgs[i],
+                starts[i] + 1, ends[i], ctgsizes[i]))
+
+
+def gather_stats(ar, lo, lengths, cutoff):
+    """
+    Gather the bases of the intervals at once and reduce per interval.
+    """
+    bounds = np.r_[0, np.cumsum(lengths)]
+    idx = np.arange(bounds[-1]) - np.repeat(bounds[:-1] - lo, lengths)
+    depth = ar[idx]
+
+    segments = bounds[:-1]
+    sums = np.add.reduceat(depth, segments, dtype=np.int64)
+    mins = np.minimum.reduceat(depth, segments)
+    maxs = np.maximum.reduceat(depth, segments)
+    above = np.add.reduceat(depth >= cutoff, segments, dtype=np.int64)
+
+    return sums, mins, maxs, above
+
+
+def scan_stats(ar, lo, length, cutoff, blocksize):
+    """
+    Reduce one long interval, reading it one block at a time.
+    """
+    sums, mins, maxs, above = 0, None, None, 0
+    for b in xrange(lo, lo + length, blocksize):
+        block = np.asarray(ar[b:min(b + blocksize, lo + length)])
+        sums += block.sum(dtype=np.int64)
+        mn, mx = block.min(), block.max()
+        mins = mn if mins is None else min(mins, mn)
+        maxs = mx if maxs is None else max(maxs, mx)
+        above += np.count_nonzero(block >= cutoff)
+
+    return sums, mins, maxs, above
+
+
+def query_intervals(ar, offsets, sizes, ctgs, starts, ends, cutoff=10,
+                    blocksize=1 << 24):
+    """
+    Depth statistics over the 0-based half-open intervals. Returns mean, min,
+    max and fraction of bases with depth at least cutoff.
+
+    The bases of the intervals are gathered about `blocksize` at a time and
+    reduced per interval; intervals longer than that are scanned on their own,
+    so memory stays bounded whatever the interval sizes.
+    """
+    check_bounds(ctgs, starts, ends, contig_lookup(sizes, ctgs))
+    lengths = ends - starts
+    lo = contig_lookup(offsets, ctgs) + starts
+
+    n = len(lengths)
+    sums = np.zeros(n, dtype=np.int64)
+    mins = np.zeros(n, dtype=ar.dtype)
+    maxs = np.zeros(n, dtype=ar.dtype)
+    above = np.zeros(n, dtype=np.int64)
+
+    big = lengths > blocksize
+    for i in np.flatnonzero(big):
+        sums[i], mins[i], maxs[i], above[i] = \
+                scan_stats(ar, lo[i], lengths[i], cutoff, blocksize)
+
+    small = np.flatnonzero(~big)
+    groups = np.cumsum(lengths[small]) // blocksize
+    for chunk in np.split(small, np.flatnonzero(np.diff(groups)) + 1):
+        if not len(chunk):
+            continue
+        sums[chunk], mins[chunk], maxs[chunk], above[chunk] = \
+                gather_stats(ar, lo[chunk], lengths[chunk], cutoff)
+
+    return sums * 1. / lengths, mins, maxs, above * 1. / lengths
+
+
 def query(args):
     """
     %prog query binfile fastafile ctgID baseID
+    %prog query binfile fastafile queryfile
 
-    Get the depth at a particular base.
+    Get the depth at a particular base. A queryfile answers many queries in one
+    run: a list of `ctgID baseID` gives the depth at each base, a bed file gives
+    the mean, min, max depth and the fraction of bases at or above --cutoff for
+    each interval.
     """
     p = OptionParser(query.__doc__)
+    p.add_option("--cutoff", default=10, type="int",
+            help="Minimum read depth for the fraction column [default: %default]")
+    p.add_option("--chunksize", default=1000000, type="int",
+            help="Number of queries to answer at a time [default: %default]")
+    set_outfile(p)
     opts, args = p.parse_args(args)
 
-    if len(args) != 4:
+    if len(args) not in (3, 4):
         sys.exit(not p.print_help())
 
-    binfile, fastafile, ctgID, baseID = args
+    binfile, fastafile = args[:2]
     b = BinFile(binfile, fastafile)
     ar = b.mmarray
 
     fastasize, sizes, offsets = get_offsets(fastafile)
-    oi = offsets[ctgID] + int(baseID) - 1
-    print "\t".join((ctgID, baseID, str(ar[oi])))
-
+    if len(args) == 4:
+        ctgID, baseID = args[2:]
+        pos = int(baseID)
+        check_bounds([ctgID], [pos - 1], [pos], [sizes[ctgID]])
+        oi = offsets[ctgID] + pos - 1
+        print "\t".join((ctgID, baseID, str(ar[oi])))
+        return
 
-def update_array(ar, coveragefile, sizes, offsets):
+    queryfile = args[2]
+    fw = must_open(opts.outfile, "w")
+    for columns in iter_columns(queryfile, chunksize=opts.chunksize):
+        ctgs = np.array(columns[0])
+        if len(columns) == 2:
+            positions = np.array(columns[1], dtype=np.int64)
+            check_bounds(ctgs, positions - 1, positions,
+                         contig_lookup(sizes, ctgs))
+            depth = ar[contig_lookup(offsets, ctgs) + positions - 1]
+            for row in zip(columns[0], columns[1], depth):
+                print >> fw, "\t".join(str(x) for x in row)
+            continue
+
+        starts = np.array(columns[1], dtype=np.int64)
+        ends = np.array(columns[2], dtype=np.int64)
+        names = columns[3] if len(columns) > 3 else ["na"] * len(ctgs)
+        stats = query_intervals(ar, offsets, sizes, ctgs, starts, ends,
+                                cutoff=opts.cutoff)
+        for ctg, start, end, name, mean, mn, mx, frac in \
+                zip(columns[0], columns[1], columns[2], names, *stats):
+            print >> fw, "\t".join(str(x) for x in (ctg, start, end, name,
+                    "{0:.1f}".format(mean), mn, mx, "{0:.3f}".format(frac)))
+    fw.close()
+
+
+def iter_columns(coveragefile, chunksize=1000000):
+    """
+    Parse the coverage file in blocks of chunksize lines, yields the columns
+    of each block as lists of strings. Only the number of columns of the
+    first line is allowed.
+    """
     fp = open(coveragefile)
-    logging.debug("Parse file `{0}`".format(coveragefile))
-    for k, rows in groupby(fp, key=(lambda x: x.split()[0])):
-        rows = list(rows)
-        offset = offsets[k]
-        ctglen = len(rows)
+    ncols = None
+    while True:
+        lines = list(islice(fp, chunksize))
+        if not lines:
+            break
 
-        if ctglen < 100000:
-            sys.stdout.write(".")
-        else:
-            print k, offset
+        fields = "".join(lines).split()
+        ncols = ncols or len(lines[0].split())
+        assert len(fields) == ncols * len(lines), \
+            "Inconsistent number of columns in `{0}`".format(coveragefile)
+        yield [fields[i::ncols] for i in xrange(ncols)]
+    fp.close()
 
-        #assert ctglen == sizes[k]
-        for i, row in enumerate(rows):
-            ctgID, baseID, count = row.split()
-            oi = offset + i
-            newcount = ar[oi] + int(count)
-            if newcount > 255:
-                newcount = 255
 
-            ar[oi] = newcount
+def saturating_add(ar, idx, counts):
+    """
+    Add counts to ar[idx], capped at the max of the array dtype.
+    """
+    maxcount = np.iinfo(ar.dtype).max
+    newcounts = ar[idx].astype(np.int64) + counts
+    ar[idx] = np.minimum(newcounts, maxcount)
 
 
+def add_runs(ar, starts, ends, counts, window=1 << 22):
+    """
+    Add counts to the half-open runs [starts, ends) of ar, runs must be sorted
+    and non-overlapping as in a bedgraph. The runs are rendered into depth one
+    window at a time through a difference array, to keep the memory bounded.
+    """
+    i, n = 0, len(starts)
+    lo = 0
+    while i < n:
+        lo = max(lo, starts[i])
+        hi = min(lo + window, ends[-1])
+        j = np.searchsorted(starts, hi, side="left")
+        rs = np.clip(starts[i:j], lo, hi) - lo
+        re = np.clip(ends[i:j], lo, hi) - lo
+        diff = np.zeros(hi - lo + 1, dtype=np.int64)
+        np.add.at(diff, rs, counts[i:j])
+        np.add.at(diff, re, -counts[i:j])
+        saturating_add(ar, slice(lo, hi), np.cumsum(diff[:-1]))
+
+        i = np.searchsorted(ends, hi, side="right")
+        lo = hi
+
+
+def update_array(ar, coveragefile, sizes, offsets, chunksize=1000000):
+    """
+    Add the counts from genomeCoverageBed to ar. Per base output (-d) has
+    columns contig, position (1-based) and count, bedgraph output (-bg) has
+    contig, start, end (0-based, half-open) and count.
+    """
+    logging.debug("Parse file `{0}`".format(coveragefile))
+    nrows = 0
+    for columns in iter_columns(coveragefile, chunksize=chunksize):
+        ctgs = np.array(columns[0])
+        coords = [np.array(x, dtype=np.int64) for x in columns[1:-1]]
+        counts = np.array(columns[-1], dtype=np.int64)
+        bedgraph = len(coords) == 2
+
+        breaks = np.flatnonzero(np.r_[True, ctgs[1:] != ctgs[:-1]])
+        stops = np.r_[breaks[1:], len(ctgs)]
+        for a, b in zip(breaks, stops):
+            offset = offsets[ctgs[a]]
+            if bedgraph:
+                starts, ends = coords
+                add_runs(ar, offset + starts[a:b], offset + ends[a:b],
+                         counts[a:b])
+            else:
+                positions, = coords
+                saturating_add(ar, offset + positions[a:b] - 1, counts[a:b])
+
+        nrows += len(ctgs)
+        logging.debug("{0} rows parsed ({1})".format(nrows, ctgs[-1]))
+
+
+@memoized
 def get_offsets(fastafile):
     s = Sizes(fastafile)
     fastasize = s.totalsize
@@ -200,9 +461,13 @@ def count(args):
     %prog count t.coveragePerBase fastafile
 
     Serialize the genomeCoverage results. The coordinate system of the count array
-    will be based on the fastafile.
+    will be based on the fastafile. Both per base (genomeCoverageBed -d) and
+    bedgraph (genomeCoverageBed -bg) outputs are accepted.
     """
     p = OptionParser(count.__doc__)
+    set_dtype(p)
+    p.add_option("--chunksize", default=1000000, type="int",
+            help="Number of lines to parse at a time [default: %default]")
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
@@ -217,12 +482,17 @@ def count(args):
         return
 
     fastasize, sizes, offsets = get_offsets(fastafile)
-    logging.debug("Initialize array of uint8 with size {0}".format(fastasize))
-    ar = np.zeros(fastasize, dtype=np.uint8)
+    logging.debug("Initialize array of {0} with size {1}".\
+                    format(opts.dtype, fastasize))
+    # Fill a temporary file, so that an interrupted run leaves no partial array
+    tmpfile = countsfile + ".tmp"
+    ar = np.memmap(tmpfile, dtype=opts.dtype, mode="w+", shape=(fastasize,))
 
-    update_array(ar, coveragefile, sizes, offsets)
+    update_array(ar, coveragefile, sizes, offsets, chunksize=opts.chunksize)
 
-    ar.tofile(countsfile)
+    ar.flush()
+    del ar
+    os.rename(tmpfile, countsfile)
     logging.debug("Array written to `{0}`".format(countsfile))
 
 
@@ -28,7 +28,9 @@ see supplementary info for sea anemone genome paper, formula::
 Finally a blast.filtered file is created.
 """
 
+import os
 import sys
+import shutil
 import logging
 import os.path as op
 import itertools
@@ -37,11 +39,11 @@ from math import log10
 from collections import defaultdict
 
 from jcvi.formats.bed import Bed
-from jcvi.formats.blast import BlastLine
-from jcvi.utils.grouper import Grouper
+from jcvi.formats.blast import BlastLine, BlastTable, set_table
+from jcvi.utils.grouper import DisjointSet
 from jcvi.utils.cbook import gene_name
 from jcvi.algorithms.synteny import add_beds, check_beds
-from jcvi.apps.base import debug
+from jcvi.apps.base import debug, sh
 debug()
 
 
@@ -53,115 +55,396 @@ def main(blast_file, opts):
     filter_repeats = opts.filter_repeats
     cscore = opts.cscore
 
-    fp = file(blast_file)
-    total_lines = sum(1 for line in fp)
-    logging.debug("Load BLAST file `%s` (total %d lines)" % \
-            (blast_file, total_lines))
-    fp.seek(0)
-    blasts = sorted([BlastLine(line) for line in fp], \
-            key=lambda b: b.score, reverse=True)
+    if opts.table:
+        blasts = BlastList(read_blasttable(blast_file, qbed, sbed,
+                    qorder, sorder, is_self=is_self, ostrip=opts.strip_names))
+    else:
+        blasts = BlastStream(blast_file, qbed, sbed, qorder, sorder,
+                    is_self=is_self, ostrip=opts.strip_names)
+
+    try:
+        if not tandem_Nmax is None:
+            logging.debug("running the local dups filter " \
+                    "(tandem_Nmax=%d) .." % tandem_Nmax)
+
+            qtandems, standems = \
+                    blasts.tandem_groupers(tandem_Nmax=tandem_Nmax)
+
+            qdups_fh = open(op.splitext(qbed.filename)[0] + ".localdups",
+                    "w") if opts.tandems_only else None
+
+            if is_self:
+                for s in standems:
+                    qtandems.join(*s)
+                qdups_to_mother = write_localdups(qtandems, qbed, qdups_fh)
+                sdups_to_mother = qdups_to_mother
+            else:
+                qdups_to_mother = write_localdups(qtandems, qbed, qdups_fh)
+                sdups_fh = open(op.splitext(sbed.filename)[0] + \
+                        ".localdups", "w") if opts.tandems_only else None
+                sdups_to_mother = write_localdups(standems, sbed, sdups_fh)
+
+            if opts.tandems_only:
+                # write out new .bed after tandem removal
+                write_new_bed(qbed, qdups_to_mother)
+                if not is_self:
+                    write_new_bed(sbed, sdups_to_mother)
+
+                # just want to use this script as a tandem finder.
+                sys.exit()
+
+            before_filter = len(blasts)
+            blasts.filter_tandem(qdups_to_mother, sdups_to_mother)
+            logging.debug("after filter (%d->%d) .." % \
+                    (before_filter, len(blasts)))
+
+        if filter_repeats:
+            before_filter = len(blasts)
+            logging.debug("running the repeat filter")
+            blasts.filter_repeat()
+            logging.debug("after filter (%d->%d) .." % (before_filter,
+                len(blasts)))
+
+        if not cscore is None:
+            before_filter = len(blasts)
+            logging.debug("running the cscore filter (cscore>=%.2f) .." % \
+                    cscore)
+            blasts.filter_cscore(cscore=cscore)
+            logging.debug("after filter (%d->%d) .." % (before_filter,
+                len(blasts)))
+
+        blastfilteredfile = blast_file + ".filtered"
+        fw = open(blastfilteredfile, "w")
+        blasts.write(fw)
+        fw.close()
+    finally:
+        blasts.close()
+
+
+class BlastList (list):
+    """
+    In-memory list of BlastLines, sorted by score descending, which the
+    filters below are applied to in turn.
+    """
+    def tandem_groupers(self, tandem_Nmax=10):
+        qtandems = tandem_grouper(None, self, flip=True,
+                                  tandem_Nmax=tandem_Nmax)
+        standems = tandem_grouper(None, self, flip=False,
+                                  tandem_Nmax=tandem_Nmax)
+        return qtandems, standems
 
-    filtered_blasts = []
-    seen = set()
-    ostrip = opts.strip_names
-    nwarnings = 0
-    for b in blasts:
-        query, subject = b.query, b.subject
-        if ostrip:
-            query, subject = gene_name(query), gene_name(subject)
-        if query not in qorder:
-            if nwarnings < 100:
-                logging.warning("{0} not in {1}".format(query,
-                    qbed.filename))
-            elif nwarnings == 100:
-                logging.warning("too many warnings.. suppressed")
-            nwarnings += 1
-            continue
-        if subject not in sorder:
-            if nwarnings < 100:
-                logging.warning("{0} not in {1}".format(subject,
-                    sbed.filename))
-            elif nwarnings == 100:
-                logging.warning("too many warnings.. suppressed")
-            nwarnings += 1
-            continue
+    def filter_tandem(self, qdups_to_mother, sdups_to_mother):
+        self[:] = filter_tandem(self, qdups_to_mother, sdups_to_mother)
 
-        qi, q = qorder[query]
-        si, s = sorder[subject]
+    def filter_repeat(self):
+        self[:] = filter_repeat(self)
 
-        if is_self and qi > si:
-            # move all hits to same side when doing self-self BLAST
-            query, subject = subject, query
-            qi, si = si, qi
-            q, s = s, q
+    def filter_cscore(self, cscore=.5):
+        self[:] = filter_cscore(self, cscore=cscore)
 
-        key = query, subject
-        if key in seen:
-            continue
-        seen.add(key)
-        b.query, b.subject = key
+    def write(self, fw):
+        write_new_blast(self, fh=fw)
 
-        b.qi, b.si = qi, si
-        b.qseqid, b.sseqid = q.seqid, s.seqid
+    def close(self):
+        pass
 
-        filtered_blasts.append(b)
 
-    if not tandem_Nmax is None:
-        logging.debug("running the local dups filter (tandem_Nmax=%d) .." % \
-                tandem_Nmax)
+class BlastStream (object):
+    """
+    Bounded-memory version of BlastList. The BLAST file is streamed once to
+    pick the hits between genes in the bed files, then each filter streams
+    the hits from one temporary record file to the next. Records stay sorted
+    by score (descending) then by line number, same as the stable in-memory
+    sort. Genes are encoded as integer ids so that counts and best scores per
+    gene stay small; de-duplication of gene pairs goes through external
+    `sort` rather than a `seen` set.
+
+    Record columns: qid, sid, qi, si, lineno, followed by the BLAST line.
+    """
+    key_pair = "-k1,1n -k2,2n -k17,17gr -k5,5n"
+    key_score = "-k17,17gr -k5,5n"
+
+    def __init__(self, blast_file, qbed, sbed, qorder, sorder,
+                 is_self=False, ostrip=True):
+        from tempfile import mkdtemp
+
+        self.qbed, self.sbed = qbed, sbed
+        self.workdir = mkdtemp(prefix="blastfilter")
+        self.nfiles = 0
+        self.index = {}
+        self.names = []
+
+        try:
+            recordfile = self.tempfile()
+            fw = open(recordfile, "w")
+            nwarnings = nlines = 0
+            for lineno, row in enumerate(open(blast_file)):
+                nlines += 1
+                atoms = row.split("\t", 2)
+                query, subject = atoms[0], atoms[1]
+                if ostrip:
+                    query, subject = gene_name(query), gene_name(subject)
+                if query not in qorder:
+                    if nwarnings < 100:
+                        logging.warning("{0} not in {1}".format(query,
+                            qbed.filename))
+                    elif nwarnings == 100:
+                        logging.warning("too many warnings.. suppressed")
+                    nwarnings += 1
+                    continue
+                if subject not in sorder:
+                    if nwarnings < 100:
+                        logging.warning("{0} not in {1}".format(subject,
+                            sbed.filename))
+                    elif nwarnings == 100:
+                        logging.warning("too many warnings.. suppressed")
+                    nwarnings += 1
+                    continue
+
+                qi, q = qorder[query]
+                si, s = sorder[subject]
+
+                if is_self and qi > si:
+                    # move all hits to same side when doing self-self BLAST
+                    query, subject = subject, query
+                    qi, si = si, qi
+
+                qid, sid = self.encode(query), self.encode(subject)
+                print >> fw, "\t".join(str(x) for x in \
+                        (qid, sid, qi, si, lineno, row.rstrip("\r\n")))
+            fw.close()
+            logging.debug("Load BLAST file `%s` (total %d lines)" % \
+                    (blast_file, nlines))
+
+            self.recordfile = recordfile
+            self.dedup()
+        except:
+            self.close()
+            raise
+
+    def encode(self, name):
+        index = self.index
+        if name not in index:
+            index[name] = len(self.names)
+            self.names.append(name)
+        return index[name]
+
+    def tempfile(self):
+        self.nfiles += 1
+        return op.join(self.workdir, "records{0}".format(self.nfiles))
+
+    def sort(self, key):
+        sortedfile = self.tempfile()
+        retcode = sh("LC_ALL=C sort -t '\t' {0} {1} -o {2}".\
+                format(key, self.recordfile, sortedfile))
+        assert retcode == 0, "sort exited with {0}".format(retcode)
+        return sortedfile
+
+    def replace(self, recordfile):
+        os.remove(self.recordfile)
+        self.recordfile = recordfile
+
+    def records(self):
+        """
+        Yields record lines, and the record columns needed by the filters.
+        """
+        for row in open(self.recordfile):
+            atoms = row.split("\t", 17)
+            yield row, int(atoms[0]), int(atoms[1]), int(atoms[2]), \
+                    int(atoms[3]), float(atoms[15]), float(atoms[16])
+
+    def filter(self, keep):
+        filteredfile = self.tempfile()
+        fw = open(filteredfile, "w")
+        for record in self.records():
+            if keep(*record[1:]):
+                fw.write(record[0])
+        fw.close()
+        self.replace(filteredfile)
+
+    def dedup(self):
+        """
+        Keep the first record of each (qid, sid), in score order.
+        """
+        pairfile = self.sort(self.key_pair)
+        uniqfile = self.tempfile()
+        fw = open(uniqfile, "w")
+        last = None
+        for row in open(pairfile):
+            pair = row.split("\t", 2)[:2]
+            if pair == last:
+                continue
+            last = pair
+            fw.write(row)
+        fw.close()
+        os.remove(pairfile)
+        self.replace(uniqfile)
+        self.replace(self.sort(self.key_score))
+
+    def __len__(self):
+        return sum(1 for row in open(self.recordfile))
+
+    def tandem_groupers(self, tandem_Nmax=10):
+        """
+        Same as tandem_grouper() on both sides, with the (name, seqid, rank)
+        keys sorted externally and scanned for neighbors.
+        """
+        qkeysfile, skeysfile = self.tempfile(), self.tempfile()
+        qfw, sfw = open(qkeysfile, "w"), open(skeysfile, "w")
+        qbed, sbed = self.qbed, self.sbed
+        for row, qid, sid, qi, si, evalue, score in self.records():
+            if evalue < 1e-10:
+                print >> qfw, "\t".join(str(x) for x in \
+                        (sid, qbed[qi].seqid, qi))
+                print >> sfw, "\t".join(str(x) for x in \
+                        (qid, sbed[si].seqid, si))
+        qfw.close()
+        sfw.close()
+
+        tandems = []
+        for keysfile, bed in ((qkeysfile, qbed), (skeysfile, sbed)):
+            cmd = "LC_ALL=C sort -t '\t' -k1,1n -k2,2 -k3,3n {0} -o {0}".\
+                    format(keysfile)
+            retcode = sh(cmd)
+            assert retcode == 0, "sort exited with {0}".format(retcode)
+            g = DisjointSet(len(bed))
+            for name, hits in itertools.groupby(open(keysfile),
+                                        key=lambda x: x.split("\t", 1)[0]):
+                hits = [x.split() for x in hits]
+                for a, b in zip(hits[:-1], hits[1:]):
+                    # on the same chr and rank difference no larger than
+                    # tandem_Nmax
+                    ai, bi = int(a[2]), int(b[2])
+                    if bi - ai <= tandem_Nmax and b[1] == a[1]:
+                        g.join(ai, bi)
+            os.remove(keysfile)
+            tandems.append(g)
+
+        return tandems
+
+    def filter_tandem(self, qdups_to_mother, sdups_to_mother):
+        encode = self.encode
+        qmother = dict((encode(a), encode(b)) \
+                        for a, b in qdups_to_mother.items())
+        smother = dict((encode(a), encode(b)) \
+                        for a, b in sdups_to_mother.items())
+
+        motherfile = self.tempfile()
+        fw = open(motherfile, "w")
+        for record in self.records():
+            row, qid, sid = record[:3]
+            qid, sid = qmother.get(qid, qid), smother.get(sid, sid)
+            if qid == sid:
+                continue
+            atoms = row.split("\t", 2)
+            atoms[:2] = str(qid), str(sid)
+            fw.write("\t".join(atoms))
+        fw.close()
+
+        # records stay in score order, same as the stable re-sort on score
+        self.replace(motherfile)
+        self.dedup()
+
+    def filter_repeat(self, evalue_cutoff=.05):
+        counts = defaultdict(int)
+        nblasts = 0
+        for row, qid, sid, qi, si, evalue, score in self.records():
+            counts[qid] += 1
+            counts[sid] += 1
+            nblasts += 1
+        if not nblasts:
+            return
+
+        expected_count = nblasts * 1. / len(counts)
+        logging.debug("(expected_count=%d) .." % expected_count)
+
+        def keep(qid, sid, qi, si, evalue, score):
+            count = counts[qid] + counts[sid]
+            return evalue ** (expected_count / count) < evalue_cutoff
+
+        self.filter(keep)
+
+    def filter_cscore(self, cscore=.5):
+        best_score = defaultdict(float)
+        for row, qid, sid, qi, si, evalue, score in self.records():
+            if score > best_score[qid]:
+                best_score[qid] = score
+            if score > best_score[sid]:
+                best_score[sid] = score
+
+        def keep(qid, sid, qi, si, evalue, score):
+            return score / max(best_score[qid], best_score[sid]) > cscore
+
+        self.filter(keep)
+
+    def write(self, fw):
+        names = self.names
+        for record in self.records():
+            row, qid, sid = record[:3]
+            b = BlastLine(row.split("\t", 5)[-1])
+            b.query, b.subject = names[qid], names[sid]
+            print >> fw, b
+
+    def close(self):
+        shutil.rmtree(self.workdir)
+
+
+def read_blasttable(blast_file, qbed, sbed, qorder, sorder,
+                    is_self=False, ostrip=True):
+    """
+    Same as read_blastlines(), but through the columnar BlastTable backend.
+    Bed lookups are done once per distinct name, the score ordering and the
+    de-duplication of gene pairs are vectorized. Only the surviving hits are
+    turned into BlastLines.
+    """
+    import numpy as np
+
+    blast = BlastTable(blast_file, cache=True)
+    names = [gene_name(x) for x in blast.names] if ostrip else blast.names
+    qranks = np.array([qorder[x][0] if x in qorder else -1 for x in names],
+                      dtype="i8")
+    sranks = np.array([sorder[x][0] if x in sorder else -1 for x in names],
+                      dtype="i8")
+
+    data = blast.data
+    idx = np.argsort(-data["score"], kind="mergesort")
+    queries, subjects = data["query"][idx], data["subject"][idx]
+    qi, si = qranks[queries], sranks[subjects]
+
+    missing = np.flatnonzero((qi < 0) | (si < 0))
+    for nwarnings, j in enumerate(missing[:101]):
+        if nwarnings == 100:
+            logging.warning("too many warnings.. suppressed")
+            break
+        if qi[j] < 0:
+            logging.warning("{0} not in {1}".format(names[queries[j]],
+                qbed.filename))
+        else:
+            logging.warning("{0} not in {1}".format(names[subjects[j]],
+                sbed.filename))
 
-        qtandems = tandem_grouper(qbed, filtered_blasts,
-                flip=True, tandem_Nmax=tandem_Nmax)
-        standems = tandem_grouper(sbed, filtered_blasts,
-                flip=False, tandem_Nmax=tandem_Nmax)
+    valid = (qi >= 0) & (si >= 0)
+    idx, qi, si = idx[valid], qi[valid], si[valid]
+    if is_self:
+        # move all hits to same side when doing self-self BLAST
+        flip = qi > si
+        qi, si = np.where(flip, si, qi), np.where(flip, qi, si)
 
-        qdups_fh = open(op.splitext(qbed_file)[0] + ".localdups", "w") \
-                if opts.tandems_only else None
+    pairs = qi * len(sbed) + si
+    first = np.sort(np.unique(pairs, return_index=True)[1])
 
-        if is_self:
-            for s in standems:
-                qtandems.join(*s)
-            qdups_to_mother = write_localdups(qtandems, qbed, qdups_fh)
-            sdups_to_mother = qdups_to_mother
-        else:
-            qdups_to_mother = write_localdups(qtandems, qbed, qdups_fh)
-            sdups_fh = open(op.splitext(sbed_file)[0] + ".localdups", "w") \
-                    if opts.tandems_only else None
-            sdups_to_mother = write_localdups(standems, sbed, sdups_fh)
-
-        if opts.tandems_only:
-            # write out new .bed after tandem removal
-            write_new_bed(qbed, qdups_to_mother)
-            if not is_self:
-                write_new_bed(sbed, sdups_to_mother)
-
-            # just want to use this script as a tandem finder.
-            sys.exit()
-
-        before_filter = len(filtered_blasts)
-        filtered_blasts = list(filter_tandem(filtered_blasts, \
-                qdups_to_mother, sdups_to_mother))
-        logging.debug("after filter (%d->%d) .." % \
-                (before_filter, len(filtered_blasts)))
-
-    if filter_repeats:
-        before_filter = len(filtered_blasts)
-        logging.debug("running the repeat filter")
-        filtered_blasts = list(filter_repeat(filtered_blasts))
-        logging.debug("after filter (%d->%d) .." % (before_filter,
-            len(filtered_blasts)))
-
-    if not cscore is None:
-        before_filter = len(filtered_blasts)
-        logging.debug("running the cscore filter (cscore>=%.2f) .." % cscore)
-        filtered_blasts = list(filter_cscore(filtered_blasts, cscore=cscore))
-        logging.debug("after filter (%d->%d) .." % (before_filter,
-            len(filtered_blasts)))
-
-    blastfilteredfile = blast_file + ".filtered"
-    fw = open(blastfilteredfile, "w")
-    write_new_blast(filtered_blasts, fh=fw)
-    fw.close()
+    filtered_blasts = []
+    for i, a, b in zip(idx[first], qi[first], si[first]):
+        bl = blast.blastline(i)
+        q, s = qbed[a], sbed[b]
+        bl.query, bl.subject = q.accn, s.accn
+        bl.qi, bl.si = int(a), int(b)
+        bl.qseqid, bl.sseqid = q.seqid, s.seqid
+        filtered_blasts.append(bl)
+
+    logging.debug("Kept {0} of {1} BLAST hits.".\
+            format(len(filtered_blasts), len(blast)))
+    return filtered_blasts
 
 
 def write_localdups(tandems, bed, dups_fh=None):
@@ -294,7 +577,7 @@ def tandem_grouper(bed, blast_list, tandem_Nmax=10, flip=True):
 
     simple_blast.sort()
 
-    standems = Grouper()
+    standems = DisjointSet()
     for name, hits in itertools.groupby(simple_blast, key=lambda x: x[0]):
         # these are already sorted.
         hits = [x[1] for x in hits]
@@ -319,6 +602,7 @@ if __name__ == "__main__":
     p.add_option("--tandems_only", dest="tandems_only",
             action="store_true", default=False,
             help="only calculate tandems, write .localdup file and exit.")
+    set_table(p)
 
     filter_group = optparse.OptionGroup(p, "BLAST filters")
     filter_group.add_option("--tandem_Nmax", dest="tandem_Nmax",
@@ -1,5 +1,6 @@
 """
-Codes to submit multiple jobs to JCVI grid engine
+Codes to submit multiple jobs to JCVI grid engine, or to a bounded pool of
+processes on the local computer (set JCVI_GRID=local, JCVI_GRID_CPUS=N).
 """
 
 import os
@@ -7,15 +8,17 @@ import os.path as op
 import shutil
 import sys
 import re
+import time
 import logging
+import threading
 
 from glob import glob
-from itertools import izip_longest
+from itertools import count, izip_longest
 from subprocess import Popen, PIPE
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Pool, Process, cpu_count
 
-from jcvi.formats.base import FileSplitter
+from jcvi.formats.base import FileSplitter, restore_order
 from jcvi.apps.base import ActionDispatcher, sh, popen, mkdir, backup, debug
 debug()
 
@@ -24,25 +27,189 @@ sge = "sge"
 PCODE = "04048"  # Project code, JCVI specific
 commitfile = op.join(sge, "COMMIT")
 statusfile = op.join(sge, "STATUS")
+reportfile = op.join(sge, "REPORT")
+
+backends = ("sge", "local")
+GRID_BACKEND = os.environ.get("JCVI_GRID", "sge")
+GRID_CPUS = int(os.environ.get("JCVI_GRID_CPUS", 0)) or cpu_count()
 
 
 class Jobs (list):
     """
     Runs multiple funcion calls on the SAME computer, using multiprocessing.
+    At most `cpus` processes are running at any time.
     """
-    def __init__(self, target, args):
+    def __init__(self, target, args, cpus=None):
 
+        self.cpus = cpus or cpu_count()
         for x in args:
             self.append(Process(target=target, args=x))
 
     def run(self):
+        running = []
         for pi in self:
+            while len(running) >= self.cpus:
+                running[0].join(.1)
+                running = [x for x in running if x.is_alive()]
             pi.start()
+            running.append(pi)
 
         for pi in self:
             pi.join()
 
 
+def spool_worker(task):
+    """
+    Runs the target in a pool worker, with out_fh set to a private buffered
+    spool file instead of a handle shared with the other workers.
+    """
+    target, spoolfile, args = task
+    fw = open(spoolfile, "w", 1 << 20)
+    target(*args, out_fh=fw)
+    fw.close()
+    return spoolfile
+
+
+def spool_jobs(target, args, out_fh, cpus=None, spooldir="."):
+    """
+    Runs target(*arg, out_fh=spool) for each arg on a pool of at most `cpus`
+    processes. The workers write without locking, and this single writer
+    appends each spool to out_fh as soon as it completes, in the order of args.
+    """
+    from tempfile import mkdtemp
+
+    cpus = min(cpus or cpu_count(), len(args))
+    workdir = mkdtemp(prefix="spool.", dir=spooldir)
+    tasks = [(target, op.join(workdir, "{0:05d}".format(i)), x) \
+                for i, x in enumerate(args)]
+
+    pool = Pool(cpus)
+    try:
+        for spoolfile in pool.imap(spool_worker, tasks):
+            fp = open(spoolfile)
+            shutil.copyfileobj(fp, out_fh, 1 << 20)
+            fp.close()
+            os.remove(spoolfile)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(workdir)
+
+    out_fh.flush()
+
+
+class LocalPool (object):
+    """
+    Runs GridProcess on the local computer, with a queue drained by at most
+    `cpus` worker threads. Each job is retried up to `retries` times, and its
+    exit code, attempts, wall time and peak RSS (KB) are recorded on the job.
+    """
+    def __init__(self, cpus=GRID_CPUS, retries=0):
+        import Queue
+
+        self.cpus = cpus
+        self.retries = retries
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.nworkers = 0
+        self.ids = count(1)
+        self.backedup = set()
+
+    def spawn(self, n):
+        for i in xrange(n):
+            t = threading.Thread(target=self.work, name="Local Worker")
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        self.nworkers += n
+
+    def resize(self, cpus):
+        """
+        Change the number of workers; extra workers quit once they reach the
+        end of the jobs already queued.
+        """
+        self.cpus = cpus
+        if not self.nworkers:  # workers are started at the first submit
+            return
+
+        if cpus > self.nworkers:
+            self.spawn(cpus - self.nworkers)
+        else:
+            for i in xrange(self.nworkers - cpus):
+                self.queue.put(None)
+            self.nworkers = cpus
+
+    def submit(self, p, path=None):
+        p.jobid = "{0}.{1}".format(os.getpid(), self.ids.next())
+        # Jobs may share the same outfile, back it up only once
+        for filename in (p.outfile, p.errfile):
+            if not filename:
+                continue
+            filename = op.join(path or os.getcwd(), filename)
+            if filename not in self.backedup:
+                backup(filename)
+                self.backedup.add(filename)
+
+        if not self.nworkers:
+            self.spawn(self.cpus)
+
+        self.queue.put((p, path))
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            p, path = job
+            try:
+                p.run_local(path=path, retries=self.retries)
+            except Exception, e:
+                logging.error("[{0}] {1}".format(p.jobid, e))
+                p.exitcode = -1
+            self.queue.task_done()
+
+    def wait(self):
+        """
+        Block until all the submitted jobs are done.
+        """
+        self.queue.join()
+
+    def close(self):
+        for i in xrange(self.nworkers):
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+        self.nworkers = 0
+
+
+_pool = None
+append_lock = threading.Lock()
+
+
+def get_pool(cpus=None, retries=None):
+    """
+    Returns the LocalPool shared by this process, which is drained at exit.
+    """
+    import atexit
+
+    global _pool
+    if _pool is None:
+        _pool = LocalPool(cpus=cpus or GRID_CPUS, retries=retries or 0)
+        atexit.register(_pool.close)
+    else:
+        if cpus and cpus != _pool.cpus:
+            _pool.resize(cpus)
+        if retries is not None:
+            _pool.retries = retries
+
+    return _pool
+
+
 class CmdReplacer (object):
     """
     Creates parallelized version of cmd, but glob the input files (with the
@@ -74,7 +241,7 @@ class CmdSplitter (object):
     This creates parallelized version of cmd, and substituting infile with
     infile_00 and outfile with outfile_00, etc.
     """
-    def __init__(self, cmd, infile, outfile, outputdir=sge, N=4):
+    def __init__(self, cmd, infile, outfile, outputdir=sge, N=4, mode="cycle"):
 
         infilepat = re.compile(r"\b%s\b" % infile)
         outfilepat = re.compile(r"\b%s\b" % outfile)
@@ -83,8 +250,9 @@ class CmdSplitter (object):
         split_outputs = FileSplitter.get_names(outfile, N)
 
         # inputs need to be splitted
-        fs = FileSplitter(infile, outputdir)
+        fs = FileSplitter(infile, outputdir, mode=mode)
         fs.split(N)
+        self.manifest = fs.manifest if mode == "balanced" else None
 
         self.cmds = []
         for sinput, soutput in zip(split_inputs, split_outputs):
@@ -112,6 +280,10 @@ class GridProcess (object):
         self.infile = infile
         self.outfile = outfile
         self.errfile = errfile
+        self.exitcode = None
+        self.attempts = 0
+        self.walltime = 0
+        self.maxrss = 0
 
     def __str__(self):
         return "\t".join((x for x in \
@@ -125,11 +297,70 @@ class GridProcess (object):
     def is_defunct(self):
         return self.cmd[0] == '#'
 
-    def start(self, path=sge):
+    @property
+    def cmdgroup(self):
+        return op.basename(self.cmd.lstrip("#").split()[0])
+
+    @property
+    def report(self):
+        return "\t".join(str(x) for x in (self.jobid, self.exitcode,
+                self.attempts, "{0:.1f}".format(self.walltime), self.maxrss,
+                self.cmd))
+
+    def run_local(self, path=None, retries=0):
+        """
+        Run the command in a subprocess and wait on it, with stdout and stderr
+        named and appended as the grid engine would. The stdout of each attempt
+        is kept aside, and only appended to the outfile if the attempt
+        succeeds; stderr of all the attempts is appended.
+        """
+        from tempfile import TemporaryFile
+
+        cwd = path or os.getcwd()
+        outfile = self.outfile or "{0}.o{1}".format(self.cmdgroup, self.jobid)
+        errfile = self.errfile or "{0}.e{1}".format(self.cmdgroup, self.jobid)
+        outfile, errfile = op.join(cwd, outfile), op.join(cwd, errfile)
+
+        while self.attempts <= retries:
+            self.attempts += 1
+            fi = open(op.join(cwd, self.infile)) if self.infile else None
+            fo = TemporaryFile(dir=op.dirname(outfile))
+            fe = open(errfile, "a")
+            start = time.time()
+            proc = Popen(self.cmd, shell=True, cwd=cwd,
+                         stdin=fi, stdout=fo, stderr=fe)
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            self.walltime = time.time() - start
+            self.maxrss = rusage.ru_maxrss
+            self.exitcode = proc.returncode = os.WEXITSTATUS(status) \
+                    if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if self.exitcode == 0:
+                fo.seek(0)
+                with append_lock:  # jobs may share the same outfile
+                    fw = open(outfile, "a")
+                    shutil.copyfileobj(fo, fw)
+                    fw.close()
+            for fh in (fi, fo, fe):
+                if fh:
+                    fh.close()
+
+            logging.debug("[{0}] {1} (exit={2}, attempt={3}, time={4:.1f}s, "\
+                          "rss={5}K)".format(self.jobid, self.cmd, self.exitcode,
+                          self.attempts, self.walltime, self.maxrss))
+            if self.exitcode == 0:
+                break
+
+        return self.exitcode
+
+    def start(self, path=sge, backend=None):
 
         if self.is_defunct:
             return
 
+        if (backend or GRID_BACKEND) == "local":
+            get_pool().submit(self, path=path)
+            return
+
         cwd = os.getcwd()
         if path:
             os.chdir(path)
@@ -181,7 +412,7 @@ class Grid (list):
     def __init__(self, cmds=None, outfiles=[]):
 
         mkdir(sge)
-        if not outfiles:
+        if cmds and not outfiles:
             outfiles = [None] * len(cmds)
 
         if cmds:
@@ -199,7 +430,7 @@ class Grid (list):
 
         assert sum(1 for p in self if not p.is_defunct), \
                 "job list need to be non-empty"
-        self.cmdgroup = self[0].cmd.split()[0]
+        self.cmdgroup = self[0].cmdgroup
 
     def get_job(self, jobid):
         for p in self:
@@ -209,12 +440,16 @@ class Grid (list):
         logging.error("job %s not found in STATUS or is a defunct job" % jobid)
         sys.exit(1)
 
-    def run(self):
-
-        cwd = os.getcwd()
+    def run(self, backend=None):
 
         for pi in self:
-            pi.start()
+            pi.start(backend=backend)
+
+        if (backend or GRID_BACKEND) == "local":
+            get_pool().wait()
+            return self.writereport()
+
+        return 0
 
     def readcommit(self):
 
@@ -263,6 +498,60 @@ class Grid (list):
             print >>fw, p
         fw.close()
 
+    def writereport(self):
+        return writereport(self)
+
+    @classmethod
+    def readreport(cls):
+        """
+        Returns the last recorded exit code of each job.
+        """
+        exitcodes = {}
+        if not op.exists(reportfile):
+            return exitcodes
+
+        fp = open(reportfile)
+        for row in fp:
+            jobid, exitcode = row.split("\t", 2)[:2]
+            exitcodes[jobid] = int(exitcode)
+        fp.close()
+
+        return exitcodes
+
+
+def writereport(procs):
+    """
+    Append exit codes, attempts, wall time and peak RSS of the local jobs.
+    Returns the number of failed jobs.
+    """
+    mkdir(sge)
+    fw = open(reportfile, "a")
+    failed = 0
+    for p in procs:
+        if p.is_defunct or p.exitcode is None:
+            continue
+        print >>fw, p.report
+        failed += (p.exitcode != 0)
+    fw.close()
+
+    if failed:
+        logging.error("{0} jobs failed, see `{1}`".format(failed, reportfile))
+
+    return failed
+
+
+def set_backend(p):
+    """
+    Add options to choose between grid engine and local process pool
+    """
+    p.add_option("--backend", default=GRID_BACKEND, choices=backends,
+                 help="Run jobs on, one of {0} [default: %default]".\
+                      format("|".join(backends)))
+    p.add_option("--cpus", default=GRID_CPUS, type="int",
+                 help="Number of local workers [default: %default]")
+    p.add_option("--retries", default=0, type="int",
+                 help="Retry failed local jobs [default: %default]")
+
 
 def main():
 
@@ -306,6 +595,7 @@ def run(args):
                       format("|".join(queue_choices)))
     p.add_option("-t", dest="threaded", type="int",
                  help="Append '-pe threaded N' [default: %default]")
+    set_backend(p)
     opts, args = p.parse_args(args)
 
     if len(args) == 0:
@@ -323,6 +613,7 @@ def run(args):
 
     assert args, "Command empty"
     cmd = " ".join(args)
+    procs = []
 
     for i, filename in enumerate(filenames):
         filename = filename.strip()
@@ -348,7 +639,15 @@ def run(args):
 
         p = GridProcess(ncmd, outfile=outfile,
                         queue=opts.queue, threaded=opts.threaded)
-        p.start(path=None)  # current folder
+        if opts.backend == "local":
+            get_pool(cpus=opts.cpus, retries=opts.retries)
+        p.start(path=None, backend=opts.backend)  # current folder
+        procs.append(p)
+
+    if opts.backend == "local":
+        get_pool().wait()
+        if writereport(procs):
+            sys.exit(1)
 
 
 def commit(args):
@@ -365,6 +664,9 @@ def commit(args):
     p.add_option("-o", dest="outfile", help="outfile")
     p.add_option("-n", dest="N", type="int", default=4,
             help="number of hosts to run on (1 < N < 100)")
+    p.add_option("--balanced", default=False, action="store_true",
+            help="split infile balanced by record length, use `merge "\
+                 "--manifest` to restore the order [default: %default]")
 
     opts, args = p.parse_args(args)
     try:
@@ -386,7 +688,11 @@ def commit(args):
     if "*" in opts.infile:
         cs = CmdReplacer(cmd, infile, outfile)
     else:
-        cs = CmdSplitter(cmd, infile, outfile, N=N)
+        mode = "balanced" if opts.balanced else "cycle"
+        cs = CmdSplitter(cmd, infile, outfile, N=N, mode=mode)
+        if cs.manifest:
+            logging.debug("Use `merge output --manifest={0}` to restore the "\
+                          "input order.".format(cs.manifest))
 
     g = Grid(cs.cmds, outfiles=cs.outfiles)
     g.writecommit()
@@ -396,17 +702,27 @@ def push(args):
     """
     %prog push
 
-    send the jobs to sun grid engine. the commands are from sge/COMMIT.
+    send the jobs to sun grid engine. the commands are from sge/COMMIT. With
+    --backend=local, run them on a pool of local processes, and wait for them
+    to finish. Exit codes, wall time and RSS are appended to sge/REPORT.
     """
     p = OptionParser(push.__doc__)
+    set_backend(p)
+    opts, args = p.parse_args(args)
+
+    if opts.backend == "local":
+        get_pool(cpus=opts.cpus, retries=opts.retries)
 
     g = Grid()
-    g.run()
+    failed = g.run(backend=opts.backend)
     g.writestatus()
 
     # remove COMMIT file
     os.remove(commitfile)
 
+    if failed:
+        sys.exit(1)
+
 
 def rerun(args):
     """
@@ -416,6 +732,7 @@ def rerun(args):
 
     p.add_option("-j", dest="jobid",
             help="rerun job with id (once resubmitted, it will get a new id)")
+    set_backend(p)
 
     opts, args = p.parse_args(args)
 
@@ -427,12 +744,19 @@ def rerun(args):
     p = g.get_job(opts.jobid)
 
     newp = GridProcess(p.cmd, outfile=p.outfile)
-    newp.start()  # start and acquire a job id
+    if opts.backend == "local":
+        get_pool(cpus=opts.cpus, retries=opts.retries)
+    newp.start(backend=opts.backend)  # start and acquire a job id
 
     p.make_defunct()
     g.append(newp)
     g.writestatus()
 
+    if opts.backend == "local":
+        get_pool().wait()
+        if g.writereport():
+            sys.exit(1)
+
 
 def filemerger(split_outputs, outfiles, dir=sge):
 
@@ -452,8 +776,13 @@ def merge(args):
     - output, concatenate all the files that are successful runs in OUTPUT
     - stdout, concatenate all prog.o*
     - stderr, concatenate all prog.e*
+
+    With --manifest, the merged rows are put back in the order of the input
+    records before splitting, by the record name in the first column.
     """
     p = OptionParser(merge.__doc__)
+    p.add_option("--manifest",
+            help="manifest from splitting the input, e.g. sge/query.manifest")
 
     opts, args = p.parse_args(args)
     try:
@@ -464,15 +793,21 @@ def merge(args):
         sys.exit(p.print_help())
 
     assert op.exists(statusfile), "STATUS file not found, cannot merge"
+    manifest = op.abspath(opts.manifest) if opts.manifest else None
 
     g = Grid()
     cmdgroup = g.cmdgroup  # the actual command that was run
+    exitcodes = Grid.readreport()
     stdoutlist = []
     stderrlist = []
     outfiles = []
     for p in g:
         if p.is_defunct:
             continue
+        if exitcodes.get(p.jobid, 0) != 0:
+            logging.error("job {0} exited with {1}, skipped".\
+                          format(p.jobid, exitcodes[p.jobid]))
+            continue
         stdoutlist.append("%s.o%s" % (cmdgroup, p.jobid))
         stderrlist.append("%s.e%s" % (cmdgroup, p.jobid))
         outfiles.append(p.outfile)
@@ -480,9 +815,15 @@ def merge(args):
     if filetype == "output":
         filemerger(stdoutlist, outfiles)
     elif filetype == "stdout":
-        filemerger(stdoutlist, ["%s.stdout" % cmdgroup])
+        outfiles = ["%s.stdout" % cmdgroup]
+        filemerger(stdoutlist, outfiles)
     elif filetype == "stderr":
-        filemerger(stderrlist, ["%s.stderr" % cmdgroup])
+        outfiles = ["%s.stderr" % cmdgroup]
+        filemerger(stderrlist, outfiles)
+
+    if manifest:
+        for outfile in set(outfiles):
+            restore_order(outfile, manifest)
 
 
 def clean(args):
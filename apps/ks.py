@@ -9,10 +9,12 @@ import sys
 import os
 import os.path as op
 import csv
+import shutil
 import logging
 
 from math import log, sqrt, pi, exp
-from itertools import product, combinations
+from itertools import product, combinations, imap, islice, izip
+from tempfile import mkdtemp
 from collections import namedtuple
 from optparse import OptionParser
 from subprocess import Popen
@@ -23,8 +25,9 @@ from Bio import AlignIO
 from Bio.Align.Applications import ClustalwCommandline
 
 from jcvi.formats.base import must_open
+from jcvi.utils.cbook import memoized
 from jcvi.apps.command import getpath, partial
-from jcvi.apps.base import ActionDispatcher, debug, mkdir, set_outfile, sh
+from jcvi.apps.base import ActionDispatcher, debug, set_outfile
 debug()
 
 
@@ -35,8 +38,8 @@ PAML_BIN = partial(getpath, name="PAML")
 
 class AbstractCommandline:
 
-    def run(self):
-        r = Popen(str(self), shell=True)
+    def run(self, cwd=None):
+        r = Popen(str(self), shell=True, cwd=cwd)
         return r.communicate()
 
 
@@ -74,6 +77,7 @@ def main():
         ('fromgroups', 'flatten the gene families into pairs'),
         ('prepare', 'prepare pairs of sequences'),
         ('calc', 'calculate Ks between pairs of sequences'),
+        ('ngcheck', 'check calc --method ng against yn00 on reference pairs'),
         ('report', 'generate a distribution of Ks values'),
         ('gc3', 'filter the Ks results to remove high GC3 genes'),
             )
@@ -232,8 +236,25 @@ def calc(args):
         3. Convert the output to Fasta format.
         4. Use this alignment info to align gene sequences using PAL2NAL
         5. Run PAML yn00 to calculate synonymous mutation rates.
+
+    The pairs are sent to --cpus workers in chunks, each chunk runs in its own
+    scratch directory. If the outfile exists, the pairs already in it are
+    skipped, so an interrupted run can be resumed. Pairs that failed are
+    listed in `outfile.failed` and skipped as well, unless --retry_failed.
     """
+    from multiprocessing import Pool
+
     p = OptionParser(calc.__doc__)
+    p.add_option("--cpus", default=1, type="int",
+            help="Number of worker processes [default: %default]")
+    p.add_option("--method", default="yn00", choices=("yn00", "ng"),
+            help="Estimate rates with PAML yn00, or in-process Nei-Gojobori " \
+                 "which writes nan in the yn columns [default: %default]")
+    p.add_option("--chunksize", default=20, type="int",
+            help="Number of pairs per worker task [default: %default]")
+    p.add_option("--retry_failed", default=False, action="store_true",
+            help="Resume with the pairs that failed in earlier runs " \
+                 "[default: %default]")
     set_outfile(p)
 
     opts, args = p.parse_args(args)
@@ -246,33 +267,147 @@ def calc(args):
         print >>sys.stderr, "Incorrect arguments"
         sys.exit(not p.print_help())
 
-    output_h = must_open(opts.outfile, "w")
-    output_h.write("name,dS-yn,dN-yn,dS-ng,dN-ng\n")
-    work_dir = op.join(os.getcwd(), "syn_analysis")
-    mkdir(work_dir)
+    outfile = opts.outfile
+    done = read_done_pairs(outfile)
+    if done:
+        logging.debug("Resume `{0}`, skip {1} pairs already done.".\
+                        format(outfile, len(done)))
+        output_h = must_open(outfile, "a")
+    else:
+        output_h = must_open(outfile, "w")
+        output_h.write("name,dS-yn,dN-yn,dS-ng,dN-ng\n")
+
+    failed_h = None
+    if outfile not in ("stdout", "-"):
+        failedfile = outfile + ".failed"
+        if opts.retry_failed:
+            failed_h = open(failedfile, "w")
+        else:
+            failed = read_failed_pairs(failedfile)
+            if failed:
+                logging.debug("Skip {0} pairs that failed before, use " \
+                        "--retry_failed to rerun them.".format(len(failed)))
+            done |= failed
+            failed_h = open(failedfile, "a")
 
     if not protein_file:
         protein_file = translate_dna(dna_file)
 
+    work_dir = mkdtemp(prefix="syn_analysis.", dir=os.getcwd())
     prot_iterator = SeqIO.parse(open(protein_file), "fasta")
     dna_iterator = SeqIO.parse(open(dna_file), "fasta")
-    for p_rec_1, p_rec_2, n_rec_1, n_rec_2 in \
-            zip(prot_iterator, prot_iterator, dna_iterator, dna_iterator):
+    pairs = (x for x in izip(prot_iterator, prot_iterator,
+                             dna_iterator, dna_iterator) \
+                if pair_name(*x[:2]) not in done)
+    tasks = ((chunk, work_dir, opts.method) \
+                for chunk in iter_chunks(pairs, opts.chunksize))
+
+    pool = Pool(opts.cpus) if opts.cpus > 1 else None
+    npairs = nfailed = 0
+    try:
+        results = pool.imap_unordered(calc_chunk, tasks) if pool \
+                  else imap(calc_chunk, tasks)
+        for rows, failed in results:
+            for row in rows:
+                output_h.write("%s\n" % (",".join(str(x) for x in row)))
+            output_h.flush()
+            if failed_h:
+                for name in failed:
+                    print >> failed_h, name
+                failed_h.flush()
+            npairs += len(rows)
+            nfailed += len(failed)
+
+        if pool:
+            pool.close()
+            pool.join()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        # Clean-up
+        shutil.rmtree(work_dir)
+        if failed_h:
+            failed_h.close()
+
+    logging.debug("A total of {0} pairs calculated, {1} failed.".\
+                    format(npairs, nfailed))
+
+
+def pair_name(p_rec_1, p_rec_2):
+    return "%s;%s" % (p_rec_1.name, p_rec_2.name)
+
+
+def read_done_pairs(ks_file):
+    """
+    Names of the pairs already in ks_file, to resume calc.
+    """
+    if ks_file in ("stdout", "-") or not op.exists(ks_file):
+        return set()
+
+    reader = csv.reader(open(ks_file, "rb"))
+    return set(row[0] for row in islice(reader, 1, None) if row)
+
+
+def read_failed_pairs(failedfile):
+    """
+    Names of the pairs that failed in earlier runs of calc.
+    """
+    if not op.exists(failedfile):
+        return set()
 
-        print >>sys.stderr, "--------", p_rec_1.name, p_rec_2.name
-        align_fasta = clustal_align_protein(p_rec_1, p_rec_2, work_dir)
-        mrtrans_fasta = run_mrtrans(align_fasta, n_rec_1, n_rec_2, work_dir)
-        if mrtrans_fasta:
-            ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = \
-                    find_synonymous(mrtrans_fasta, work_dir)
-            if ds_subs_yn is not None:
-                pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
-                output_h.write("%s\n" % (",".join(str(x) for x in (pair_name,
-                        ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng))))
-                output_h.flush()
+    return set(row.strip() for row in open(failedfile) if row.strip())
 
-    # Clean-up
-    sh("rm -rf 2YN.t 2YN.dN 2YN.dS rst rub rst1 syn_analysis")
+
+def iter_chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def calc_chunk(args):
+    """
+    Calculate the rates of a chunk of pairs, in a scratch directory of its
+    own. Returns the rows of the pairs that succeeded, and the names of the
+    pairs that failed.
+    """
+    chunk, work_dir, method = args
+    scratch = mkdtemp(dir=work_dir)
+    rows, failed = [], []
+    try:
+        for p_rec_1, p_rec_2, n_rec_1, n_rec_2 in chunk:
+
+            name = pair_name(p_rec_1, p_rec_2)
+            print >>sys.stderr, "--------", p_rec_1.name, p_rec_2.name
+            align_fasta = clustal_align_protein(p_rec_1, p_rec_2, scratch)
+            if method == "ng":
+                codons = codon_align(align_fasta, n_rec_1, n_rec_2)
+                if codons:
+                    ds_subs_ng, dn_subs_ng = ng86(*codons)
+                    rows.append((name, "nan", "nan", ds_subs_ng, dn_subs_ng))
+                else:
+                    failed.append(name)
+                continue
+
+            mrtrans_fasta = run_mrtrans(align_fasta, n_rec_1, n_rec_2, scratch)
+            ds_subs_yn = None
+            if mrtrans_fasta:
+                ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = \
+                        find_synonymous(mrtrans_fasta, scratch)
+            if ds_subs_yn is None:
+                failed.append(name)
+                continue
+
+            rows.append((name,
+                    ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng))
+    finally:
+        shutil.rmtree(scratch)
+
+    return rows, failed
 
 
 def translate_dna(dna_file):
@@ -307,7 +442,8 @@ def find_synonymous(input_file, work_dir):
 
     cl = YnCommandline(ctl_file)
     print >>sys.stderr, "\tyn00:", cl
-    r, e = cl.run()
+    # yn00 leaves rst, rub and 2YN.* in the current directory
+    r, e = cl.run(cwd=work_dir)
     ds_value_yn = None
     ds_value_ng = None
     dn_value_yn = None
@@ -340,6 +476,220 @@ def find_synonymous(input_file, work_dir):
     return ds_value_yn, dn_value_yn, ds_value_ng, dn_value_ng
 
 
+def codon_align(align_fasta, rec_1, rec_2):
+    """
+    Thread the CDS through the protein alignment, like pal2nal, so that each
+    aligned residue becomes its codon and each gap becomes `---`. Returns the
+    two codon-aligned strings, or None if a CDS is too short for its protein.
+    """
+    from cStringIO import StringIO
+
+    codons = []
+    prots = SeqIO.parse(StringIO(align_fasta), "fasta")
+    for prot, rec in zip(prots, (rec_1, rec_2)):
+        dna = str(rec.seq).upper()
+        aligned = []
+        i = 0
+        for aa in str(prot.seq):
+            if aa == "-":
+                aligned.append("---")
+                continue
+            codon = dna[i:i + 3]
+            if len(codon) < 3:
+                print >>sys.stderr, "***codon_align could not translate"
+                return None
+            aligned.append(codon)
+            i += 3
+        codons.append("".join(aligned))
+
+    return codons
+
+
+@memoized
+def ng86_tables():
+    """
+    Lookup tables over the 64 codons (ACGT order) for Nei-Gojobori:
+    synonymous and nonsynonymous sites per codon, with mutations to stop
+    codons excluded (N = 3 - S - nstop / 3), and synonymous and nonsynonymous
+    differences for each codon pair, averaged over the pathways avoiding stop
+    codons. Use `ngcheck` to compare with yn00 on a reference set.
+    """
+    from itertools import permutations
+    from Bio.Data.CodonTable import standard_dna_table
+
+    bases = "ACGT"
+    codons = ["".join(x) for x in product(bases, repeat=3)]
+    aa = [standard_dna_table.forward_table.get(x, "*") for x in codons]
+    index = dict((x, i) for i, x in enumerate(codons))
+    stop = np.array([x == "*" for x in aa])
+
+    S = np.zeros(64)
+    N = np.zeros(64)
+    for i, c in enumerate(codons):
+        syn = nstop = 0
+        for pos, b in product(range(3), bases):
+            if b == c[pos]:
+                continue
+            m = aa[index[c[:pos] + b + c[pos + 1:]]]
+            if m == "*":
+                nstop += 1
+            elif m == aa[i]:
+                syn += 1
+        S[i] = syn / 3.
+        N[i] = 3 - S[i] - nstop / 3.
+
+    SD = np.zeros((64, 64))
+    ND = np.zeros((64, 64))
+    for i, j in product(range(64), repeat=2):
+        a, b = codons[i], codons[j]
+        diff = [k for k in range(3) if a[k] != b[k]]
+        paths = []
+        for order in permutations(diff):
+            cur, sd, nd, ok = a, 0, 0, True
+            for k in order:
+                nxt = cur[:k] + b[k] + cur[k + 1:]
+                if nxt != b and aa[index[nxt]] == "*":
+                    ok = False
+                if aa[index[nxt]] == aa[index[cur]]:
+                    sd += 1
+                else:
+                    nd += 1
+                cur = nxt
+            paths.append((ok, sd, nd))
+        paths = [x for x in paths if x[0]] or paths
+        SD[i, j] = np.mean([x[1] for x in paths])
+        ND[i, j] = np.mean([x[2] for x in paths])
+
+    return S, N, SD, ND, stop
+
+
+def codon_indices(seq):
+    """
+    Index of each codon of seq into the ng86 tables, -1 for gaps, ambiguous
+    bases and stop codons.
+    """
+    S, N, SD, ND, stop = ng86_tables()
+    lookup = np.zeros(256, dtype=int) - 1
+    for i, b in enumerate("ACGT"):
+        lookup[ord(b)] = i
+
+    n = len(seq) / 3 * 3
+    bases = lookup[np.frombuffer(seq[:n].upper(), dtype=np.uint8)]
+    bases = bases.reshape((-1, 3))
+    idx = bases[:, 0] * 16 + bases[:, 1] * 4 + bases[:, 2]
+    invalid = (bases < 0).any(axis=1)
+    idx[invalid] = 0
+    idx[invalid | stop[idx]] = -1
+    return idx
+
+
+def jukes_cantor(p):
+    if not 0 <= p < .75:
+        return float("nan")
+    return -.75 * log(1 - 4 * p / 3) if p else 0.
+
+
+def ng86(seq_1, seq_2):
+    """
+    Nei and Gojobori (1986) Ks and Ka of two codon-aligned sequences with
+    Jukes-Cantor correction, through the codon lookup tables. Codons with gaps,
+    ambiguous bases or stops in either sequence are skipped.
+
+    >>> ng86("ATGCTTAAAGGGCCCTTTGAAACAGCGTGGCTA",
+    ...      "ATGCTCAAAGGACCCTTTGAGACAGCGTGCCTA")
+    (0.5716050390351726, 0.04256461244433711)
+
+    Away from stop codons, where the site conventions agree, this is the same
+    as Bio.codonalign cal_dn_ds(method="NG86"), which returns (dN, dS):
+
+    >>> ng86("GCTCCCGGTCTGGTCCATGCAGGCCGTCTCGCTGGCCCTGCC",
+    ...      "GCCCCGGATCTAGCCCATGCGGGCCGTCTTGCAGGCCCTGCC")
+    (0.6872180489056166, 0.07322885217293695)
+    """
+    S, N, SD, ND, stop = ng86_tables()
+    a, b = codon_indices(seq_1), codon_indices(seq_2)
+    valid = (a >= 0) & (b >= 0)
+    a, b = a[valid], b[valid]
+
+    syn_sites = (S[a] + S[b]).sum() / 2
+    non_sites = (N[a] + N[b]).sum() / 2
+    if not syn_sites or not non_sites:
+        return float("nan"), float("nan")
+
+    ds = jukes_cantor(SD[a, b].sum() / syn_sites)
+    dn = jukes_cantor(ND[a, b].sum() / non_sites)
+    return ds, dn
+
+
+def check_ng86(name, ours, theirs, tol=1e-3):
+    """
+    Compare the in-process ng86 (dS, dN) against the Nei-Gojobori columns of
+    yn00, which are printed to 4 decimals. Returns the number of columns that
+    disagree.
+
+    >>> check_ng86("a;b", (.5716, .0426), (.5716, .0425))
+    0
+    >>> check_ng86("a;b", (.5716, .0426), (.5916, float("nan")))
+    1
+    """
+    nbad = 0
+    for label, a, b in zip(("dS", "dN"), ours, theirs):
+        if a != a or b != b:  # nan
+            continue
+        if abs(a - b) > tol:
+            print >>sys.stderr, "{0}: ng86 {1}={2:.4f} but yn00 {1}={3:.4f}".\
+                    format(name, label, a, b)
+            nbad += 1
+    return nbad
+
+
+def ngcheck(args):
+    """
+    %prog ngcheck [prot.fasta] cds.fasta yn00.ks
+
+    Check the in-process Nei-Gojobori estimator on a small reference set of
+    pairs. The yn00.ks is the output of `calc --method yn00` on the same
+    files, its Nei-Gojobori columns are computed by PAML yn00. Pairs whose
+    dS or dN differ by more than --tol are reported.
+    """
+    p = OptionParser(ngcheck.__doc__)
+    p.add_option("--tol", default=1e-3, type="float",
+            help="Largest difference allowed, yn00 prints 4 decimals " \
+                 "[default: %default]")
+    opts, args = p.parse_args(args)
+
+    if len(args) == 2:
+        protein_file = None
+        dna_file, ks_file = args
+    elif len(args) == 3:
+        protein_file, dna_file, ks_file = args
+    else:
+        sys.exit(not p.print_help())
+
+    header, data = read_ks_file(ks_file)
+    theirs = dict((x.pair, (x.ng_ks, x.ng_ka)) for x in data)
+
+    if not protein_file:
+        protein_file = translate_dna(dna_file)
+
+    work_dir = mkdtemp(prefix="syn_analysis.", dir=os.getcwd())
+    prot_iterator = SeqIO.parse(open(protein_file), "fasta")
+    dna_iterator = SeqIO.parse(open(dna_file), "fasta")
+    pairs = [x for x in izip(prot_iterator, prot_iterator,
+                             dna_iterator, dna_iterator) \
+                if pair_name(*x[:2]) in theirs]
+    try:
+        rows, failed = calc_chunk((pairs, work_dir, "ng"))
+    finally:
+        shutil.rmtree(work_dir)
+
+    nbad = sum(1 for row in rows \
+                if check_ng86(row[0], row[3:], theirs[row[0]], tol=opts.tol))
+    logging.debug("{0} of {1} pairs checked disagree with yn00, {2} failed.".\
+                    format(nbad, len(rows), len(failed)))
+    sys.exit(nbad > 0)
+
+
 def extract_subs_value(text):
     """Extract a subsitution value from a line of text.
 
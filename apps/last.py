@@ -14,12 +14,8 @@ import logging
 from optparse import OptionParser
 from subprocess import Popen, PIPE
 
-from Bio import SeqIO
-from itertools import islice
-from multiprocessing import Lock
-
 from jcvi.utils.cbook import depends
-from jcvi.apps.grid import Jobs
+from jcvi.apps.grid import spool_jobs
 from jcvi.formats.base import must_open
 from jcvi.apps.base import debug, sh, set_outfile, set_params
 debug()
@@ -32,23 +28,173 @@ def run_lastdb(infile=None, outfile=None, lastdb_bin="lastdb"):
     sh(cmd)
 
 
-def last(k, n, out_fh, cmd, query, lock):
+def index_query(query):
+    """
+    Single pass over the query FASTA. Returns (name, offset, size, seqlen) for
+    each record, where offset and size give its byte range in the file.
+    """
+    index = []
+    name, offset, seqlen, pos = None, 0, 0, 0
+    fp = open(query, "rb")
+    for row in fp:
+        if row[0] == ">":
+            if name is not None:
+                index.append((name, offset, pos - offset, seqlen))
+            name = (row[1:].split() or [""])[0]
+            offset, seqlen = pos, 0
+        else:
+            seqlen += len(row.strip())
+        pos += len(row)
+    fp.close()
+
+    if name is not None:
+        index.append((name, offset, pos - offset, seqlen))
+
+    return index
+
+
+def make_windows(index, window=0, overlap=0):
+    """
+    Split records longer than `window` into windows that overlap by `overlap`.
+    Each piece is (name, offset, size, seqlen, start, end, ownend). A hit is
+    kept only by the window whose [start, ownend) contains its start, so hits
+    within an overlap are reported once.
 
-    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, shell=True)
+    >>> make_windows([("a", 0, 30, 25)], window=10, overlap=2)[-1]
+    ('a', 0, 30, 25, 16, 25, 25)
+    """
+    pieces = []
+    step = window - overlap
+    for name, offset, size, seqlen in index:
+        if not window or seqlen <= window:
+            pieces.append((name, offset, size, seqlen, 0, seqlen, seqlen))
+            continue
 
-    parser = SeqIO.parse(query, "fasta")
-    for rec in islice(parser, k - 1, None, n):
-        SeqIO.write([rec], proc.stdin, "fasta")
-    proc.stdin.close()
+        for start in xrange(0, seqlen - overlap, step):
+            end = min(start + window, seqlen)
+            ownend = seqlen if end == seqlen else start + step
+            pieces.append((name, offset, size, seqlen, start, end, ownend))
 
-    logging.debug("job <%d> started: %s" % (proc.pid, cmd))
-    for row in proc.stdout:
-        if row[0] == '#':
+    return pieces
+
+
+def make_chunks(pieces, cpus, chunks_per_cpu=4):
+    """
+    Pack the pieces, longest first, into chunks of about equal residues. The
+    chunks are returned largest first; idle workers take the next chunk from
+    the pool queue, so a single long chromosome no longer stalls a worker
+    while the others sit idle.
+    """
+    if cpus == 1 or not pieces:
+        return [pieces]
+
+    plen = lambda x: x[5] - x[4]
+    pieces = sorted(pieces, key=plen, reverse=True)
+    target = max(sum(plen(x) for x in pieces) / (cpus * chunks_per_cpu), 1)
+
+    chunks, chunk, chunksize = [], [], 0
+    for x in pieces:
+        chunk.append(x)
+        chunksize += plen(x)
+        if chunksize >= target:
+            chunks.append(chunk)
+            chunk, chunksize = [], 0
+    if chunk:
+        chunks.append(chunk)
+
+    chunks.sort(key=lambda c: sum(plen(x) for x in c), reverse=True)
+    return chunks
+
+
+def window_name(name, start, end):
+    return "{0}:{1}-{2}".format(name, start, end)
+
+
+def feed_query(query, chunk, fh):
+    """
+    Copy the records in the chunk by byte range, cutting out the windows.
+    """
+    cache = (None, None)
+    fp = open(query, "rb")
+    for name, offset, size, seqlen, start, end, ownend in chunk:
+        if end - start == seqlen:
+            fp.seek(offset)
+            record = fp.read(size)
+            fh.write(record)
+            if not record.endswith("\n"):
+                fh.write("\n")
             continue
-        lock.acquire()
-        out_fh.write(row)
-        out_fh.flush()
-        lock.release()
+
+        if cache[0] != offset:
+            fp.seek(offset)
+            lines = fp.read(size).splitlines()[1:]
+            cache = (offset, "".join(x.strip() for x in lines))
+        print >> fh, ">" + window_name(name, start, end)
+        print >> fh, cache[1][start:end]
+    fp.close()
+    fh.close()
+
+
+def lift_row(row, windows, format):
+    """
+    Convert query coordinates in a row from window back to the sequence, or
+    return None if the hit belongs to the next window.
+    """
+    atoms = row.rstrip("\n").split("\t")
+    q = 0 if format == "blast" else 6
+    if atoms[q] not in windows:
+        return row
+
+    name, start, end, seqlen, ownend = windows[atoms[q]]
+    atoms[q] = name
+    if format == "blast":
+        qstart, qend = int(atoms[6]) + start, int(atoms[7]) + start
+        atoms[6:8] = str(qstart), str(qend)
+        fstart = min(qstart, qend) - 1
+    else:
+        # LAST tab, 0-based start of the alignment on the aligned strand
+        qstart, alnsize, strand = int(atoms[7]), int(atoms[8]), atoms[9]
+        if strand == "+":
+            qstart += start
+            fstart = qstart
+        else:
+            qstart += seqlen - end
+            fstart = seqlen - qstart - alnsize
+        atoms[7], atoms[10] = str(qstart), str(seqlen)
+
+    if fstart >= ownend:
+        return None
+
+    return "\t".join(atoms) + "\n"
+
+
+def last(cmd, query, chunk, format, out_fh=None):
+    """
+    Align the records in the chunk and write the rows to out_fh. The query is
+    fed from a thread so that the output pipe is drained at the same time.
+    """
+    from threading import Thread
+
+    windows = dict((window_name(name, start, end),
+                    (name, start, end, seqlen, ownend)) for \
+                    name, offset, size, seqlen, start, end, ownend in chunk \
+                    if end - start < seqlen)
+
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, shell=True)
+    feeder = Thread(target=feed_query, args=(query, chunk, proc.stdin))
+    feeder.start()
+
+    logging.debug("job <%d> started: %s" % (proc.pid, cmd))
+    rows = (row for row in proc.stdout if row[0] != '#')
+    if windows:
+        rows = (lift_row(row, windows, format) for row in rows)
+        rows = (row for row in rows if row is not None)
+    out_fh.writelines(rows)
+    feeder.join()
+    retcode = proc.wait()
+    if retcode != 0:
+        raise Exception("job <{0}> exited with {1}: {2}".\
+                        format(proc.pid, retcode, cmd))
     logging.debug("job <%d> finished" % proc.pid)
 
 
@@ -71,6 +217,13 @@ def main(args):
                       format("|".join(supported_formats)))
     p.add_option("--eval", default=False, action="store_true",
                  help="Use lastex to recalculate E-value [default: %default]")
+    p.add_option("--sort", default=False, action="store_true",
+                 help="Sort blast output by query and score [default: %default]")
+    p.add_option("--window", default=0, type="int",
+                 help="Split query sequences longer than this into windows, "\
+                      "0 to disable [default: %default]")
+    p.add_option("--overlap", default=1000, type="int",
+                 help="Overlap between adjacent windows [default: %default]")
 
     set_params(p)
     set_outfile(p)
@@ -83,6 +236,10 @@ def main(args):
     subject, query = args
     if opts.eval and opts.cpus > 1:
         raise Exception, "Option --eval cannnot work with multiple threads"
+    if opts.window:
+        assert opts.format != "maf", "Option --window cannot work with maf"
+        assert 0 <= opts.overlap < opts.window, \
+                "Option --overlap must be smaller than --window"
 
     path = opts.path
     getpath = lambda x: op.join(path, x) if path else x
@@ -94,11 +251,10 @@ def main(args):
     run_lastdb(infile=subject, outfile=subjectdb + ".prj", lastdb_bin=lastdb_bin)
 
     cpus = opts.cpus
-    logging.debug("Dispatch job to {0} cpus".format(cpus))
-
-    if opts.format == "maf":
-        cmd = 'echo "##maf version=1"'
-        sh(cmd)
+    pieces = make_windows(index_query(query), window=opts.window,
+                          overlap=opts.overlap)
+    chunks = make_chunks(pieces, cpus)
+    logging.debug("Dispatch {0} chunks to {1} cpus".format(len(chunks), cpus))
 
     cmd = "{0} -u 0".format(lastal_bin)
     f = supported_formats.index(opts.format)
@@ -116,12 +272,16 @@ def main(args):
         cmd += " | {0} {1}.prj {2}.prj -".format(lastex_bin, subjectdb, querydb)
 
     out_fh = must_open(opts.outfile, "w")
-    lock = Lock()
+    if opts.format == "maf":
+        print >> out_fh, "##maf version=1"
+
+    args = [(cmd, query, x, opts.format) for x in chunks]
+    spool_jobs(last, args, out_fh, cpus=cpus)
+    out_fh.close()
 
-    args = [(k + 1, cpus, out_fh, cmd, query, lock) \
-                    for k in xrange(cpus)]
-    g = Jobs(target=last, args=args)
-    g.run()
+    if opts.sort and opts.format == "blast" and opts.outfile != "stdout":
+        from jcvi.formats.blast import sort
+        sort([opts.outfile])
 
 
 if __name__ == '__main__':
@@ -9,10 +9,10 @@ import logging
 
 from optparse import OptionParser
 from subprocess import Popen, PIPE
-from multiprocessing import Lock, Pool
+from multiprocessing import Pool
 
 from jcvi.formats.base import must_open
-from jcvi.apps.grid import Grid, Jobs
+from jcvi.apps.grid import Grid, spool_jobs
 from jcvi.apps.base import ActionDispatcher, debug, set_params, \
         set_grid, set_outfile, sh, mkdir
 debug()
@@ -97,18 +97,21 @@ def lastz_2bit(t):
     if grid:  # if run on SGE, only the cmd is needed
         return lastz_cmd
 
-    proc = Popen(lastz_cmd, bufsize=1, stdout=PIPE, shell=True)
-    out_fh = open(outfile, "w")
+    proc = Popen(lastz_cmd, stdout=PIPE, shell=True)
+    out_fh = open(outfile, "w", 1 << 20)
 
     logging.debug("job <%d> started: %s" % (proc.pid, lastz_cmd))
-    for row in proc.stdout:
-        out_fh.write(row)
-        out_fh.flush()
+    out_fh.writelines(proc.stdout)
+    out_fh.close()
+    retcode = proc.wait()
+    if retcode != 0:
+        raise Exception("job <{0}> exited with {1}: {2}".\
+                        format(proc.pid, retcode, lastz_cmd))
     logging.debug("job <%d> finished" % proc.pid)
 
 
-def lastz(k, n, bfasta_fn, afasta_fn, out_fh, lock, lastz_bin, extra,
-          mask=False, grid=False):
+def lastz(k, n, bfasta_fn, afasta_fn, lastz_bin, extra, mask=False,
+          grid=False, out_fh=None):
 
     ref_tags = [Multiple, Darkspace]
     qry_tags = [Darkspace]
@@ -130,15 +133,15 @@ def lastz(k, n, bfasta_fn, afasta_fn, out_fh, lock, lastz_bin, extra,
     if grid:  # if run on SGE, only the cmd is needed
         return lastz_cmd
 
-    proc = Popen(lastz_cmd, bufsize=1, stdout=PIPE, shell=True)
+    proc = Popen(lastz_cmd, stdout=PIPE, shell=True)
 
     logging.debug("job <%d> started: %s" % (proc.pid, lastz_cmd))
-    for row in proc.stdout:
-        row = lastz_to_blast(row)
-        lock.acquire()
-        print >> out_fh, row
-        out_fh.flush()
-        lock.release()
+    # rows are converted to blast tabular on the fly, in the worker
+    out_fh.writelines(lastz_to_blast(row) + "\n" for row in proc.stdout)
+    retcode = proc.wait()
+    if retcode != 0:
+        raise Exception("job <{0}> exited with {1}: {2}".\
+                        format(proc.pid, retcode, lastz_cmd))
     logging.debug("job <%d> finished" % proc.pid)
 
 
@@ -163,6 +166,8 @@ def main():
             help="specify LASTZ path")
     p.add_option("--mask", dest="mask", default=False, action="store_true",
             help="treat lower-case letters as mask info [default: %default]")
+    p.add_option("--sort", default=False, action="store_true",
+            help="sort blast output by query and score [default: %default]")
 
     set_params(p)
     set_outfile(p)
@@ -228,11 +233,9 @@ def main():
 
         return
 
-    lock = Lock()
-
     if grid:
-        cmds = [lastz(k + 1, cpus, bfasta_fn, afasta_fn, out_fh, \
-                lock, lastz_bin, extra, mask, grid) for k in xrange(cpus)]
+        cmds = [lastz(k + 1, cpus, bfasta_fn, afasta_fn, lastz_bin, extra,
+                mask, grid) for k in xrange(cpus)]
         mkdir(outdir)
         g = Grid(cmds, outfiles=[op.join(outdir, "out.{0}.lastz").\
                 format(i) for i in range(len(cmds))])
@@ -240,10 +243,14 @@ def main():
         g.writestatus()
 
     else:
-        args = [(k + 1, cpus, bfasta_fn, afasta_fn, out_fh,
-                lock, lastz_bin, extra, mask) for k in xrange(cpus)]
-        g = Jobs(target=lastz, args=args)
-        g.run()
+        args = [(k + 1, cpus, bfasta_fn, afasta_fn, lastz_bin, extra, mask) \
+                for k in xrange(cpus)]
+        spool_jobs(lastz, args, out_fh, cpus=cpus)
+        out_fh.close()
+
+        if opts.sort and opts.outfile != "stdout":
+            from jcvi.formats.blast import sort
+            sort([opts.outfile])
 
 
 if __name__ == '__main__':
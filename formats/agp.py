@@ -359,7 +359,7 @@ class AGP (LineFile):
                 logging.debug("Write object %s to `%s`" % (object, fw.name))
 
     def build_all(self, componentfasta, targetfasta, newagp=None):
-        f = Fasta(componentfasta, index=False)
+        f = Fasta(componentfasta)
         fw = open(targetfasta, "w")
 
         for ob, lines_with_same_ob in groupby(self, key=lambda x: x.object):
@@ -1423,7 +1423,7 @@ def validate(args):
 
     agp = AGP(agpfile)
     build = Fasta(targetfasta)
-    bacs = Fasta(componentfasta, index=False)
+    bacs = Fasta(componentfasta)
 
     # go through this line by line
     for aline in agp:
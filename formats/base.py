@@ -6,9 +6,11 @@ import os.path as op
 import math
 import sys
 import logging
+import heapq
 
 from itertools import groupby, islice, cycle, izip
 from optparse import OptionParser
+from pipes import quote
 
 from Bio import SeqIO
 from jcvi.apps.base import ActionDispatcher, sh, debug, need_update, \
@@ -136,6 +138,95 @@ class FileSplitter (object):
             format = "txt"
         return format
 
+    def _index(self):
+        """
+        Single pass over the file, returns (name, offset, size, length) of
+        each record. The length is in residues for fasta and fastq, and in
+        bytes for txt, where each line is a record.
+        """
+        index = []
+        pos = 0
+        fp = open(self.filename, "rb")
+        if self.format == "fasta":
+            name = None
+            for row in fp:
+                if row[0] == ">":
+                    if name is not None:
+                        index.append((name, offset, pos - offset, length))
+                    name = (row[1:].split() or [""])[0]
+                    offset, length = pos, 0
+                else:
+                    length += len(row.strip())
+                pos += len(row)
+            if name is not None:
+                index.append((name, offset, pos - offset, length))
+
+        elif self.format == "fastq":
+            while True:
+                rec = list(islice(fp, 4))
+                if not rec:
+                    break
+                size = sum(len(x) for x in rec)
+                name = (rec[0][1:].split() or [""])[0]
+                index.append((name, pos, size, len(rec[1].strip())))
+                pos += size
+
+        else:
+            for row in fp:
+                name = (row.split() or [""])[0]
+                index.append((name, pos, len(row), len(row)))
+                pos += len(row)
+
+        fp.close()
+        return index
+
+    def _balanced_split(self, filehandles):
+        """
+        Assign records to the files by greedy longest-first total length, and
+        copy them as raw byte ranges, keeping their relative order. Writes the
+        manifest: name, original order, split file, and order in that file.
+        """
+        index = self._index()
+        N = len(filehandles)
+        bins = [[] for i in xrange(N)]
+        heap = [(0, 0, i) for i in xrange(N)]
+        for i in sorted(xrange(len(index)), key=lambda x: -index[x][3]):
+            total, nrecords, b = heapq.heappop(heap)
+            bins[b].append(i)
+            heapq.heappush(heap, (total + index[i][3], nrecords + 1, b))
+
+        fp = open(self.filename, "rb")
+        where = {}
+        for b, fw in zip(bins, filehandles):
+            b.sort()
+            # adjacent records are read as one range
+            j = 0
+            while j < len(b):
+                k = j + 1
+                while k < len(b) and b[k] == b[k - 1] + 1:
+                    k += 1
+                start, end = index[b[j]][1], index[b[k - 1]][1] + \
+                                             index[b[k - 1]][2]
+                fp.seek(start)
+                data = fp.read(end - start)
+                fw.write(data)
+                if not data.endswith("\n"):
+                    fw.write("\n")
+                j = k
+
+            for j, i in enumerate(b):
+                where[i] = (fw.name, j)
+            logging.debug("write %d records (%d in length) to %s" % \
+                    (len(b), sum(index[i][3] for i in b), fw.name))
+        fp.close()
+
+        fw = open(self.manifest, "w")
+        for i, (name, offset, size, length) in enumerate(index):
+            splitfile, j = where[i]
+            print >> fw, "\t".join((name, str(i), splitfile, str(j)))
+        fw.close()
+        logging.debug("manifest written to `{0}`".format(self.manifest))
+
     def _batch_iterator(self, N=1):
         """Returns N lists of records.
 
@@ -167,23 +258,36 @@ class FileSplitter (object):
 
         return names
 
+    @classmethod
+    def get_manifest(cls, filename):
+        root, ext = op.splitext(op.basename(filename))
+        return root + ".manifest"
+
     def split(self, N, force=False):
         """
-        There are two modes of splitting the records
+        There are three modes of splitting the records
         - batch: splitting is sequentially to records/N chunks
         - cycle: placing each record in the splitted files and cycles
+        - balanced: placing the longest records first, each to the file with
+          the least total length so far, also writes a manifest
 
-        use `cycle` if the len of the record is not evenly distributed
+        use `cycle` or `balanced` if the len of the record is not evenly
+        distributed
         """
         mode = self.mode
-        assert mode in ("batch", "cycle")
+        assert mode in ("batch", "cycle", "balanced")
         logging.debug("set split mode=%s" % mode)
 
         self.names = self.__class__.get_names(self.filename, N)
+        self.manifest = self.__class__.get_manifest(self.filename)
         if self.outputdir:
             self.names = [op.join(self.outputdir, x) for x in self.names]
+            self.manifest = op.join(self.outputdir, self.manifest)
 
-        if not need_update(self.filename, self.names) and not force:
+        # A balanced split is only complete with its manifest
+        outputs = self.names + [self.manifest] if mode == "balanced" \
+                  else self.names
+        if not need_update(self.filename, outputs) and not force:
             logging.error("file %s already existed, skip file splitting" % \
                     self.names[0])
             return
@@ -211,10 +315,72 @@ class FileSplitter (object):
                 else:
                     fw.write(record)
 
+        elif mode == "balanced":
+            self._balanced_split(filehandles)
+
         for fw in filehandles:
             fw.close()
 
 
+def read_manifest(manifest):
+    """
+    Returns the original order of each record name in the manifest written by
+    FileSplitter in `balanced` mode.
+    """
+    order = {}
+    fp = open(manifest)
+    for row in fp:
+        name, i, splitfile, j = row.rstrip("\n").split("\t")
+        order.setdefault(name, int(i))
+    fp.close()
+
+    return order
+
+
+def restore_order(filename, manifest):
+    """
+    Sort the rows of the file in place by the original order of the record
+    named in the first column. Rows of the same record keep their order, and
+    rows not in the manifest go last.
+
+    Each row is prefixed with its order key and row number, then the external
+    `sort` does the work, so the file is never held in memory. The file is
+    left untouched if the sort fails.
+    """
+    order = read_manifest(manifest)
+    last = len(order)
+    keyedfile = filename + ".keyed"
+    fp = open(filename)
+    fw = open(keyedfile, "w")
+    for i, row in enumerate(fp):
+        key = order.get((row.split(None, 1) or [""])[0], last)
+        if not row.endswith("\n"):
+            row += "\n"
+        fw.write("{0}\t{1}\t{2}".format(key, i, row))
+    fw.close()
+    fp.close()
+
+    # The merged file is replaced only once the sort has succeeded
+    tmpdir = op.dirname(op.abspath(filename))
+    cmd = "LC_ALL=C sort -t'\t' -k1,1n -k2,2n -T {0} -o {1} {1}".\
+            format(quote(tmpdir), quote(keyedfile))
+    retcode = sh(cmd)
+    assert retcode == 0, "sort exited with {0}, `{1}` kept".\
+            format(retcode, keyedfile)
+
+    tmpfile = filename + ".tmp"
+    fp = open(keyedfile)
+    fw = open(tmpfile, "w")
+    for row in fp:
+        fw.write(row.split("\t", 2)[2])
+    fw.close()
+    fp.close()
+    os.rename(tmpfile, filename)
+    os.remove(keyedfile)
+    logging.debug("`{0}` sorted in the order of `{1}`".\
+            format(filename, manifest))
+
+
 def check_exists(filename):
     """
     Avoid overwriting some files accidentally.
@@ -281,6 +447,53 @@ def must_open(filename, mode="r", checkexists=False, skipcheck=False):
     return fp
 
 
+def write_arrays(filename, arrays):
+    """
+    Write NumPy arrays back to back into one binary file, each in .npy format,
+    so that they can be reopened zero-copy through memmap_arrays(). The file is
+    replaced atomically, existing memory maps of it stay valid.
+    """
+    import numpy as np
+
+    tmpfile = filename + ".tmp"
+    fw = open(tmpfile, "wb")
+    for a in arrays:
+        np.lib.format.write_array(fw, np.ascontiguousarray(a))
+    fw.close()
+    os.rename(tmpfile, filename)
+    logging.debug("Wrote {0} arrays to `{1}`.".format(len(arrays), filename))
+
+
+def memmap_arrays(filename):
+    """
+    Returns the arrays written by write_arrays(), as read-only memory maps.
+    """
+    import numpy as np
+    from numpy.lib import format as npformat
+
+    size = op.getsize(filename)
+    fp = open(filename, "rb")
+    arrays = []
+    while fp.tell() < size:
+        version = npformat.read_magic(fp)
+        read_header = npformat.read_array_header_1_0 if version == (1, 0) \
+                      else npformat.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(fp)
+        offset = fp.tell()
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        if nbytes:
+            order = "F" if fortran_order else "C"
+            a = np.memmap(filename, dtype=dtype, mode="r", shape=shape,
+                          offset=offset, order=order)
+        else:
+            a = np.zeros(shape, dtype=dtype)
+        arrays.append(a)
+        fp.seek(offset + nbytes)
+    fp.close()
+
+    return arrays
+
+
 def read_until(handle, start):
     # read each line until a certain start, then puts the start tag back
     while 1:
@@ -423,13 +636,15 @@ def split(args):
             help="split all records [default: %default]")
     p.add_option("--cycle", default=False, action="store_true",
             help="splitted records in Round Robin fashion [default: %default]")
+    p.add_option("--balanced", default=False, action="store_true",
+            help="balance total record length, longest first [default: %default]")
 
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
         sys.exit(p.print_help())
 
-    mode = "cycle" if opts.cycle else "batch"
+    mode = "balanced" if opts.balanced else "cycle" if opts.cycle else "batch"
     filename, outdir = args
     fs = FileSplitter(filename, outputdir=outdir, mode=mode)
 
@@ -8,6 +8,8 @@ import sys
 import shutil
 import logging
 
+import numpy as np
+
 from itertools import groupby
 from optparse import OptionParser
 
@@ -164,14 +166,162 @@ class Bed(LineFile):
             yield seqid, ranks[0][1], ranks[-1][1]
 
 
+class BedIndex (object):
+    """
+    In-process interval index over the features of a Bed, as a nested
+    containment list (NCList) per seqid backed by NumPy arrays. Intervals that
+    are contained in another one are moved into the sublist of their container,
+    so that within each sublist both starts and ends are sorted and an overlap
+    query is a binary search followed by a linear scan.
+
+    Coordinates follow BedLine, i.e. 1-based and end-inclusive.
+    """
+    def __init__(self, bed):
+        self.bed = bed
+        self.lists = {}
+        self.sorted = {}
+
+        members = {}
+        for i, b in enumerate(bed):
+            members.setdefault(b.seqid, []).append(i)
+
+        for seqid, ids in members.iteritems():
+            ids = np.array(ids, dtype=int)
+            starts = np.array([bed[i].start for i in ids], dtype=int)
+            ends = np.array([bed[i].end for i in ids], dtype=int)
+            self.lists[seqid] = self.nclist(starts, ends, ids)
+
+            by_start = np.argsort(starts, kind="mergesort")
+            by_end = np.argsort(ends, kind="mergesort")
+            self.sorted[seqid] = (starts[by_start], ids[by_start],
+                                  ends[by_end], ids[by_end])
+
+    def __contains__(self, seqid):
+        return seqid in self.lists
+
+    @staticmethod
+    def nclist(starts, ends, ids):
+        n = len(starts)
+        order = np.lexsort((-ends, starts))
+        starts, ends, ids = starts[order], ends[order], ids[order]
+
+        # The stack holds the chain of enclosing intervals, the top of the
+        # stack that still reaches past the current end is its container
+        parent = np.empty(n, dtype=int)
+        stack = []
+        elist = ends.tolist()
+        for i, e in enumerate(elist):
+            while stack and elist[stack[-1]] < e:
+                stack.pop()
+            parent[i] = stack[-1] if stack else -1
+            stack.append(i)
+
+        # Lay out each sublist contiguously, top level (parent -1) first
+        order = np.lexsort((np.arange(n), parent))
+        parent = parent[order]
+        newpos = np.empty(n, dtype=int)
+        newpos[order] = np.arange(n)
+        starts, ends, ids = starts[order], ends[order], ids[order]
+
+        sub_lo = np.zeros(n, dtype=int)
+        sub_hi = np.zeros(n, dtype=int)
+        breaks = np.flatnonzero(np.r_[True, parent[1:] != parent[:-1]])
+        stops = np.r_[breaks[1:], n]
+        parents = parent[breaks]
+        nested = parents >= 0
+        sub_lo[newpos[parents[nested]]] = breaks[nested]
+        sub_hi[newpos[parents[nested]]] = stops[nested]
+        top = (0, stops[0]) if parents[0] < 0 else (0, 0)
+
+        return starts, ends, ids, sub_lo, sub_hi, top
+
+    def iter_overlap(self, seqid, start, end):
+        """
+        Yields the positions in the Bed of the features overlapping
+        [start, end], in no particular order.
+        """
+        if seqid not in self.lists:
+            return
+
+        starts, ends, ids, sub_lo, sub_hi, top = self.lists[seqid]
+        stack = [top]
+        while stack:
+            lo, hi = stack.pop()
+            i = lo + np.searchsorted(ends[lo:hi], start)
+            while i < hi and starts[i] <= end:
+                yield ids[i]
+                if sub_lo[i] < sub_hi[i]:
+                    stack.append((sub_lo[i], sub_hi[i]))
+                i += 1
+
+    def overlap(self, seqid, start, end):
+        """
+        Returns the features overlapping [start, end], in Bed order.
+        """
+        ids = sorted(self.iter_overlap(seqid, start, end))
+        return [self.bed[i] for i in ids]
+
+    def count(self, seqid, starts, ends):
+        """
+        Number of features overlapping each of the query intervals, the
+        queries can be scalars or arrays.
+        """
+        if seqid not in self.sorted:
+            return np.zeros_like(starts, dtype=int)
+
+        sstarts, sids, sends, eids = self.sorted[seqid]
+        return np.searchsorted(sstarts, ends, side="right") - \
+               np.searchsorted(sends, starts, side="left")
+
+    def knearest(self, seqid, start, end, k=1):
+        """
+        Returns up to k features closest to [start, end] as (distance, feature)
+        sorted by distance. Overlapping features have distance 0, otherwise
+        distance is the gap between the nearest ends, ties broken by Bed order.
+        """
+        if seqid not in self.sorted:
+            return []
+
+        hits = [(0, i) for i in self.iter_overlap(seqid, start, end)]
+        sstarts, sids, sends, eids = self.sorted[seqid]
+        n = len(sstarts)
+        left = np.searchsorted(sends, start, side="left") - 1
+        right = np.searchsorted(sstarts, end, side="right")
+
+        # Walk outward on both sides, left by end descending, right by start
+        # ascending, and stop once k features are in hand and none can tie
+        found = sorted(hits)[:k]
+        while left >= 0 or right < n:
+            dl = start - sends[left] if left >= 0 else None
+            dr = sstarts[right] - end if right < n else None
+            d = min(x for x in (dl, dr) if x is not None)
+            if len(found) >= k and d > found[-1][0]:
+                break
+            if d == dl:
+                found.append((d, eids[left]))
+                left -= 1
+            else:
+                found.append((d, sids[right]))
+                right += 1
+            found = sorted(found)[:k]
+
+        return [(int(d), self.bed[i]) for d, i in found]
+
+    def nearest(self, seqid, start, end):
+        """
+        Returns the (distance, feature) closest to [start, end], or None.
+        """
+        hits = self.knearest(seqid, start, end, k=1)
+        return hits[0] if hits else None
+
+
 class BedEvaluate (object):
 
     def __init__(self, TPbed, FPbed, FNbed, TNbed):
 
-        self.TP = Bed(TPbed).sum(unique=True)
-        self.FP = Bed(FPbed).sum(unique=True)
-        self.FN = Bed(FNbed).sum(unique=True)
-        self.TN = Bed(TNbed).sum(unique=True)
+        self.TP, self.FP, self.FN, self.TN = \
+                (x if isinstance(x, (int, long)) else Bed(x).sum(unique=True) \
+                 for x in (TPbed, FPbed, FNbed, TNbed))
 
     def __str__(self):
         from jcvi.utils.table import tabulate
@@ -216,6 +366,12 @@ class BedEvaluate (object):
                     (self.sensitivity, self.specificity, self.accuracy)))
 
 
+def set_bedtools(instance):
+    instance.add_option("--bedtools", default=False, action="store_true",
+            help="Use BEDTools instead of the in-process interval index " \
+                 "[default: %default]")
+
+
 def main():
 
     actions = (
@@ -237,97 +393,114 @@ def main():
     p.dispatch(globals())
 
 
-def bins(args):
+def bin_coverage(bed, sizes, binsize):
     """
-    %prog bins bedfile fastafile
-
-    Bin bed lengths into each consecutive window.
+    Covered bases of the merged features in each consecutive window of
+    binsize, for every seqid in sizes. The cumulative coverage is evaluated at
+    all the bin boundaries of a chromosome at once. Returns dict of seqid =>
+    (covered, binlens) arrays.
     """
-    import numpy as np
-
-    from jcvi.formats.sizes import Sizes
-
-    p = OptionParser(bins.__doc__)
-    p.add_option("--binsize", default=100000, type="int",
-                 help="Size of the bins [default: %default]")
-    opts, args = p.parse_args(args)
+    merged = merge_ranges(bed)
+    coverage = {}
+    for seqid, size in zip(sizes.ctgs, sizes.sizes):
+        bounds = np.r_[np.arange(0, size, binsize), size]
+        binlens = np.diff(bounds)
+        if seqid not in merged:
+            coverage[seqid] = (np.zeros(len(binlens), dtype=int), binlens)
+            continue
 
-    if len(args) != 2:
-        sys.exit(not p.print_help())
+        # Half-open 0-based runs, clipped to the chromosome
+        starts, ends = merged[seqid]
+        starts = starts - 1
+        ends = np.minimum(ends, size)
+        keep = starts < ends
+        starts, ends = starts[keep], ends[keep]
 
-    bedfile, fastafile = args
-    assert op.exists(bedfile)
+        # Coverage in [0, x) is all the runs starting before x, less the part
+        # of the last of them that reaches past x
+        cumlens = np.r_[0, np.cumsum(ends - starts)]
+        k = np.searchsorted(starts, bounds, side="left")
+        overhang = np.where(k > 0, ends[np.maximum(k - 1, 0)] - bounds, 0)
+        cumcov = cumlens[k] - np.maximum(overhang, 0)
+        coverage[seqid] = (np.diff(cumcov), binlens)
 
-    binsize = opts.binsize
-    binfile = bedfile + ".{0}.bins".format(binsize)
-    if not need_update(bedfile, binfile):
-        return binfile
+    return coverage
 
-    sizes = Sizes(fastafile).mapping
-    fw = open(binfile, "w")
-    bedfile = mergeBed(bedfile)
-    bedfile = sort([bedfile, "-i"])
 
-    bed = Bed(bedfile)
-    for chr, subbeds in bed.sub_beds():
-        chr_len = sizes[chr]
-        nbins = chr_len / binsize
-        last_bin = chr_len % binsize
-        if last_bin:
-            nbins += 1
+def make_bins(bedfiles, fastafile, binsize=100000):
+    """
+    Write `bedfile.{binsize}.bins` for each of the bedfiles, which is skipped
+    if up to date. Returns the list of binfiles.
+    """
+    from jcvi.formats.sizes import Sizes
 
-        a = np.zeros(nbins, dtype="int")
-        b = np.zeros(nbins, dtype="int")
-        b[:-1] = binsize
-        b[-1] = last_bin
+    sizes = None
+    binfiles = []
+    for bedfile in bedfiles:
+        assert op.exists(bedfile)
+        binfile = bedfile + ".{0}.bins".format(binsize)
+        binfiles.append(binfile)
+        if not need_update(bedfile, binfile):
+            continue
 
-        for bb in subbeds:
+        sizes = sizes or Sizes(fastafile)
+        coverage = bin_coverage(Bed(bedfile), sizes, binsize)
+        fw = open(binfile, "w")
+        for chr in sizes.ctgs:
+            for xa, xb in zip(*coverage[chr]):
+                print >> fw, "\t".join(str(x) for x in (chr, xa, xb))
+        fw.close()
+        logging.debug("File written to `{0}`.".format(binfile))
 
-            start, end = bb.start, bb.end
-            startbin = start / binsize
-            endbin = end / binsize
+    return binfiles
 
-            assert startbin <= endbin
 
-            if startbin == endbin:
-                a[startbin] += end - start + 1
+def bins(args):
+    """
+    %prog bins bedfile [bedfile ...] fastafile
 
-            if startbin < endbin:
-                firstsize = (startbin + 1) * binsize - start + 1
-                lastsize = end - endbin * binsize
-                a[startbin] += firstsize
-                if startbin + 1 < endbin:
-                    a[startbin + 1:endbin] += binsize
-                a[endbin] += lastsize
+    Bin bed lengths into each consecutive window. Features are merged first so
+    that each base is counted only once.
+    """
+    p = OptionParser(bins.__doc__)
+    p.add_option("--binsize", default=100000, type="int",
+                 help="Size of the bins [default: %default]")
+    opts, args = p.parse_args(args)
 
-        for xa, xb in zip(a, b):
-            print >> fw, "\t".join(str(x) for x in (chr, xa, xb))
+    if len(args) < 2:
+        sys.exit(not p.print_help())
 
-    fw.close()
+    bedfiles, fastafile = args[:-1], args[-1]
+    binfiles = make_bins(bedfiles, fastafile, binsize=opts.binsize)
 
-    return binfile
+    return binfiles[0] if len(binfiles) == 1 else binfiles
 
 
 def pile(args):
     """
     %prog pile abedfile bbedfile > piles
 
-    Call intersectBed on two bedfiles.
+    Intersect two bedfiles and group the ids that overlap.
     """
-    from jcvi.utils.grouper import Grouper
+    from jcvi.utils.grouper import CompactGrouper
 
     p = OptionParser(pile.__doc__)
     p.add_option("--minOverlap", default=0, type="int",
                  help="Minimum overlap required [default: %default]")
+    set_bedtools(p)
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
         sys.exit(not p.print_help())
 
     abedfile, bbedfile = args
-    iw = intersectBed_wao(abedfile, bbedfile, minOverlap=opts.minOverlap)
-    groups = Grouper()
+    iw = intersectBed_wao(abedfile, bbedfile, minOverlap=opts.minOverlap,
+                          bedtools=opts.bedtools)
+    groups = CompactGrouper()
     for a, b in iw:
+        if b is None:
+            groups.join(a.accn)
+            continue
         groups.join(a.accn, b.accn)
 
     ngroups = 0
@@ -439,6 +612,7 @@ def evaluate(args):
     p = OptionParser(evaluate.__doc__)
     p.add_option("--query",
                  help="Chromosome location [default: %default]")
+    set_bedtools(p)
     opts, args = p.parse_args(args)
 
     if len(args) != 3:
@@ -446,6 +620,12 @@ def evaluate(args):
 
     prediction, reality, fastafile = args
     query = opts.query
+    if not opts.bedtools:
+        sizes = Sizes(fastafile)
+        be = evaluate_index(Bed(prediction), Bed(reality), sizes, query=query)
+        print >> sys.stderr, be
+        return be
+
     prediction = mergeBed(prediction)
     reality = mergeBed(reality)
     sizes = Sizes(fastafile)
@@ -481,12 +661,103 @@ def evaluate(args):
     return be
 
 
-def intersectBed_wao(abedfile, bbedfile, minOverlap=0):
+def merge_ranges(bed, seqid=None, start=None, end=None):
+    """
+    Merge the overlapping features per seqid, like `mergeBed`, optionally
+    clipped to the region seqid:start-end. Returns dict of seqid => (starts,
+    ends) arrays.
+    """
+    members = {}
+    for b in bed:
+        if seqid and b.seqid != seqid:
+            continue
+        members.setdefault(b.seqid, []).append((b.start, b.end))
+
+    merged = {}
+    for s, ranges in members.iteritems():
+        ranges = np.array(ranges, dtype=int)
+        if start is not None:
+            ranges[:, 0] = np.maximum(ranges[:, 0], start)
+            ranges[:, 1] = np.minimum(ranges[:, 1], end)
+            ranges = ranges[ranges[:, 0] <= ranges[:, 1]]
+        if not len(ranges):
+            continue
+
+        ranges = ranges[np.argsort(ranges[:, 0], kind="mergesort")]
+        starts, ends = ranges[:, 0], np.maximum.accumulate(ranges[:, 1])
+        # A new block begins where the start passes all the ends seen so far
+        breaks = np.flatnonzero(np.r_[True, starts[1:] > ends[:-1]])
+        stops = np.r_[breaks[1:], len(starts)] - 1
+        merged[s] = (starts[breaks], ends[stops])
+
+    return merged
+
+
+def evaluate_index(prediction, reality, sizes, query=None):
+    """
+    Truth table of prediction vs reality (both Bed) over the genome, or the
+    query region, computed with BedIndex rather than BEDTools.
+    """
+    seqid = start = end = None
+    if query:
+        seqid, start, end = query_to_range(query, sizes)
+        start += 1
+        total = end - start + 1
+    else:
+        total = sum(sizes.mapping.values())
+
+    pm = merge_ranges(prediction, seqid, start, end)
+    rm = merge_ranges(reality, seqid, start, end)
+    rbed = Bed()
+    for s, (starts, ends) in sorted(rm.items()):
+        for a, b in zip(starts, ends):
+            rbed.append(BedLine("\t".join(str(x) for x in (s, a - 1, b))))
+    index = BedIndex(rbed)
+
+    TP = 0
+    for s, (starts, ends) in pm.iteritems():
+        for a, b in zip(starts, ends):
+            for r in index.overlap(s, a, b):
+                TP += min(b, r.end) - max(a, r.start) + 1
+
+    P = sum(int((e - s + 1).sum()) for s, e in pm.values())
+    R = sum(int((e - s + 1).sum()) for s, e in rm.values())
+    TP = int(TP)
+    return BedEvaluate(TP, P - TP, R - TP, total - P - R + TP)
+
+
+def intersect_index(abed, bbed, minOverlap=0):
+    """
+    In-process equivalent of `intersectBed -wao`, yields (a, b) for every pair
+    of overlapping features, and (a, None) for features in abed that have no
+    overlap.
+    """
+    index = BedIndex(bbed)
+    for a in abed:
+        hits = index.overlap(a.seqid, a.start, a.end)
+        if not hits:
+            if minOverlap <= 0:
+                yield a, None
+            continue
+
+        for b in hits:
+            c = min(a.end, b.end) - max(a.start, b.start) + 1
+            if c < minOverlap:
+                continue
+            yield a, b
+
+
+def intersectBed_wao(abedfile, bbedfile, minOverlap=0, bedtools=False):
     abed = Bed(abedfile)
     bbed = Bed(bbedfile)
     print >> sys.stderr, "`{0}` has {1} features.".format(abedfile, len(abed))
     print >> sys.stderr, "`{0}` has {1} features.".format(bbedfile, len(bbed))
 
+    if not bedtools:
+        for a, b in intersect_index(abed, bbed, minOverlap=minOverlap):
+            yield a, b
+        return
+
     cmd = "intersectBed -wao -a {0} -b {1}".format(abedfile, bbedfile)
     acols = abed[0].nargs
     bcols = bbed[0].nargs
@@ -518,6 +789,7 @@ def refine(args):
     from jcvi.utils.range import range_intersect
 
     p = OptionParser(refine.__doc__)
+    set_bedtools(p)
     opts, args = p.parse_args(args)
 
     if len(args) != 3:
@@ -526,12 +798,13 @@ def refine(args):
     abedfile, bbedfile, refinedbed = args
     fw = open(refinedbed, "w")
     intersected = refined = 0
-    for a, b in intersected_wao(abedfile, bbedfile):
+    for a, b in intersectBed_wao(abedfile, bbedfile, bedtools=opts.bedtools):
         if b is None:
             print >> fw, a
             continue
 
         intersected += 1
+        a = BedLine(str(a))  # features are shared across pairs, refine a copy
         aspan_before = a.span
         arange = (a.start, a.end)
         brange = (b.start, b.end)
@@ -568,12 +841,9 @@ def distance(args):
         sys.exit(not p.print_help())
 
     bedfile, = args
-    sortedbedfile = sort([bedfile])
+    bed = Bed(bedfile)
     valid = total = 0
-    fp = open(sortedbedfile)
-    for a, b in pairwise(fp):
-        a = BedLine(a)
-        b = BedLine(b)
+    for a, b in pairwise(bed):
         ar = (a.seqid, a.start, a.end, "+")
         br = (b.seqid, b.start, b.end, "+")
         dist, oo = range_distance(ar, br, distmode=opts.distmode)
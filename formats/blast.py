@@ -8,18 +8,20 @@ import sys
 import math
 import logging
 
-from itertools import groupby
+from itertools import groupby, islice
 from collections import defaultdict
 from optparse import OptionParser
 
 import numpy as np
 
-from jcvi.formats.base import LineFile, must_open
+from jcvi.formats.base import BaseFile, LineFile, must_open, \
+        write_arrays, memmap_arrays
 from jcvi.formats.coords import print_stats
 from jcvi.formats.sizes import Sizes
-from jcvi.utils.grouper import Grouper
+from jcvi.utils.grouper import DisjointSet
 from jcvi.utils.range import range_distance
-from jcvi.apps.base import ActionDispatcher, debug, set_outfile, sh, popen
+from jcvi.apps.base import ActionDispatcher, debug, set_outfile, sh, popen, \
+        need_update
 debug()
 
 
@@ -99,17 +101,29 @@ class Blast (LineFile):
     """
     We can have a Blast class that loads entire file into memory, this is
     not very efficient for big files (BlastSlow); when the BLAST file is
-    generated by BLAST/BLAT, the file is already sorted
+    generated by BLAST/BLAT, the file is already sorted. Use `table=True` to
+    load the file through the columnar BlastTable backend instead.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, table=False):
         super(Blast, self).__init__(filename)
-        self.fp = must_open(filename)
+        self.table = BlastTable(filename) if table else None
+        self.fp = None if table else must_open(filename)
 
     def iter_line(self):
+        if self.table is not None:
+            for b in self.table:
+                yield b
+            return
+
         for row in self.fp:
             yield BlastLine(row)
 
     def iter_hits(self):
+        if self.table is not None:
+            for query, blines in self.table.iter_hits():
+                yield query, blines
+            return
+
         for query, blines in groupby(self.fp,
                 key=lambda x: BlastLine(x).query):
             blines = [BlastLine(x) for x in blines]
@@ -117,6 +131,11 @@ class Blast (LineFile):
             yield query, blines
 
     def iter_best_hit(self, N=1, hsps=False):
+        if self.table is not None:
+            for query, b in self.table.iter_best_hit(N=N, hsps=hsps):
+                yield query, b
+            return
+
         for query, blines in groupby(self.fp,
                 key=lambda x: BlastLine(x).query):
             blines = [BlastLine(x) for x in blines]
@@ -144,6 +163,330 @@ class Blast (LineFile):
         return dict(self.iter_best_hit())
 
 
+def group_bounds(keys):
+    """
+    Returns the (starts, stops) of the runs of equal values in a sorted array.
+    """
+    n = len(keys)
+    if not n:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    stops = np.r_[starts[1:], n]
+    return starts, stops
+
+
+class BlastTable (BaseFile):
+    """
+    Columnar alternative to BlastSlow, loads the entire blastfile into a NumPy
+    structured array. Query and subject names are interned into integer codes
+    (look up in `names`), the rest of the columns are typed fields. Subject
+    coordinates are normalized as in BlastLine, with `orientation` kept.
+
+    With `cache=True`, the table is saved to a binary sidecar `blastfile.bin`
+    and memory-mapped back in later runs, until the blastfile gets newer. The
+    sidecar also stores the query blocks, so that hits() can jump directly to
+    the HSPs of a query. The `offset` column keeps the byte offset of each
+    row in the blastfile, so that the original lines can be copied as is.
+    """
+    dtype = np.dtype([("query", "i4"), ("subject", "i4"),
+                      ("pctid", "f8"), ("hitlen", "i4"),
+                      ("nmismatch", "i4"), ("ngaps", "i4"),
+                      ("qstart", "i8"), ("qstop", "i8"),
+                      ("sstart", "i8"), ("sstop", "i8"),
+                      ("evalue", "f8"), ("score", "f8"),
+                      ("orientation", "S1"), ("offset", "i8")])
+
+    def __init__(self, filename, data=None, names=None, cache=False,
+                 chunksize=1000000):
+        super(BlastTable, self).__init__(filename)
+        self.data, self.names = data, names
+        self._ranks = self._index = self._blocks = None
+        if data is not None:
+            return
+
+        binfile = filename + ".bin"
+        if cache and not need_update(filename, binfile):
+            self.load(binfile)
+            if self.data.dtype == self.dtype:
+                return
+            logging.debug("Sidecar `{0}` is outdated.".format(binfile))
+
+        self.data, self.names = self.parse(filename, chunksize=chunksize)
+        self._blocks = None
+        logging.debug("Imported {0} rows ({1} names) from `{2}`.".\
+                format(len(self.data), len(self.names), filename))
+        if cache:
+            try:
+                self.save(binfile)
+            except (IOError, OSError) as e:
+                logging.warning("{0}, table not cached".format(e))
+
+    @classmethod
+    def parse(cls, filename, chunksize=1000000):
+        """
+        Parse the tabular file in chunks of lines, returns (data, names).
+        """
+        fp = must_open(filename)
+        index = {}
+        chunks = []
+        numeric = cls.dtype.names[2:12]
+        pos = 0
+        for lines in iter(lambda: list(islice(fp, chunksize)), []):
+            rows, offsets = [], []
+            for x in lines:
+                if x.strip() and x[0] != '#':
+                    rows.append(x.rstrip().split("\t"))
+                    offsets.append(pos)
+                pos += len(x)
+            if not rows:
+                continue
+
+            cols = zip(*rows)
+            chunk = np.empty(len(rows), dtype=cls.dtype)
+            chunk["query"] = [index.setdefault(x, len(index)) for x in cols[0]]
+            chunk["subject"] = [index.setdefault(x, len(index)) for x in cols[1]]
+            for name, col in zip(numeric, cols[2:12]):
+                chunk[name] = np.array(col, dtype=cls.dtype[name])
+
+            sstart, sstop = chunk["sstart"].copy(), chunk["sstop"].copy()
+            chunk["sstart"] = np.minimum(sstart, sstop)
+            chunk["sstop"] = np.maximum(sstart, sstop)
+            chunk["orientation"] = np.where(sstart > sstop, '-', '+')
+            chunk["offset"] = offsets
+            chunks.append(chunk)
+
+        data = np.concatenate(chunks) if chunks else \
+               np.zeros(0, dtype=cls.dtype)
+        names = [None] * len(index)
+        for name, code in index.iteritems():
+            names[code] = name
+
+        return data, names
+
+    def save(self, binfile):
+        """
+        Write data, query blocks and names into the binary sidecar.
+        """
+        order, qcodes, offsets = self.blocks
+        names = np.array(bytearray("\n".join(self.names)), dtype="u1")
+        write_arrays(binfile, [self.data, order, qcodes, offsets, names])
+
+    def load(self, binfile):
+        self.data, order, qcodes, offsets, names = memmap_arrays(binfile)
+        self.names = names.tostring().split("\n") if len(names) else []
+        self._blocks = order, qcodes, offsets
+        logging.debug("Mapped {0} rows ({1} names) from `{2}`.".\
+                format(len(self.data), len(self.names), binfile))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        return self.blastline(i)
+
+    def __iter__(self):
+        for i in xrange(len(self.data)):
+            yield self.blastline(i)
+
+    def blastline(self, i):
+        """
+        Materialize row i as a BlastLine.
+        """
+        query, subject, pctid, hitlen, nmismatch, ngaps, qstart, qstop, \
+            sstart, sstop, evalue, score, orientation = \
+            self.data[i].item()[:13]
+
+        b = BlastLine.__new__(BlastLine)
+        b.query, b.subject = self.names[query], self.names[subject]
+        b.pctid, b.hitlen, b.nmismatch, b.ngaps = \
+                pctid, hitlen, nmismatch, ngaps
+        b.qstart, b.qstop, b.sstart, b.sstop = qstart, qstop, sstart, sstop
+        b.evalue, b.score, b.orientation = evalue, score, orientation
+        return b
+
+    def iter_line(self):
+        return iter(self)
+
+    @property
+    def ranks(self):
+        """
+        Lexicographic rank of each name code, used to sort by name.
+        """
+        if self._ranks is None:
+            names = self.names
+            order = sorted(xrange(len(names)), key=names.__getitem__)
+            ranks = np.empty(len(names), dtype="i4")
+            ranks[order] = np.arange(len(names), dtype="i4")
+            self._ranks = ranks
+        return self._ranks
+
+    @property
+    def index(self):
+        """
+        Name => code mapping.
+        """
+        if self._index is None:
+            self._index = dict((x, i) for i, x in enumerate(self.names))
+        return self._index
+
+    @property
+    def blocks(self):
+        """
+        Returns (order, qcodes, offsets), rows order[offsets[i]:offsets[i + 1]]
+        are the HSPs of query qcodes[i], with scores descending. The qcodes
+        are sorted, so a query is found through binary search.
+        """
+        if self._blocks is None:
+            order = self.argsort()
+            query = self.data["query"][order]
+            starts, stops = group_bounds(query)
+            self._blocks = order, query[starts], np.r_[starts, len(order)]
+        return self._blocks
+
+    def codes(self, names):
+        """
+        Returns the codes of the given names, names not in the table ignored.
+        """
+        index = self.index
+        return np.array([index[x] for x in names if x in index], dtype="i4")
+
+    def take(self, idx):
+        """
+        Subset of the rows by index array or boolean mask, names are shared.
+        """
+        t = BlastTable(None, data=self.data[idx], names=self.names)
+        t.filename = self.filename
+        t._ranks, t._index = self._ranks, self._index
+        return t
+
+    def argsort(self, byname=False):
+        """
+        Group rows by query with scores descending within each query. Queries
+        are in order of first appearance, or alphabetical if `byname`. The sort
+        is stable as in the BlastLine-based code.
+        """
+        if not byname and self._blocks is not None:
+            return self._blocks[0]
+
+        data = self.data
+        idx = np.argsort(-data["score"], kind="mergesort")
+        key = data["query"][idx]
+        if byname:
+            key = self.ranks[key]
+        return idx[np.argsort(key, kind="mergesort")]
+
+    def sort(self, byname=False):
+        return self.take(self.argsort(byname=byname))
+
+    def hits(self, query):
+        """
+        Returns the BlastLines of a query, scores descending.
+        """
+        order, qcodes, offsets = self.blocks
+        code = self.index.get(query, -1)
+        i = np.searchsorted(qcodes, code)
+        if i == len(qcodes) or qcodes[i] != code:
+            return []
+
+        return [self.blastline(x) for x in order[offsets[i]:offsets[i + 1]]]
+
+    def iter_hits(self, byname=False, queries=None):
+        """
+        Same as Blast.iter_hits(), yields query => list of BlastLines. Only
+        the HSP blocks of `queries` are visited if given.
+        """
+        if queries is not None:
+            for query in queries:
+                yield query, self.hits(query)
+            return
+
+        if byname:
+            idx = self.argsort(byname=True)
+            starts, stops = group_bounds(self.data["query"][idx])
+        else:
+            idx, qcodes, offsets = self.blocks
+            starts, stops = offsets[:-1], offsets[1:]
+
+        for start, stop in zip(starts, stops):
+            blines = [self.blastline(i) for i in idx[start:stop]]
+            yield blines[0].query, blines
+
+    def best(self, N=1, hsps=False, byname=False):
+        """
+        Returns a new table with best N hits per query. With `hsps`, all HSPs
+        of the selected query-subject pairs are kept.
+        """
+        idx = self.argsort(byname=byname)
+        query = self.data["query"][idx]
+        starts, stops = group_bounds(query)
+        offsets = np.repeat(starts, stops - starts)
+        keep = (np.arange(len(idx)) - offsets) < N
+        if hsps:
+            pairs = query.astype("i8") * len(self.names) + \
+                    self.data["subject"][idx]
+            keep = np.in1d(pairs, pairs[keep])
+
+        return self.take(idx[keep])
+
+    def iter_best_hit(self, N=1, hsps=False, byname=False):
+        for b in self.best(N=N, hsps=hsps, byname=byname):
+            yield b.query, b
+
+    def filter(self, score=None, pctid=None, hitlen=None, evalue=None):
+        """
+        Returns a new table with rows passing all given cutoffs.
+        """
+        data = self.data
+        mask = np.ones(len(data), dtype=bool)
+        if score is not None:
+            mask &= data["score"] >= score
+        if pctid is not None:
+            mask &= data["pctid"] >= pctid
+        if hitlen is not None:
+            mask &= data["hitlen"] >= hitlen
+        if evalue is not None:
+            mask &= data["evalue"] <= evalue
+
+        return self.take(mask)
+
+    def counts(self, column="subject"):
+        """
+        Number of rows per name code in the given column.
+        """
+        return np.bincount(self.data[column], minlength=len(self.names))
+
+    def write(self, fw=sys.stdout):
+        for b in self:
+            print >> fw, b
+
+    def write_raw(self, fw=sys.stdout):
+        """
+        Copy the original lines of the rows from the blastfile, which must be
+        a plain seekable file. Unlike write(), all columns and number formats
+        are kept.
+        """
+        fp = open(self.filename)
+        for offset in self.data["offset"]:
+            fp.seek(offset)
+            row = fp.readline()
+            fw.write(row if row.endswith("\n") else row + "\n")
+        fp.close()
+
+
+def set_table(instance, note=None):
+    """
+    Add --table option to load BLAST file through BlastTable
+    """
+    help = "Use columnar NumPy backend for big files, cached as binary " \
+           "sidecar `blastfile.bin`"
+    if note:
+        help += ", " + note
+    instance.add_option("--table", default=False, action="store_true",
+            help=help + " [default: %default]")
+
+
 def get_stats(blastfile):
 
     from jcvi.utils.range import range_union
@@ -355,6 +698,7 @@ def top10(args):
     p = OptionParser(top10.__doc__)
     p.add_option("--ids", default=None,
                 help="Two column ids file to query seqid [default: %default]")
+    set_table(p)
     opts, args = p.parse_args(args)
 
     if len(args) != 1:
@@ -363,6 +707,15 @@ def top10(args):
     blastfile, = args
     mapping = DictFile(opts.ids, delimiter="\t") if opts.ids else {}
 
+    if opts.table:
+        blast = BlastTable(blastfile, cache=True)
+        counts = blast.counts("subject")
+        top = sorted((-c, blast.names[i]) for i, c in enumerate(counts) if c)
+        for count, seqid in top[:10]:
+            nseqid = mapping.get(seqid, seqid)
+            print "\t".join((str(-count), nseqid))
+        return
+
     cmd = "cut -f2 {0}".format(blastfile)
     cmd += " | sort | uniq -c | sort -k1,1nr | head"
     fp = popen(cmd)
@@ -386,6 +739,8 @@ def sort(args):
             help="Sort by reference position [default: %default]")
     p.add_option("--coords", default=False, action="store_true",
             help="File is .coords generated by NUCMER [default: %default]")
+    set_table(p, note="rows tied on the sort keys keep their file order "\
+                       "instead of GNU sort's whole-line order")
 
     opts, args = p.parse_args(args)
 
@@ -394,6 +749,37 @@ def sort(args):
 
     blastfile, = args
 
+    if opts.table and not opts.coords:
+        if blastfile.endswith((".gz", ".bz2")) or not op.isfile(blastfile):
+            logging.error("--table needs a plain file, not `{0}`".\
+                    format(blastfile))
+            sys.exit(1)
+
+        blast = BlastTable(blastfile, cache=True)
+        data = blast.data
+        if opts.query:
+            keys = (data["qstart"], blast.ranks[data["query"]])
+        elif opts.ref:
+            sstart = np.where(data["orientation"] == '-', \
+                              data["sstop"], data["sstart"])
+            keys = (sstart, blast.ranks[data["subject"]])
+        else:
+            keys = (-data["score"], blast.ranks[data["query"]])
+
+        # Copy the original lines, comment lines are kept on top
+        blast = blast.take(np.lexsort(keys))
+        tmpfile = blastfile + ".tmp"
+        fw = open(tmpfile, "w")
+        for row in open(blastfile):
+            if row[0] == '#':
+                fw.write(row)
+        blast.write_raw(fw)
+        fw.close()
+        os.rename(tmpfile, blastfile)
+        if op.exists(blastfile + ".bin"):  # offsets are stale
+            os.remove(blastfile + ".bin")
+        return
+
     if opts.coords:
         if opts.query:
             key = "-k13,13 -k3,3n"
@@ -509,15 +895,19 @@ def chain_HSPs(blastlines, xdist=100, ydist=100):
     key = lambda x: (x.query, x.subject)
     blastlines.sort(key=key)
 
-    clusters = Grouper()
+    # HSPs are grouped by their index in the sorted list
+    hsps = []
+    clusters = DisjointSet(len(blastlines))
     for qs, points in groupby(blastlines, key=key):
         points = sorted(list(points), \
                 key=lambda x: (x.qstart, x.qstop, x.sstart, x.sstop))
 
         n = len(points)
+        offset = len(hsps)
+        hsps.extend(points)
         for i in xrange(n):
             a = points[i]
-            clusters.join(a)
+            clusters.join(offset + i)
             for j in xrange(i + 1, n):
                 b = points[j]
                 if a.orientation != b.orientation:
@@ -532,11 +922,11 @@ def chain_HSPs(blastlines, xdist=100, ydist=100):
                 if del_y > ydist:
                     continue
                 # otherwise join
-                clusters.join(a, b)
+                clusters.join(offset + i, offset + j)
 
     chained_hsps = []
     for c in clusters:
-        chained_hsps.append(combine_HSPs(c))
+        chained_hsps.append(combine_HSPs([hsps[x] for x in c]))
     chained_hsps = sorted(chained_hsps, key=lambda x: -x.score)
 
     return chained_hsps
@@ -599,6 +989,39 @@ def mismatches(args):
     stem_leaf_plot(data, 0, 20, 20, title=title)
 
 
+def query_coverage(blastfile, table=False):
+    """
+    Yields (query, covered, alignlen, mismatches, gaps) for each query, in
+    alphabetical order of the queries.
+    """
+    if not table:
+        blast = BlastSlow(blastfile)
+        for query, blines in blast.iter_hits():
+            covered = alignlen = mismatches = gaps = 0
+            for b in blines:
+                covered += abs(b.qstart - b.qstop + 1)
+                alignlen += b.hitlen
+                mismatches += b.nmismatch
+                gaps += b.ngaps
+            yield query, covered, alignlen, mismatches, gaps
+        return
+
+    blast = BlastTable(blastfile, cache=True)
+    data = blast.data
+    query = data["query"]
+    n = len(blast.names)
+    sums = lambda w: np.bincount(query, weights=w, minlength=n).astype("i8")
+    covered = sums(np.abs(data["qstart"] - data["qstop"] + 1))
+    alignlen = sums(data["hitlen"])
+    mismatches = sums(data["nmismatch"])
+    gaps = sums(data["ngaps"])
+    codes = np.unique(query)
+    codes = codes[np.argsort(blast.ranks[codes])]
+    for i in codes:
+        yield blast.names[i], int(covered[i]), int(alignlen[i]), \
+                int(mismatches[i]), int(gaps[i])
+
+
 def covfilter(args):
     """
     %prog covfilter blastfile fastafile
@@ -616,6 +1039,7 @@ def covfilter(args):
     p.add_option("--list", dest="list", default=False, action="store_true",
             help="List the id% and cov% per gene [default: %default]")
     set_outfile(p, outfile=None)
+    set_table(p)
 
     opts, args = p.parse_args(args)
 
@@ -639,23 +1063,11 @@ def covfilter(args):
     alignlen = 0
     queries = set()
     valid = set()
-    blast = BlastSlow(querysupermap)
-    for query, blines in blast.iter_hits():
-        blines = list(blines)
+    for query, this_covered, this_alignlen, this_mismatches, this_gaps in \
+            query_coverage(querysupermap, table=opts.table):
         queries.add(query)
 
         # per gene report
-        this_covered = 0
-        this_alignlen = 0
-        this_mismatches = 0
-        this_gaps = 0
-
-        for b in blines:
-            this_covered += abs(b.qstart - b.qstop + 1)
-            this_alignlen += b.hitlen
-            this_mismatches += b.nmismatch
-            this_gaps += b.ngaps
-
         this_identity = 100. - (this_mismatches + this_gaps) * 100. / this_alignlen
         this_coverage = this_covered * 100. / sizes[query]
 
@@ -702,8 +1114,13 @@ def covfilter(args):
     if not outfile:
         return
 
-    fp = open(blastfile)
     fw = must_open(outfile, "w")
+    if opts.table:
+        blast = BlastTable(blastfile, cache=True)
+        mask = np.in1d(blast.data["query"], blast.codes(valid))
+        blast.take(mask).write(fw)
+        return
+
     blast = Blast(blastfile)
     for b in blast.iter_line():
         if b.query in valid:
@@ -950,16 +1367,25 @@ def best(args):
             help="get best N hits [default: %default]")
     p.add_option("--hsps", default=False, action="store_true",
             help="get all HSPs for the best pair [default: %default]")
+    set_table(p, note="ties in score keep their file order instead of "\
+                       "GNU sort's whole-line order")
     opts, args = p.parse_args(args)
 
     if len(args) != 1:
         sys.exit(not p.print_help())
 
     blastfile, = args
-    sort([blastfile])
     bestblastfile = blastfile + ".best"
     fw = open(bestblastfile, "w")
 
+    if opts.table:
+        # Sorted in memory, no need for the in-place sort
+        blast = BlastTable(blastfile, cache=True)
+        blast.best(N=opts.n, byname=True).write(fw)
+        return
+
+    sort([blastfile])
+
     b = Blast(blastfile)
     for q, bline in b.iter_best_hit(N=opts.n, hsps=False):
         print >> fw, bline
@@ -6,6 +6,7 @@ import sys
 import os
 import os.path as op
 import shutil
+import mmap
 import logging
 import string
 
@@ -19,39 +20,202 @@ from Bio.SeqRecord import SeqRecord
 
 from jcvi.formats.base import BaseFile, DictFile, must_open
 from jcvi.utils.table import banner
-from jcvi.apps.base import ActionDispatcher, debug, set_outfile, sh
+from jcvi.apps.base import ActionDispatcher, debug, set_outfile, sh, \
+        need_update
 from jcvi.apps.console import red, green
 debug()
 
 
+class FastaIndex (BaseFile):
+    """
+    Random access into a plain FASTA file through a samtools-compatible `.fai`
+    index, with columns name, length, offset, linebases and linewidth. The
+    index is built once and rebuilt when the FASTA file is newer. Subsequences
+    are sliced off a memory map of the FASTA file at offsets computed from the
+    line width, so no record is ever built. When the `.fai` cannot be written,
+    e.g. in a read-only directory, the index is kept in memory only.
+    """
+    def __init__(self, fastafile):
+        faifile = fastafile + ".fai"
+        if need_update(fastafile, faifile):
+            rows = self.build(fastafile)
+            try:
+                self.write(rows, faifile)
+            except (IOError, OSError) as e:
+                logging.debug("{0}, index kept in memory".format(e))
+        else:
+            rows = [row.split()[:5] for row in open(faifile)]
+
+        super(FastaIndex, self).__init__(faifile)
+        self.fastafile = fastafile
+        self.names = []
+        self.entries = {}
+        for name, length, offset, linebases, linewidth in rows:
+            if name in self.entries:
+                raise ValueError("Duplicate record `{0}` in `{1}`".\
+                                 format(name, fastafile))
+            self.names.append(name)
+            self.entries[name] = (int(length), int(offset), int(linebases),
+                                  int(linewidth))
+        self._mmap = None
+
+    @classmethod
+    def write(cls, rows, faifile):
+        fw = open(faifile, "w")
+        for row in rows:
+            print >> fw, "\t".join(str(x) for x in row)
+        fw.close()
+        logging.debug("Index written to `{0}`.".format(faifile))
+
+    @classmethod
+    def build(cls, fastafile):
+        """
+        Returns the `.fai` rows of fastafile, raises ValueError if the sequence
+        lines in a record are not all of the same width (except the last one).
+        """
+        rows = []
+        offset = 0
+        record = None
+        fp = open(fastafile, "rb")
+        for line in fp:
+            offset += len(line)
+            if line[0] == ">":
+                if record:
+                    rows.append(record)
+                name = line[1:].split()[0]
+                # name, length, offset, linebases, linewidth, last line seen
+                record = [name, 0, offset, 0, 0, False]
+                continue
+
+            if record is None:
+                raise ValueError("`{0}` is not FASTA".format(fastafile))
+
+            bases = len(line.rstrip("\r\n"))
+            if record[5] and bases:
+                raise ValueError("Irregular line width in `{0}`, record `{1}`".\
+                                 format(fastafile, record[0]))
+            if record[3] == 0:
+                record[3], record[4] = bases, len(line)
+            elif bases != record[3] or len(line) != record[4]:
+                record[5] = True
+                if bases > record[3]:
+                    raise ValueError("Irregular line width in `{0}`, " \
+                        "record `{1}`".format(fastafile, record[0]))
+            record[1] += bases
+        fp.close()
+
+        if record:
+            rows.append(record)
+
+        return [row[:5] for row in rows]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    @property
+    def mmap(self):
+        if self._mmap is None:
+            fp = open(self.fastafile, "rb")
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            fp.close()
+        return self._mmap
+
+    def size(self, name):
+        return self.entries[name][0]
+
+    def fetch(self, name, start=None, stop=None):
+        """
+        Returns the string of name:start-stop, 1-based and inclusive.
+        """
+        length, offset, linebases, linewidth = self.entries[name]
+        start = start - 1 if start is not None else 0
+        stop = stop if stop is not None else length
+
+        assert start >= 0, "start (%d) must >= 0" % (start + 1)
+        assert stop <= length, \
+                ("stop (%d) must be <= " + \
+                "length of `%s` (%d)") % (stop, name, length)
+
+        if start >= stop:
+            return ""
+
+        a = offset + start / linebases * linewidth + start % linebases
+        b = offset + stop / linebases * linewidth + stop % linebases
+        return self.mmap[a:b].translate(None, "\r\n")
+
+
+def get_fai(fastafile):
+    """
+    Returns the FastaIndex of fastafile, or None if it cannot be indexed (e.g.
+    compressed, irregular line width, or duplicate names).
+    """
+    if fastafile.endswith(".gz") or not op.isfile(fastafile):
+        return None
+
+    try:
+        return FastaIndex(fastafile)
+    except (ValueError, IOError, OSError) as e:
+        logging.debug("{0}, use Bio.SeqIO instead".format(e))
+        return None
+
+
 class Fasta (BaseFile, dict):
 
     def __init__(self, filename, index=True, key_function=None, lazy=False):
         super(Fasta, self).__init__(filename)
         self.key_function = key_function
+        self.fai = None
+        self._index = None
 
         if lazy:  # do not incur the overhead
             return
 
-        if index:
-            self.index = SeqIO.index(filename, "fasta",
-                    key_function=key_function)
+        # Bio.SeqIO.index cannot read compressed files, those are loaded whole
+        if index and not filename.endswith((".gz", ".bz2")):
+            # The .fai serves names, sizes and subsequences, records are only
+            # indexed by Bio.SeqIO once they are asked for
+            if not key_function:
+                self.fai = get_fai(filename)
+            if not self.fai:
+                self._index = SeqIO.index(filename, "fasta",
+                        key_function=key_function)
         else:
-            # SeqIO.to_dict expects a different key_function that operates on
-            # the SeqRecord instead of the raw string
-            _key_function = (lambda rec: key_function(rec.description)) if \
-                    key_function else None
-            self.index = SeqIO.to_dict(SeqIO.parse(must_open(filename), "fasta"),
-                    key_function=_key_function)
+            self._index = self._to_dict()
+
+    def _to_dict(self):
+        # SeqIO.to_dict expects a different key_function that operates on
+        # the SeqRecord instead of the raw string
+        key_function = self.key_function
+        _key_function = (lambda rec: key_function(rec.description)) if \
+                key_function else None
+        return SeqIO.to_dict(SeqIO.parse(must_open(self.filename), "fasta"),
+                key_function=_key_function)
+
+    @property
+    def index(self):
+        if self._index is None:
+            if self.filename.endswith((".gz", ".bz2")):
+                self._index = self._to_dict()
+            else:
+                self._index = SeqIO.index(self.filename, "fasta",
+                        key_function=self.key_function)
+        return self._index
 
     def _key_function(self, key):
         return self.key_function(key) if self.key_function else key
 
     def __len__(self):
+        if self.fai:
+            return len(self.fai)
         return len(self.index)
 
     def __contains__(self, key):
         key = self._key_function(key)
+        if self.fai:
+            return key in self.fai
         return key in self.index
 
     def __getitem__(self, key):
@@ -60,9 +224,16 @@ class Fasta (BaseFile, dict):
         return rec
 
     def keys(self):
+        if self.fai:
+            return list(self.fai.names)
         return self.index.keys()
 
     def iterkeys(self):
+        if self.fai:
+            for k in self.fai.names:
+                yield k
+            return
+
         for k in self.index.iterkeys():
             yield k
 
@@ -72,7 +243,8 @@ class Fasta (BaseFile, dict):
 
     def itersizes(self):
         for k in self.iterkeys():
-            yield k, len(self[k])
+            size = self.fai.size(k) if self.fai else len(self[k])
+            yield k, size
 
     def iteritems_ordered(self):
         for rec in SeqIO.parse(must_open(self.filename), "fasta"):
@@ -141,6 +313,12 @@ class Fasta (BaseFile, dict):
         assert name in self, "feature: %s not in `%s`" % \
                 (f, self.filename)
 
+        if self.fai:
+            seq = self.fai.fetch(name, f.get('start'), f.get('stop'))
+            if f.get('strand') in (-1, '-1', '-'):
+                seq = str(Seq(seq).reverse_complement())
+            return seq if asstring else Seq(seq)
+
         fasta = self[f['chr']]
 
         seq = Fasta.subseq(fasta,
@@ -9,6 +9,9 @@ import os.path as op
 import sys
 import logging
 
+import numpy as np
+
+from itertools import imap, izip
 from collections import namedtuple
 from optparse import OptionParser
 
@@ -22,14 +25,23 @@ qual_offset = lambda x: 33 if x == "sanger" else 64
 
 
 class FastqLite (object):
-    def __init__(self, name, seq, qual):
+    def __init__(self, name, seq, qual, id=None):
         self.name = name
         self.seq = seq
         self.qual = qual
+        self.id = id or name
 
     def __str__(self):
         return "\n".join((self.name, self.seq, "+", self.qual))
 
+    @property
+    def length(self):
+        return len(self.seq)
+
+    @property
+    def quality(self):
+        return [ord(x) for x in self.qual]
+
     def rc(self):
         self.seq = rc(self.seq)
         self.qual = self.qual[::-1]
@@ -62,18 +74,180 @@ class FastqRecord (object):
         return [ord(x) for x in self.qual]
 
 
-def iter_fastq(filename, offset=0, key=None):
-    if isinstance(filename, str):
-        logging.debug("Read file `{0}`".format(filename))
-        fh = must_open(filename)
-    else:
-        fh = filename
+class FastqBatch (object):
+    """
+    A batch of fastq records parsed from a large buffer. The quality values of
+    all records are held in one flat uint8 array, where record i spans
+    qual[starts[i]:starts[i] + lengths[i]].
+    """
+    def __init__(self, lines, offset=0):
+        if lines and lines[0].endswith("\r"):
+            lines = [x.rstrip("\r") for x in lines]
+        self.headers = lines[0::4]
+        self.seqs = lines[1::4]
+        quals = lines[3::4]
+        assert self.headers[0][:1] == "@", \
+                "malformed fastq record: {0}".format(self.headers[0])
+
+        n = len(self.seqs)
+        self.lengths = np.fromiter(imap(len, self.seqs), dtype=int, count=n)
+        qlengths = np.fromiter(imap(len, quals), dtype=int, count=n)
+        mismatch = np.flatnonzero(self.lengths != qlengths)
+        if len(mismatch):
+            i = mismatch[0]
+            raise AssertionError("length mismatch: seq(%s) and qual(%s)" % \
+                                 (self.seqs[i], quals[i]))
+
+        self.starts = np.cumsum(self.lengths) - self.lengths
+        self.qual = np.frombuffer("".join(quals), dtype=np.uint8)
+        if offset != 0:
+            self.qual = convert_qual(self.qual, offset)
 
+    def __len__(self):
+        return len(self.seqs)
+
+    @property
+    def bases(self):
+        return int(self.lengths.sum())
+
+    @property
+    def names(self):
+        return [x.split(None, 1)[0] for x in self.headers]
+
+    def qualstrings(self):
+        qual = self.qual.tostring()
+        return [qual[s:s + l] for s, l in \
+                izip(self.starts.tolist(), self.lengths.tolist())]
+
+    def records(self, key=None):
+        for name, seq, qual in izip(self.names, self.seqs, self.qualstrings()):
+            yield FastqLite(name, seq, qual, id=key(name) if key else None)
+
+    def trim(self, first=1, last=0):
+        """
+        Keep bases first..last (1-based, inclusive) of every read, as in
+        `fastx_trimmer`. Quality values are gathered in one indexing pass.
+        """
+        f = first - 1
+        ends = np.minimum(self.lengths, last) if last else self.lengths
+        lengths = np.maximum(ends - f, 0)
+        starts = np.cumsum(lengths) - lengths
+        idx = np.repeat(self.starts + f - starts, lengths) + \
+              np.arange(lengths.sum())
+        self.qual = self.qual[idx]
+        self.lengths, self.starts = lengths, starts
+        self.seqs = [x[f:last] for x in self.seqs] if last else \
+                    [x[f:] for x in self.seqs]
+
+    def write(self, fw, mask=None):
+        headers, seqs, quals = self.headers, self.seqs, self.qualstrings()
+        if mask is not None:
+            select = np.flatnonzero(mask).tolist()
+            headers = [headers[i] for i in select]
+            seqs = [seqs[i] for i in select]
+            quals = [quals[i] for i in select]
+
+        n = len(seqs)
+        if not n:
+            return
+        lines = [None] * (4 * n)
+        lines[0::4] = headers
+        lines[1::4] = seqs
+        lines[2::4] = ["+"] * n
+        lines[3::4] = quals
+        fw.write("\n".join(lines) + "\n")
+
+
+def convert_qual(qual, offset):
+    """
+    Shift the quality values by offset in one vectorized add.
+    """
+    if len(qual):
+        lo, hi = int(qual.min()) + offset, int(qual.max()) + offset
+        if lo < 33 or hi > 126:
+            raise ValueError("Quality out of range after offset {0}: [{1}, {2}]".\
+                             format(offset, lo, hi))
+    return qual + np.uint8(offset % 256)
+
+
+def iter_blocks(filename, blocksize=1 << 22):
+    """
+    Yields raw blocks from a file or a filehandle. Gzip files are decompressed
+    by a background thread, which stays a few blocks ahead of the parser.
+    """
+    if isinstance(filename, list):
+        for f in filename:
+            for block in iter_blocks(f, blocksize=blocksize):
+                yield block
+        return
+
+    if not isinstance(filename, basestring) or not filename.endswith(".gz"):
+        fp = must_open(filename) if isinstance(filename, basestring) \
+                else filename
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            yield block
+        return
+
+    import gzip
+    import threading
+    import Queue
+
+    queue = Queue.Queue(maxsize=4)
+
+    def inflate():
+        try:
+            fp = gzip.open(filename)
+            while True:
+                block = fp.read(blocksize)
+                queue.put(block)
+                if not block:
+                    break
+            fp.close()
+        except Exception, e:
+            queue.put(e)
+
+    t = threading.Thread(target=inflate, name="Gzip Thread")
+    t.daemon = True
+    t.start()
     while True:
-        rec = FastqRecord(fh, offset=offset, key=key)
-        if not rec.name:
+        block = queue.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
             break
-        yield rec
+        yield block
+    t.join()
+
+
+def iter_fastq_batches(filename, offset=0, blocksize=1 << 22):
+    """
+    Parse the fastq file in large blocks and yield FastqBatch. Records split
+    across blocks are carried over to the next batch.
+    """
+    if isinstance(filename, basestring):
+        logging.debug("Read file `{0}`".format(filename))
+
+    tail = ""
+    for block in iter_blocks(filename, blocksize=blocksize):
+        lines = (tail + block).split("\n")
+        n = (len(lines) - 1) / 4 * 4
+        tail = "\n".join(lines[n:])
+        if n:
+            yield FastqBatch(lines[:n], offset=offset)
+
+    lines = tail.rstrip().split("\n")
+    if lines != [""]:
+        assert len(lines) % 4 == 0, "Truncated fastq record at end of file"
+        yield FastqBatch(lines, offset=offset)
+
+
+def iter_fastq(filename, offset=0, key=None):
+    for batch in iter_fastq_batches(filename, offset=offset):
+        for rec in batch.records(key=key):
+            yield rec
     yield None  # sentinel
 
 
@@ -104,17 +278,17 @@ def split_barcode(t):
 
     barcode, excludebarcode, outdir, inputfile = t
     trim = len(barcode.seq)
+    exclude = tuple(x.seq for x in excludebarcode)
 
-    fp = must_open(inputfile)
     outfastq = op.join(outdir, barcode.id + ".fastq")
     fw = open(outfastq, "w")
-    for title, seq, qual in FastqGeneralIterator(fp):
-        if seq[:trim] != barcode.seq:
-            continue
-        hasexclude = any(seq.startswith(x.seq) for x in excludebarcode)
-        if hasexclude:
+    for batch in iter_fastq_batches(inputfile):
+        mask = [seq[:trim] == barcode.seq and not seq.startswith(exclude) \
+                for seq in batch.seqs]
+        if not any(mask):
             continue
-        print >> fw, "@{0}\n{1}\n+\n{2}".format(title, seq[trim:], qual[trim:])
+        batch.trim(first=trim + 1)
+        batch.write(fw, mask=mask)
 
     fw.close()
 
@@ -133,7 +307,7 @@ def deconvolute(args):
     from multiprocessing import Pool, cpu_count
 
     p = OptionParser(deconvolute.__doc__)
-    p.add_option("--cpus", default=32,
+    p.add_option("--cpus", default=32, type="int",
                  help="Number of processes to run [default: %default]")
     p.add_option("--outdir", default="deconv",
                  help="Output directory [default: %default]")
@@ -367,11 +541,10 @@ def trim(args):
     """
     %prog trim fastqfile
 
-    Wraps `fastx_trimmer` to trim from begin or end of reads.
+    Trim from begin or end of reads, same as `fastx_trimmer`. Reads that are
+    trimmed to nothing are dropped.
     """
     p = OptionParser(trim.__doc__)
-    set_grid(p)
-
     p.add_option("-f", dest="first", default=0, type="int",
             help="First base to keep. Default is 1.")
     p.add_option("-l", dest="last", default=0, type="int",
@@ -381,19 +554,19 @@ def trim(args):
     if len(args) != 1:
         sys.exit(not p.print_help())
 
-    grid = opts.grid
-
     fastqfile, = args
     base = op.basename(fastqfile).split(".")[0]
     fq = base + ".ntrimmed.fastq"
 
-    cmd = "fastx_trimmer -Q33 "
-    if opts.first:
-        cmd += "-f {0.first} ".format(opts)
-    if opts.last:
-        cmd += "-l {0.last} ".format(opts)
+    first = max(opts.first, 1)
+    fw = open(fq, "w")
+    for batch in iter_fastq_batches(fastqfile):
+        batch.trim(first=first, last=opts.last)
+        batch.write(fw, mask=batch.lengths > 0)
+    fw.close()
 
-    sh(cmd, grid=grid, infile=fastqfile, outfile=fq)
+    logging.debug("Trimmed reads written to `{0}`".format(fq))
+    return fq
 
 
 def splitread(args):
@@ -451,10 +624,9 @@ def size(args):
     total_size = 0
     total_numrecords = 0
     for f in args:
-        for rec in iter_fastq(f):
-            if rec:
-                total_numrecords += 1
-                total_size += len(rec)
+        for batch in iter_fastq_batches(f):
+            total_numrecords += len(batch)
+            total_size += batch.bases
 
     print >>sys.stderr, "A total %d bases in %s sequences" % (total_size,
             total_numrecords)
@@ -475,7 +647,6 @@ def convert(args):
     p.add_option("-q", dest="outfastq", default="sanger", choices=supported_qvs,
             help="output qv, one of {0} [default: %default]".\
                 format("|".join(supported_qvs)))
-    set_grid(p)
 
     opts, args = p.parse_args(args)
 
@@ -484,20 +655,14 @@ def convert(args):
 
     infastq, outfastq = args
 
-    from jcvi.apps.command import EMBOSSPATH
-
-    seqret = EMBOSSPATH("seqret")
-    if infastq.endswith(".gz"):
-        cmd = "zcat {0} | ".format(infastq)
-        cmd += seqret + " fastq-{0}::stdin fastq-{1}::stdout".\
-                format(opts.infastq, opts.outfastq)
-        cmd += " | gzip > {0}".format(outfastq)
-    else:
-        cmd = seqret + " fastq-{0}::{1} fastq-{2}::{3}".\
-                format(opts.infastq, infastq, opts.outfastq, outfastq)
-
-    sh(cmd, grid=opts.grid)
+    offset = qual_offset(opts.outfastq) - qual_offset(opts.infastq)
+    fw = must_open(outfastq, "w")
+    for batch in iter_fastq_batches(infastq, offset=offset):
+        batch.write(fw)
+    fw.close()
 
+    logging.debug("Quality offset shifted by {0} in `{1}`".\
+                    format(offset, outfastq))
     return outfastq
 
 
@@ -648,7 +813,6 @@ def pair(args):
     in_offset = qual_offset(opts.infastq)
     out_offset = qual_offset(opts.outfastq)
     offset = out_offset - in_offset
-    ref = opts.ref
 
     strip_name = lambda x: x[:-1]
 
@@ -677,9 +841,6 @@ def pair(args):
             print >>fragsfw, b
             b = bh_iter.next()
 
-        # update progress
-        pos = rh.tell()
-
     # write all the leftovers to frags file
     while a:
         print >>fragsfw, a
@@ -689,6 +850,9 @@ def pair(args):
         print >>fragsfw, b
         b = bh_iter.next()
 
+    fragsfw.close()
+    pairsfw.close()
+
 
 if __name__ == '__main__':
     main()
@@ -8,11 +8,14 @@ import os.path as op
 import itertools
 import logging
 
+import numpy as np
+
 from collections import defaultdict
 from urlparse import unquote
 from optparse import OptionParser
 
-from jcvi.formats.base import LineFile, must_open
+from jcvi.formats.base import BaseFile, LineFile, must_open, write_arrays, \
+        memmap_arrays
 from jcvi.formats.fasta import Fasta, SeqIO
 from jcvi.formats.bed import Bed, BedLine
 from jcvi.utils.iter import flatten
@@ -22,6 +25,8 @@ from jcvi.apps.base import ActionDispatcher, set_outfile, mkdir, need_update, sh
 
 Valid_strands = ('+', '-', '?', '.')
 Valid_phases = ('0', '1', '2', '.')
+Fields = ("seqid", "source", "type", "start", "end", "score", "strand",
+          "phase", "attributes")
 FastaTag = "##FASTA"
 RegionTag = "##sequence-region"
 
@@ -29,7 +34,13 @@ RegionTag = "##sequence-region"
 class GffLine (object):
     """
     Specification here (http://www.sequenceontology.org/gff3.shtml)
+
+    Column 9 is only decoded on first access of `attributes_text`,
+    `attributes` or `accn`, so that coordinates and type come cheap.
     """
+    __slots__ = ("seqid", "source", "type", "start", "end", "score", "strand",
+                 "phase", "key", "_raw", "_attributes_text", "_attributes")
+
     def __init__(self, sline, key="ID"):
         args = sline.strip().split("\t")
         self.seqid = args[0]
@@ -44,12 +55,36 @@ class GffLine (object):
         self.phase = args[7]
         assert self.phase in Valid_phases, \
                 "phase must be one of {0}".format(Valid_phases)
-        self.attributes_text = unquote(args[8].strip())
-        self.gff3 = gff3 = "=" in self.attributes_text
-        self.attributes = make_attributes(self.attributes_text, gff3=gff3)
+        self._raw = args[8]
+        self._attributes_text = self._attributes = None
         # key is not in the gff3 field, this indicates the conversion to accn
         self.key = key  # usually it's `ID=xxxxx;`
 
+    @property
+    def attributes_text(self):
+        if self._attributes_text is None:
+            self._attributes_text = unquote(self._raw.strip())
+        return self._attributes_text
+
+    @attributes_text.setter
+    def attributes_text(self, text):
+        self._attributes_text = text
+
+    @property
+    def gff3(self):
+        return "=" in self.attributes_text
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = make_attributes(self.attributes_text,
+                                               gff3=self.gff3)
+        return self._attributes
+
+    @attributes.setter
+    def attributes(self, attributes):
+        self._attributes = attributes
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -94,12 +129,22 @@ class GffLine (object):
 
 
 class Gff (LineFile):
-
-    def __init__(self, filename, key="ID"):
+    """
+    Iterate over the features of a GFF file. With `fields`, e.g.
+    fields=("seqid", "start", "end"), tuples of these columns are yielded
+    instead of GffLine, with no attribute work at all.
+    """
+    def __init__(self, filename, key="ID", fields=None):
         super(Gff, self).__init__(filename)
         self.key = key
+        self.fields = fields
 
     def __iter__(self):
+        fields = self.fields
+        if fields:
+            columns = [Fields.index(x) for x in fields]
+            ints = [Fields.index(x) for x in ("start", "end")]
+
         fp = must_open(self.filename)
         for row in fp:
             row = row.strip()
@@ -109,11 +154,196 @@ class Gff (LineFile):
                 if row == FastaTag:
                     break
                 continue
-            yield GffLine(row, key=self.key)
+            if not fields:
+                yield GffLine(row, key=self.key)
+                continue
+
+            args = row.split("\t")
+            yield tuple(int(args[i]) if i in ints else args[i] \
+                        for i in columns)
 
     @property
     def seqids(self):
-        return set(x.seqid for x in self)
+        return set(x for x, in Gff(self.filename, fields=("seqid",)))
+
+
+class GffStore (BaseFile):
+    """
+    Features of a GFF file in compact arrays of seqid, type, coordinates,
+    score, strand, ID, Name and the byte offset of the line. The strings are
+    interned into `names`. The Parent attributes are resolved into
+    parent => children and child => parents adjacency lists.
+
+    The GFF is parsed once, then the store is cached in the binary sidecar
+    `gffile.bin`, when it can be written. A compressed GFF or stdin cannot be
+    read back by byte offset, it is streamed once and the feature lines are
+    kept in memory instead, with no sidecar.
+    """
+    dtype = [("seqid", "i4"), ("type", "i4"), ("start", "i8"), ("end", "i8"),
+             ("score", "f8"), ("strand", "S1"), ("id", "i4"), ("name", "i4"),
+             ("offset", "i8")]
+
+    def __init__(self, filename):
+        super(GffStore, self).__init__(filename)
+        self.lines = None
+        binfile = filename + ".bin"
+        if filename.endswith((".gz", ".bz2")) or not op.isfile(filename):
+            self.lines = []
+            self.parse()
+        elif need_update(filename, binfile):
+            self.parse()
+            try:
+                self.save(binfile)
+            except (IOError, OSError) as e:
+                logging.debug("{0}, store kept in memory".format(e))
+        else:
+            self.load(binfile)
+        self.codes = dict((x, i) for i, x in enumerate(self.names))
+
+    def parse(self):
+        codes = {}
+        names = []
+        rows = []
+        edges = []
+
+        def code(s):
+            if s not in codes:
+                codes[s] = len(names)
+                names.append(s)
+            return codes[s]
+
+        offset = 0
+        lines = self.lines
+        fp = must_open(self.filename) if lines is not None \
+             else open(self.filename, "rb")
+        for line in fp:
+            pos = offset
+            offset += len(line)
+            row = line.strip()
+            if row == "":
+                continue
+            if row[0] == '#':
+                if row == FastaTag:
+                    break
+                continue
+
+            g = GffLine(row)
+            if lines is not None:
+                pos = len(lines)
+                lines.append(row)
+            try:
+                score = float(g.score)
+            except ValueError:
+                score = np.nan
+            attributes = g.attributes
+            name = code(attributes["Name"][0]) if "Name" in attributes else -1
+            rows.append((code(g.seqid), code(g.type), g.start, g.end, score,
+                         g.strand, code(g.accn), name, pos))
+            for parent in attributes.get("Parent", []):
+                edges.append((len(rows) - 1, parent))
+        if fp is not sys.stdin:
+            fp.close()
+
+        self.names = names
+        self.data = data = np.array(rows, dtype=self.dtype)
+        n = len(data)
+
+        # A feature ID spread over several lines resolves to its first line
+        ucodes, first = np.unique(data["id"], return_index=True)
+        self.first = np.zeros(len(names), dtype="i4") - 1
+        self.first[ucodes] = first
+
+        ci = np.array([c for c, p in edges], dtype="i4")
+        pi = np.array([self.first[codes[p]] if p in codes else -1 \
+                       for c, p in edges], dtype="i4")
+        valid = pi >= 0
+        ci, pi = ci[valid], pi[valid]
+
+        order = np.lexsort((ci, pi))
+        self.children_offsets = np.r_[0, np.cumsum(np.bincount(pi,
+                                        minlength=n))].astype("i8")
+        self.children_ids = ci[order]
+        order = np.lexsort((pi, ci))
+        self.parents_offsets = np.r_[0, np.cumsum(np.bincount(ci,
+                                        minlength=n))].astype("i8")
+        self.parents_ids = pi[order]
+
+        logging.debug("Parsed {0} features ({1} edges) from `{2}`.".\
+                format(n, len(ci), self.filename))
+
+    def save(self, binfile):
+        names = np.array(bytearray("\n".join(self.names)), dtype="u1")
+        write_arrays(binfile, [self.data, self.first,
+                               self.children_offsets, self.children_ids,
+                               self.parents_offsets, self.parents_ids, names])
+
+    def load(self, binfile):
+        self.data, self.first, self.children_offsets, self.children_ids, \
+            self.parents_offsets, self.parents_ids, names = \
+            memmap_arrays(binfile)
+        self.names = names.tostring().split("\n") if len(names) else []
+        logging.debug("Mapped {0} features from `{1}`.".\
+                format(len(self.data), binfile))
+
+    def __len__(self):
+        return len(self.data)
+
+    def index(self, id):
+        """
+        Returns the position of the first feature with the id, or -1.
+        """
+        if id not in self.codes:
+            return -1
+        return self.first[self.codes[id]]
+
+    def id(self, i):
+        return self.names[self.data["id"][i]]
+
+    def name(self, i):
+        code = self.data["name"][i]
+        return self.names[code] if code >= 0 else None
+
+    def seqid(self, i):
+        return self.names[self.data["seqid"][i]]
+
+    def type(self, i):
+        return self.names[self.data["type"][i]]
+
+    def children(self, i):
+        a, b = self.children_offsets[i], self.children_offsets[i + 1]
+        return self.children_ids[a:b]
+
+    def parents(self, i):
+        a, b = self.parents_offsets[i], self.parents_offsets[i + 1]
+        return self.parents_ids[a:b]
+
+    def of_type(self, types):
+        """
+        Positions of the features of given types, in file order.
+        """
+        codes = [self.codes[x] for x in types if x in self.codes]
+        return np.flatnonzero(np.in1d(self.data["type"], codes))
+
+    def iter_lines(self, idx):
+        """
+        Yields the raw GFF lines of the features at the positions idx.
+        """
+        if self.lines is not None:
+            for i in self.data["offset"][idx]:
+                yield self.lines[i]
+            return
+
+        fp = open(self.filename, "rb")
+        for offset in self.data["offset"][idx]:
+            fp.seek(offset)
+            yield fp.readline().strip()
+        fp.close()
+
+    def line(self, i):
+        return iter(self.iter_lines([i])).next()
+
+    def gffline(self, i):
+        return GffLine(self.line(i))
 
 
 def make_attributes(s, gff3=True):
@@ -215,12 +445,19 @@ def parents(args):
         sys.exit(not p.print_help())
 
     gff_file, idsfile = args
-    g = make_index(gff_file)
+    g = GffStore(gff_file)
     fp = open(idsfile)
     for row in fp:
         cid = row.strip()
-        b = g.parents(cid, 1).next()
-        print "\t".join((cid, b.id))
+        i = g.index(cid)
+        if i < 0:
+            logging.error("`{0}` not found in `{1}`".format(cid, gff_file))
+            continue
+        ps = g.parents(i)
+        if not len(ps):
+            logging.error("`{0}` has no parent".format(cid))
+            continue
+        print "\t".join((cid, g.id(ps[0])))
 
 
 def filter(args):
@@ -399,15 +636,17 @@ def liftover(args):
         print g
 
 
-def get_piles(allgenes):
+def get_piles(allgenes, gff):
     """
     Before running uniq, we need to compute all the piles. The piles are a set
-    of redundant features we want to get rid of. Input are a list of GffLines
-    features. Output are list of list of features distinct "piles".
+    of redundant features we want to get rid of. Input are the positions of
+    features in the GffStore. Output are list of list of features distinct
+    "piles".
     """
     from jcvi.utils.range import Range, range_piles
 
-    ranges = [Range(a.seqid, a.start, a.end, 0, i) \
+    data = gff.data
+    ranges = [Range(gff.seqid(a), data["start"][a], data["end"][a], 0, i) \
                     for i, a in enumerate(allgenes)]
 
     for pile in range_piles(ranges):
@@ -419,7 +658,8 @@ def uniq(args):
     %prog uniq gffile > uniq.gff
 
     Remove redundant gene models. For overlapping gene models, take the longest
-    gene. A second scan takes only the genes selected.
+    gene. A second scan takes only the genes selected. The selected lines are
+    printed as they are in the gffile, attributes are not unescaped.
 
     --mode controls whether you want larger feature, or higher scoring feature.
     --best controls how many redundant features to keep, e.g. 10 for est2genome.
@@ -445,26 +685,25 @@ def uniq(args):
         sys.exit(not p.print_help())
 
     gffile, = args
-    gff = Gff(gffile)
+    gff = GffStore(gffile)
     mode = opts.mode
     bestn = opts.best
-    allgenes = []
-    for g in gff:
-        if g.type != opts.type:
-            continue
-        allgenes.append(g)
+    data = gff.data
+    allgenes = gff.of_type([opts.type])
 
     logging.debug("A total of {0} genes imported.".format(len(allgenes)))
-    allgenes.sort(key=lambda x: (x.seqid, x.start))
+    seqids = np.array([gff.seqid(x) for x in allgenes])
+    allgenes = allgenes[np.lexsort((data["start"][allgenes], seqids))]
 
-    g = get_piles(allgenes)
+    g = get_piles(allgenes, gff)
 
     bestids = set()
     for group in g:
         if mode == "span":
-            scores_group = [(- x.span, x) for x in group]
+            scores_group = [(- (data["end"][x] - data["start"][x] + 1), x) \
+                                for x in group]
         else:
-            scores_group = [(- float(x.score), x) for x in group]
+            scores_group = [(- data["score"][x], x) for x in group]
 
         scores_group.sort()
         seen = set()
@@ -472,44 +711,39 @@ def uniq(args):
             if len(seen) >= bestn:
                 break
 
-            name = x.attributes["Name"][0] if opts.name else x.accn
+            name = gff.name(x) if opts.name else gff.id(x)
             if name in seen:
                 continue
 
             seen.add(name)
-            bestids.add(x.accn)
+            bestids.add(gff.id(x))
 
     logging.debug("A total of {0} genes selected.".format(len(bestids)))
     logging.debug("Populate children. Iteration 1..")
-    gff = Gff(gffile)
-    children = set()
-    for g in gff:
-        if "Parent" not in g.attributes:
-            continue
-        for parent in g.attributes["Parent"]:
-            if parent in bestids:
-                children.add(g.accn)
+    children = set(gff.id(c) for x in bestids for c in
+                   gff.children(gff.index(x)))
 
     if opts.iter == "2":
+        # In file order, so that descendants below a child found in this pass
+        # are also taken
         logging.debug("Populate children. Iteration 2..")
-        gff = Gff(gffile)
-        for g in gff:
-            if "Parent" not in g.attributes:
-                continue
-            for parent in g.attributes["Parent"]:
-                if parent in children:
-                    children.add(g.accn)
+        for i in xrange(len(gff)):
+            if any(gff.id(x) in children for x in gff.parents(i)):
+                children.add(gff.id(i))
 
     logging.debug("Filter gff file..")
-    gff = Gff(gffile)
     seen = set()
-    for g in gff:
-        accn = g.accn
+    selected = []
+    for i in xrange(len(gff)):
+        accn = gff.id(i)
         if accn in seen:
             continue
-        if (g.type == opts.type and accn in bestids) or (accn in children):
+        if (gff.type(i) == opts.type and accn in bestids) or (accn in children):
             seen.add(accn)
-            print g
+            selected.append(i)
+
+    for row in gff.iter_lines(selected):
+        print row
 
 
 def sort(args):
@@ -741,27 +975,44 @@ def extract(args):
     contigID = set(contigID.split(",")) if contigID else None
     names = set(x.strip() for x in open(namesfile)) if namesfile else None
 
+    if gffile.endswith((".gz", ".bz2")) or not op.isfile(gffile):
+        logging.error("extract needs a plain gffile, not `{0}`".format(gffile))
+        sys.exit(1)
+
+    gff = GffStore(gffile)
+    keep = np.ones(len(gff), dtype=bool)
+    if contigID:
+        codes = [gff.codes[x] for x in contigID if x in gff.codes]
+        keep &= np.in1d(gff.data["seqid"], codes)
+    if names:
+        codes = [gff.codes[x] for x in names if x in gff.codes]
+        keep &= np.in1d(gff.data["name"], codes)
+
+    # Comments are passed through, the feature lines are selected by the byte
+    # offsets recorded in the store
+    keep = set(gff.data["offset"][keep].tolist())
     outfile = opts.outfile
-    fp = open(gffile)
+    fp = open(gffile, "rb")
     fw = must_open(outfile, "w")
-    for row in fp:
-        atoms = row.split()
-        if len(atoms) == 0:
+    offset = 0
+    for line in fp:
+        pos = offset
+        offset += len(line)
+        row = line.strip()
+        if row == "":
             continue
-        tag = atoms[0]
         if row[0] == "#":
-            if not (tag == RegionTag and contigID and atoms[1] not in contigID):
-                print >> fw, row.rstrip()
-            if tag == FastaTag:
+            atoms = row.split()
+            tag = atoms[0]
+            if not (tag == RegionTag and contigID and len(atoms) > 1 and \
+                    atoms[1] not in contigID):
+                print >> fw, line.rstrip()
+            if row == FastaTag:
                 break
+            continue
 
-        b = GffLine(row)
-        is_right_contig = (contigID and tag in contigID) or (not contigID)
-        is_right_names = (names and b.attributes["Name"][0] in names) or \
-                         (not names)
-
-        if is_right_contig and is_right_names:
-            print >> fw, row.rstrip()
+        if pos in keep:
+            print >> fw, line.rstrip()
 
     if not opts.fasta:
         return
@@ -794,7 +1045,7 @@ def split(args):
 
     for s in seqids:
         outfile = op.join(outdir, s + ".gff")
-        extract([gffile, s, "--outfile=" + outfile])
+        extract([gffile, "--contigs=" + s, "--outfile=" + outfile])
 
 
 def note(args):
@@ -944,17 +1195,18 @@ def children(args):
         sys.exit(not p.print_help())
 
     gff_file, = args
-    g = make_index(gff_file)
+    g = GffStore(gff_file)
     parents = set(opts.parents.split(','))
 
-    for feat in get_parents(gff_file, parents):
+    for feat in g.of_type(parents):
 
-        cc = [c.id for c in g.children(feat.id, 1)]
+        cc = [g.id(c) for c in g.children(feat)]
         if len(cc) <= 1:
             continue
 
         print "\t".join(str(x) for x in \
-                    (feat.id, feat.start, feat.stop, "|".join(cc)))
+                    (g.id(feat), g.data["start"][feat], g.data["end"][feat],
+                     "|".join(cc)))
 
 
 def load(args):
@@ -986,41 +1238,47 @@ def load(args):
 
     gff_file, fasta_file = args
 
-    g = make_index(gff_file)
-    f = Fasta(fasta_file, index=False)
+    g = GffStore(gff_file)
+    data = g.data
+    f = Fasta(fasta_file)
     fw = must_open(opts.outfile, "w")
 
     parents = set(opts.parents.split(','))
     children_list = set(opts.children.split(','))
     attr = opts.attribute
 
-    for feat in get_parents(gff_file, parents):
+    for feat in g.of_type(parents):
 
         children = []
-        for c in g.children(feat.id, 1):
+        for c in g.children(feat):
 
-            if c.featuretype not in children_list:
+            if g.type(c) not in children_list:
                 continue
-            child = f.sequence(dict(chr=c.chrom, start=c.start, stop=c.stop,
-                strand=c.strand))
-            children.append((child, c))
+            start, stop = data["start"][c], data["end"][c]
+            child = f.sequence(dict(chr=g.seqid(c), start=start, stop=stop,
+                strand=data["strand"][c]))
+            children.append((child, start))
 
+        feat_id = g.id(feat)
         if not children:
             print >>sys.stderr, "[warning] %s has no children with type %s" \
-                                    % (feat.id, ','.join(children_list))
+                                    % (feat_id, ','.join(children_list))
             continue
         # sort children in incremental position
-        children.sort(key=lambda x: x[1].start)
+        children.sort(key=lambda x: x[1])
         # reverse children if negative strand
-        if feat.strand == '-':
+        if data["strand"][feat] == '-':
             children.reverse()
         feat_seq = ''.join(x[0] for x in children)
 
-        description = ",".join(feat.attributes[attr]) \
-                if attr and attr in feat.attributes else ""
+        description = ""
+        if attr:
+            attributes = g.gffline(feat).attributes
+            if attr in attributes:
+                description = ",".join(attributes[attr])
         description = description.replace("\"", "")
 
-        rec = SeqRecord(Seq(feat_seq), id=feat.id, description=description)
+        rec = SeqRecord(Seq(feat_seq), id=feat_id, description=description)
         SeqIO.write([rec], fw, "fasta")
         fw.flush()
 
@@ -1063,31 +1321,33 @@ def bed12(args):
     parent, block, thick = opts.parent, opts.block, opts.thick
     outfile = opts.outfile
 
-    g = make_index(gffile)
+    g = GffStore(gffile)
+    data = g.data
     fw = must_open(outfile, "w")
 
-    for f in g.features_of_type(parent):
+    for f in g.of_type([parent]):
 
-        chrom = f.chrom
-        chromStart = f.start - 1
-        chromEnd = f.stop
-        name = f.id
+        chrom = g.seqid(f)
+        chromStart = data["start"][f] - 1
+        chromEnd = data["end"][f]
+        name = g.id(f)
         score = 0
-        strand = f.strand
+        strand = data["strand"][f]
         thickStart = 1e15
         thickEnd = 0
         blocks = []
 
-        for c in g.children(name, 1):
+        for c in g.children(f):
 
-            cstart, cend = c.start - 1, c.stop
+            cstart, cend = data["start"][c] - 1, data["end"][c]
+            ctype = g.type(c)
 
-            if c.featuretype == block:
+            if ctype == block:
                 blockStart = cstart - chromStart
                 blockSize = cend - cstart
                 blocks.append((blockStart, blockSize))
 
-            elif c.featuretype == thick:
+            elif ctype == thick:
                 thickStart = min(thickStart, cstart)
                 thickEnd = max(thickEnd, cend)
 
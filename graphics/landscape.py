@@ -18,7 +18,7 @@ from optparse import OptionParser
 
 from jcvi.formats.sizes import Sizes
 from jcvi.formats.base import BaseFile, DictFile
-from jcvi.formats.bed import Bed, bins
+from jcvi.formats.bed import Bed, make_bins
 from jcvi.algorithms.matrix import moving_sum
 from jcvi.graphics.base import plt, _, set_image_options, \
         Rectangle, CirclePolygon
@@ -229,7 +229,7 @@ def draw_gauge(ax, margin, maxl, rightmargin=None, optimal=7):
 
 
 def get_binfiles(bedfiles, fastafile, shift):
-    binfiles = [bins([x, "--binsize={0}".format(shift), fastafile]) for x in bedfiles]
+    binfiles = make_bins(bedfiles, fastafile, binsize=shift)
     binfiles = [BinFile(x) for x in binfiles]
     return binfiles
 
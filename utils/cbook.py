@@ -6,6 +6,7 @@ mostly decorator patterns
 import os
 import os.path as op
 import logging
+import functools
 
 
 class memoized(object):
@@ -64,14 +65,20 @@ def depends(func):
     """
     Decorator to perform check on infile and outfile. When infile is not present, issue
     warning, and when outfile is present, skip function calls.
+
+    The decorated function also gets `register(graph, **kwargs)`, which adds
+    the call as a task in a `jcvi.utils.taskgraph.TaskGraph` instead.
     """
     from jcvi.apps.base import need_update
 
     infile = "infile"
     outfile = "outfile"
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         assert outfile in kwargs, \
             "You need to specify `outfile=` on function call"
+        infilename = []
         if infile in kwargs:
             infilename = kwargs[infile]
             if isinstance(infilename, basestring):
@@ -97,6 +104,18 @@ def depends(func):
 
         return outfilename
 
+    def register(graph, *args, **kwargs):
+        assert outfile in kwargs, \
+            "You need to specify `outfile=` on function call"
+        outfilename = kwargs[outfile]
+        name = kwargs.pop("name", None) or "{0}:{1}".format(func.__name__,
+                outfilename if isinstance(outfilename, basestring) \
+                            else outfilename[0])
+        cpus = kwargs.pop("cpus", 1)
+        return graph.add(name, kwargs.get(infile), outfilename, func,
+                         args=args, kwargs=kwargs, cpus=cpus)
+
+    wrapper.register = register
     return wrapper
 
 
@@ -6,6 +6,8 @@ Disjoint set data structure <http://code.activestate.com/recipes/387776/>
 Author: Michael Droettboom
 """
 
+from array import array
+
 
 class Grouper(object):
     """
@@ -92,6 +94,252 @@ class Grouper(object):
         return len(group)
 
 
+class DisjointSet(object):
+    """
+    Array-backed union-find over dense integer ids, with path compression and
+    union by rank. It has the same join(), joined() and iteration interface as
+    Grouper, and only yields the ids that have been passed to join(). The
+    arrays grow to fit the largest id seen.
+
+    >>> d = DisjointSet()
+    >>> d.join(0, 1)
+    >>> d.join(1, 2)
+    >>> d.join(5, 4)
+    >>> list(d)
+    [[0, 1, 2], [4, 5]]
+    >>> d.joined(0, 2)
+    True
+    >>> 3 in d
+    False
+    >>> d.joined(0, 4)
+    False
+    >>> d[4]
+    (4, 5)
+    """
+    def __init__(self, n=0):
+        self.parent = array("i")
+        self.rank = array("B")
+        self.seen = array("B")
+        self.grow(n)
+
+    def grow(self, n):
+        """
+        Make room for ids up to n - 1, each in its own set.
+        """
+        size = len(self.parent)
+        if n <= size:
+            return
+        self.parent.extend(xrange(size, n))
+        self.rank.extend([0] * (n - size))
+        self.seen.extend([0] * (n - size))
+
+    def find(self, x):
+        """
+        Returns the root of the set that x belongs, compressing the path.
+        """
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, a, b):
+        """
+        Merge the sets of a and b, hooking the shallower tree under the other.
+        """
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        rank = self.rank
+        if rank[ra] < rank[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        if rank[ra] == rank[rb]:
+            rank[ra] += 1
+        return ra
+
+    def join(self, a, *args):
+        """
+        Join given arguments into the same set. Accepts one or more arguments.
+        """
+        self.grow(max((a,) + args) + 1)
+        seen = self.seen
+        seen[a] = 1
+        for arg in args:
+            seen[arg] = 1
+            self.union(a, arg)
+
+    def joined(self, a, b):
+        """
+        Returns True if a and b are members of the same set.
+        """
+        if a not in self or b not in self:
+            return False
+        return self.find(a) == self.find(b)
+
+    def labels(self):
+        """
+        Returns the root of every id as an array, fully compressed at once.
+        """
+        import numpy as np
+
+        parent = np.frombuffer(self.parent, dtype=np.intc).copy()
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+        return parent
+
+    def groups(self):
+        """
+        Returns the members of the joined ids grouped by set, as a list of
+        arrays. Members are sorted, and sets are ordered by smallest member.
+        """
+        import numpy as np
+
+        members = np.flatnonzero(np.frombuffer(self.seen, dtype=np.uint8))
+        if not len(members):
+            return []
+        labels = self.labels()[members]
+        order = np.argsort(labels, kind="mergesort")
+        members, labels = members[order], labels[order]
+        breaks = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+        groups = np.split(members, breaks)
+        groups.sort(key=lambda x: x[0])
+        return groups
+
+    def __iter__(self):
+        """
+        Returns an iterator returning each of the disjoint sets as a list.
+        """
+        for group in self.groups():
+            yield group.tolist()
+
+    def __getitem__(self, key):
+        """
+        Returns the set that a certain key belongs.
+        """
+        if key not in self:
+            raise KeyError(key)
+        root = self.find(key)
+        return tuple(x for x in xrange(len(self.parent)) \
+                     if self.seen[x] and self.find(x) == root)
+
+    def __contains__(self, key):
+        return 0 <= key < len(self.seen) and self.seen[key] == 1
+
+    def __len__(self):
+        return len(self.groups())
+
+
+class CompactGrouper(object):
+    """
+    Drop-in replacement for Grouper, which encodes the hashable objects to
+    dense integer ids and groups the ids with a DisjointSet. Sets are listed in
+    the order of their first joined member.
+
+    >>> g = CompactGrouper()
+    >>> g.join('a', 'b')
+    >>> g.join('b', 'c')
+    >>> g.join('d', 'e')
+    >>> list(g)
+    [['a', 'b', 'c'], ['d', 'e']]
+    >>> g.joined('a', 'c')
+    True
+    >>> 'f' in g
+    False
+    >>> g['e']
+    ('d', 'e')
+    """
+    def __init__(self, init=[]):
+        self._ids = {}
+        self._keys = []
+        self._set = DisjointSet()
+        for x in init:
+            self.join(x)
+
+    def encode(self, key):
+        ids = self._ids
+        id = ids.get(key)
+        if id is None:
+            id = ids[key] = len(self._keys)
+            self._keys.append(key)
+        return id
+
+    def join(self, a, *args):
+        """
+        Join given arguments into the same set. Accepts one or more arguments.
+        """
+        encode = self.encode
+        self._set.join(encode(a), *[encode(x) for x in args])
+
+    def joined(self, a, b):
+        """
+        Returns True if a and b are members of the same set.
+        """
+        ids = self._ids
+        try:
+            return self._set.joined(ids[a], ids[b])
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        """
+        Returns an iterator returning each of the disjoint sets as a list.
+        """
+        keys = self._keys
+        for group in self._set:
+            yield [keys[x] for x in group]
+
+    def __getitem__(self, key):
+        """
+        Returns the set that a certain key belongs.
+        """
+        keys = self._keys
+        return tuple(keys[x] for x in self._set[self._ids[key]])
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._set)
+
+
+def array_union(n, a, b):
+    """
+    Array-based union-find over items 0..n-1, joined along the edges (a[i],
+    b[i]). Roots are hooked onto the smaller root and then fully compressed,
+    until all edges are within a set. Returns the set label of each item,
+    which is the smallest item in its set.
+
+    >>> array_union(5, [0, 3], [1, 4]).tolist()
+    [0, 0, 2, 3, 3]
+    """
+    import numpy as np
+
+    parent = np.arange(n)
+    a, b = np.asarray(a, dtype=int), np.asarray(b, dtype=int)
+    while True:
+        pa, pb = parent[a], parent[b]
+        diff = pa != pb
+        if not diff.any():
+            break
+        pa, pb = pa[diff], pb[diff]
+        np.minimum.at(parent, np.maximum(pa, pb), np.minimum(pa, pb))
+        # path compression
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+    return parent
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
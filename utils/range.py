@@ -315,41 +315,78 @@ def range_chain(ranges):
     >>> range_chain(ranges)
     ([Range(seqid='2', start=0, end=1, score=3, id=0), Range(seqid='3', start=5, end=7, score=3, id=2)], 6)
     """
-    endpoints = _make_endpoints(ranges)
+    if not ranges:
+        return [], 0
 
-    # stores the left end index for quick retrieval
-    left_index = {}
-    # dynamic programming, each entry [score, from_index, which_chain]
-    scores = []
+    seqids, starts, ends, scores, ids = zip(*ranges)
+    chains, score = range_chain_arrays(seqids, starts, ends, scores)
 
-    for i, (seqid, pos, leftright, j, score) in enumerate(endpoints):
+    selected = [ranges[x] for x in chains]
 
-        cur_score = [0, -1, -1] if i == 0 else scores[-1][:]
+    return selected, score
 
-        if leftright == LEFT:
-            left_index[j] = i
 
-        else:  # this is right end of j-th interval
-            # update if chaining j-th interval gives a better score
-            left_j = left_index[j]
-            chain_score = scores[left_j][0] + score
-            if chain_score > cur_score[0]:
-                cur_score = [chain_score, left_j, j]
+def range_chain_arrays(seqids, starts, ends, scores):
+    """
+    Weighted interval scheduling over parallel arrays, same as range_chain()
+    but returns the indices of the selected intervals. Endpoints are ordered
+    by (seqid, pos, LEFT/RIGHT, index), so intervals that share a coordinate
+    conflict, and ties keep the chain found first.
 
-        scores.append(cur_score)
+    >>> range_chain_arrays(["1", "1", "1"], [0, 3, 10], [9, 18, 28], [22, 24, 20])
+    ([0, 2], 42)
+    """
+    import numpy as np
+
+    n = len(starts)
+    if n == 0:
+        return [], 0
+
+    codes = np.unique(np.asarray(seqids), return_inverse=True)[1]
+    idx = np.arange(n)
+
+    ecodes = np.concatenate((codes, codes))
+    epos = np.concatenate((np.asarray(starts), np.asarray(ends)))
+    esides = np.repeat([LEFT, RIGHT], n)
+    eidx = np.concatenate((idx, idx))
+    order = np.lexsort((eidx, esides, epos, ecodes))
+    eidx = eidx[order]
+    isright = esides[order] == RIGHT
+    isleft = ~isright
+
+    # Number of intervals that end before each interval starts
+    nright = np.cumsum(isright) - isright
+    prev = np.empty(n, dtype=int)
+    prev[eidx[isleft]] = nright[isleft]
+
+    # Dynamic programming on intervals in the order of their right ends
+    byend = eidx[isright]
+    prev = prev[byend].tolist()
+    byend = byend.tolist()
+    scores = list(scores)
+
+    best = [0] * (n + 1)
+    taken = [False] * n
+    for r, j in enumerate(byend):
+        chain_score = best[prev[r]] + scores[j]
+        if chain_score > best[r]:
+            best[r + 1] = chain_score
+            taken[r] = True
+        else:
+            best[r + 1] = best[r]
 
     chains = []
-    score, last, chain_id = scores[-1]  # start backtracking
-    while last != -1:
-        if chain_id != -1:
-            chains.append(chain_id)
-        _, last, chain_id = scores[last]
+    r = n  # start backtracking
+    while r > 0:
+        if taken[r - 1]:
+            chains.append(byend[r - 1])
+            r = prev[r - 1]
+        else:
+            r -= 1
 
     chains.reverse()
 
-    selected = [ranges[x] for x in chains]
-
-    return selected, score
+    return chains, best[n]
 
 
 def range_depth(ranges, size, verbose=True):
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Declarative task graph for pipelines that chain steps by `need_update`. Each
+task has inputs, outputs, and a shell command or a callable. A task depends on
+the tasks that produce its inputs, and is skipped when its outputs are up to
+date, judged by mtime or by content hash. Independent branches run in parallel
+with a bounded number of cpus, and each task records its wall time.
+
+>>> g = TaskGraph(cpus=2)
+>>> a = g.add("a", [], ["a.txt"], "echo a > a.txt")
+>>> b = g.add("b", ["a.txt"], ["b.txt"], "cat a.txt > b.txt")
+>>> [x.name for x in g.upstream(b)]
+['a']
+"""
+
+import os.path as op
+import time
+import logging
+
+from jcvi.apps.base import need_update, sh
+
+
+def listify(a):
+    if a is None:
+        return []
+    if isinstance(a, basestring):
+        return [a]
+    return list(a)
+
+
+def filehash(filenames, blocksize=1 << 20):
+    """
+    SHA1 over the contents of a list of files.
+    """
+    import hashlib
+
+    h = hashlib.sha1()
+    for filename in filenames:
+        h.update(filename)
+        if not op.exists(filename):
+            continue
+        fp = open(filename, "rb")
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+        fp.close()
+
+    return h.hexdigest()
+
+
+class Task (object):
+    """
+    A node in the TaskGraph. The action is either a shell command (string),
+    run with `sh`, or a callable called with args and kwargs.
+    """
+    def __init__(self, name, inputs, outputs, action, args=(), kwargs=None,
+                 cpus=1, after=None):
+        self.name = name
+        self.inputs = listify(inputs)
+        self.outputs = listify(outputs)
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.cpus = cpus
+        self.after = listify(after)
+        self.status = "pending"
+        self.walltime = 0
+        self.error = None
+        self.sig = None
+
+    def __str__(self):
+        return "\t".join((self.name, self.status,
+                          "{0:.1f}".format(self.walltime)))
+
+    @property
+    def signature(self):
+        if isinstance(self.action, basestring):
+            action = self.action
+        else:
+            import hashlib
+
+            name = getattr(self.action, "__name__", repr(self.action))
+            params = repr((self.args, sorted(self.kwargs.items())))
+            action = name + ":" + hashlib.sha1(params).hexdigest()
+        return filehash(self.inputs) + ":" + action
+
+    def need_update(self):
+        return not self.outputs or need_update(self.inputs, self.outputs)
+
+    def run(self):
+        start = time.time()
+        try:
+            for x in self.inputs:
+                assert op.exists(x), \
+                    "The specified infile `{0}` does not exist".format(x)
+
+            if isinstance(self.action, basestring):
+                retcode = sh(self.action)
+                assert retcode == 0, \
+                    "Command exited with {0}: {1}".format(retcode, self.action)
+            else:
+                self.action(*self.args, **self.kwargs)
+
+            for x in self.outputs:
+                assert op.exists(x), \
+                    "Something went wrong, `{0}` not found".format(x)
+        except Exception, e:
+            self.error = e
+        self.walltime = time.time() - start
+
+        return self
+
+
+class TaskGraph (object):
+    """
+    Collection of tasks, with dependencies inferred from matching outputs to
+    inputs, plus any explicit `after=` task names. With check="hash", a task is
+    also rerun when the content of its inputs, or its command, changed since
+    the last run, as recorded in `statefile`.
+    """
+    def __init__(self, cpus=1, check="mtime", statefile=".taskgraph"):
+        assert check in ("mtime", "hash")
+        self.cpus = cpus
+        self.check = check
+        self.statefile = statefile
+        self.tasks = []
+        self.producers = {}
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, name, inputs, outputs, action, args=(), kwargs=None,
+            cpus=1, after=None):
+        assert name not in [x.name for x in self.tasks], \
+                "Task `{0}` already exists".format(name)
+        task = Task(name, inputs, outputs, action, args=args, kwargs=kwargs,
+                    cpus=min(cpus, self.cpus), after=after)
+        for x in task.outputs:
+            assert x not in self.producers, \
+                "`{0}` is produced by both `{1}` and `{2}`".\
+                format(x, self.producers[x].name, name)
+            self.producers[x] = task
+        self.tasks.append(task)
+
+        return task
+
+    def get_task(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+
+        raise KeyError(name)
+
+    def upstream(self, task):
+        deps = [self.producers[x] for x in task.inputs if x in self.producers]
+        deps += [self.get_task(x) for x in task.after]
+        seen = set()
+        return [x for x in deps if not (x.name in seen or seen.add(x.name))]
+
+    def readstate(self):
+        state = {}
+        if self.check == "hash" and op.exists(self.statefile):
+            fp = open(self.statefile)
+            for row in fp:
+                name, signature = row.rstrip("\n").split("\t", 1)
+                state[name] = signature
+            fp.close()
+        return state
+
+    def writestate(self, state):
+        if self.check != "hash":
+            return
+        fw = open(self.statefile, "w")
+        for name, signature in sorted(state.items()):
+            print >> fw, "\t".join((name, signature))
+        fw.close()
+
+    def need_update(self, task, state, ran):
+        if self.check == "hash":
+            task.sig = task.signature
+        if any(x.name in ran for x in self.upstream(task)):
+            return True
+        if self.check == "hash":
+            return any(not op.exists(x) for x in task.outputs) or \
+                   state.get(task.name) != task.sig
+        return task.need_update()
+
+    def run(self):
+        """
+        Run the tasks in dependency order, at most `cpus` at a time. Tasks
+        downstream of a failure are not run. Returns True if all succeeded.
+        """
+        import threading
+        import Queue
+
+        state = self.readstate()
+        upstream = dict((x.name, self.upstream(x)) for x in self.tasks)
+        pending = list(self.tasks)
+        done = set()
+        ran = set()
+        stale = {}
+        running = 0
+        free = self.cpus
+        finished = Queue.Queue()
+
+        def work(task):
+            try:
+                task.run()
+            except BaseException, e:
+                task.error = e
+            finally:
+                finished.put(task)
+
+        while pending or running:
+            npending = len(pending)
+            for task in pending[:]:
+                deps = upstream[task.name]
+                if any(x.status in ("failed", "cancelled") for x in deps):
+                    task.status = "cancelled"
+                    pending.remove(task)
+                    logging.error("Task `{0}` cancelled.".format(task.name))
+                    continue
+                if not all(x.name in done for x in deps):
+                    continue
+                if task.name not in stale:
+                    stale[task.name] = self.need_update(task, state, ran)
+                if not stale[task.name]:
+                    task.status = "skipped"
+                    pending.remove(task)
+                    done.add(task.name)
+                    logging.debug("Task `{0}` is up to date.".\
+                                  format(task.name))
+                    continue
+                if task.cpus > free:
+                    continue
+
+                task.status = "running"
+                pending.remove(task)
+                free -= task.cpus
+                running += 1
+                logging.debug("Task `{0}` started.".format(task.name))
+                t = threading.Thread(target=work, args=(task,))
+                t.daemon = True
+                t.start()
+
+            if not running:
+                assert len(pending) < npending, "Cycle among tasks: {0}".\
+                        format(", ".join(x.name for x in pending))
+                continue
+
+            task = finished.get()
+            free += task.cpus
+            running -= 1
+            if task.error is None:
+                task.status = "done"
+                done.add(task.name)
+                ran.add(task.name)
+                if self.check == "hash":
+                    state[task.name] = task.sig
+                logging.debug("Task `{0}` done in {1:.1f}s.".\
+                              format(task.name, task.walltime))
+            else:
+                task.status = "failed"
+                logging.error("Task `{0}` failed: {1}".\
+                              format(task.name, task.error))
+
+        self.writestate(state)
+
+        return all(x.status in ("done", "skipped") for x in self.tasks)
+
+    def report(self):
+        """
+        Per-task status and wall time, in the order of addition.
+        """
+        return "\n".join(str(x) for x in self.tasks)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()